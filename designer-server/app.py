@@ -8,9 +8,12 @@ from controllers.auth_controller import auth_bp
 from controllers.user_controller import user_bp
 from controllers.dashboard_controller import dashboard_bp
 from controllers.app_controller import app_bp, start_background_task
+from controllers.home_assistant_controller import home_assistant_bp
 from services.user_token_service import UserTokenService
 from services.user_service import UserService
-from services.container_registry import create_container
+from services.component_service import ComponentService
+from services.home_assistant_hub_service import HomeAssistantHubService
+from services.container_registry import create_container, get_container
 
 
 def create_app():
@@ -36,7 +39,9 @@ def create_app():
         # Disable CORS only in development
         CORS(app, resources={
             r"/components/*": {"origins": "http://localhost:5173"},
-            r"/auth/*": {"origins": "http://localhost:5173"}
+            r"/component-bundle": {"origins": "http://localhost:5173"},
+            r"/auth/*": {"origins": "http://localhost:5173"},
+            r"/home-assistant/*": {"origins": "http://localhost:5173"}
         })
     else:
         # Initialise CORS
@@ -47,8 +52,10 @@ def create_app():
     app.register_blueprint(user_bp, url_prefix='/users')
     app.register_blueprint(app_bp, url_prefix='/')
     app.register_blueprint(dashboard_bp, url_prefix='/dashboards')
+    app.register_blueprint(home_assistant_bp, url_prefix='/home-assistant')
 
     app.config["JWT_COOKIE_SECURE"] = True
+    app.config["SERVER"] = all_config["app"].get("server") or {}
     app.config["JWT_SECRET_KEY"] = all_config["app"]["jwt_key"]
 
     # Initialise JWT
@@ -59,6 +66,17 @@ def create_app():
     user_service = container.get(UserService)
     user_service.ensure_admin_user()
 
+    # Minify and hash the web components up front, after this only changed files are processed
+    component_service = container.get(ComponentService)
+    component_service.get_manifest(app.static_folder)
+
+    # Connect to home assistant once for all the panels
+    home_assistant_hub_service = container.get(HomeAssistantHubService)
+    home_assistant_hub_service.start()
+
+    # When enabled the current user is built from the signed access token claims
+    stateless_auth = all_config["app"].get("stateless_auth", False)
+
     # User injection
     @jwt.user_lookup_loader
     def inject_user(jwt_headers, jwt_data):
@@ -67,6 +85,14 @@ def create_app():
         if user_name is None:
             return None
 
+        # Refresh tokens (and tokens issued without the claims) still load the user from storage
+        if stateless_auth and jwt_data["type"] == "access" and "uid" in jwt_data and "roles" in jwt_data:
+            return {
+                "id": jwt_data["uid"],
+                "userName": user_name,
+                "roles": list(jwt_data["roles"])
+            }
+
         user = user_service.get_user(user_name=user_name)
         return user
 
@@ -80,12 +106,26 @@ def create_app():
 
         return error_model
 
+    # Tokens created at login use the user model as their identity
+    @jwt.user_identity_loader
+    def user_identity_lookup(identity):
+        if isinstance(identity, dict):
+            return identity["userName"]
+
+        return identity
+
     # JWT claims
     @jwt.additional_claims_loader
     def inject_user_claims(identity):
-        user = user_service.get_user(user_name=identity)
-        if user and len(user["roles"]) > 0:
-            return {"roles": user["roles"]}
+        # Only look the user up if the caller didn't already have the user model
+        if isinstance(identity, dict):
+            user = identity
+        else:
+            user = user_service.get_user(user_name=identity)
+
+        if user:
+            # The user ID and roles are enough to build the current user in stateless mode
+            return {"uid": user["id"], "roles": user["roles"]}
 
         return None
 
@@ -110,21 +150,24 @@ def create_app():
     def check_token_revoked(jwt_header, jwt_data):
         user_token_service = container.get(UserTokenService)
 
-        jti = jwt_data["jti"]
-        type = jwt_data["type"]
-
-        user_token = None
-        if type == "access":
-            user_token = user_token_service.getByAccessJti(jti)
-        elif type == "refresh":
-            user_token = user_token_service.getByRefreshJti(jti)
-
-        # The user token is revoked if there is no user token
-        return user_token is None
+        return user_token_service.is_revoked(jwt_data["jti"], jwt_data["type"], jwt_data["exp"])
 
     return app
 
 
 if __name__ == "__main__":
+    from waitress import serve
+
     app = create_app()
-    app.run()
+    server = app.config["SERVER"]
+    threads = max(1, int(server.get("threads", 48)))
+
+    # Open panel streams each hold a thread, so there must be threads left for other requests
+    max_streams = get_container().get(HomeAssistantHubService).get_max_streams()
+
+    if threads <= max_streams:
+        print(
+            f"server threads ({threads}) should be more than home_assistant_hub max_streams ({max_streams})")
+
+    serve(app, host=server.get("host", "0.0.0.0"),
+          port=int(server.get("port", 8000)), threads=threads)
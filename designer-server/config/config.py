@@ -9,9 +9,79 @@ class DataFileConfig:
     dashboards_data_file: str
 
 
+@dataclass(frozen=True)
+class DataStoreConfig:
+    engine: str
+    write_mode: str
+    durability: str
+    commit_interval_ms: int
+    sqlite_data_file: str
+    sqlite_busy_timeout_ms: int
+
+
+@dataclass(frozen=True)
+class TokenCacheConfig:
+    max_entries: int
+    ttl_secs: int
+
+
+@dataclass(frozen=True)
+class PasswordHashingConfig:
+    executor: str
+    max_workers: int
+    max_queue: int
+
+
+@dataclass(frozen=True)
+class ComponentCacheConfig:
+    max_bytes: int
+    minify: bool
+
+
+@dataclass(frozen=True)
+class HomeAssistantHubConfig:
+    enabled: bool
+    reconnect_min_secs: float
+    reconnect_max_secs: float
+    client_queue_size: int
+    keepalive_secs: int
+    history_size: int
+    service_call_timeout_secs: float
+    coalesce_window_ms: int
+    min_interval_secs: dict[str, float]
+    max_streams: int
+    allowed_services: list[str]
+
+
+@dataclass(frozen=True)
+class EntityHistoryConfig:
+    enabled: bool
+    hours: float
+    samples_per_entity: int
+    max_bytes: int
+
+
+@dataclass(frozen=True)
+class ServerConfig:
+    host: str
+    port: int
+    threads: int
+
+
 @dataclass(frozen=True)
 class AppConfig:
     lock_file: str
     jwt_key: str
     jwt_refresh_token_expiry_mins: int
+    token_sweep_interval_mins: int
+    stateless_auth: bool
     data_files: DataFileConfig
+    data_store: DataStoreConfig
+    token_cache: TokenCacheConfig
+    password_hashing: PasswordHashingConfig
+    component_cache: ComponentCacheConfig
+    home_assistant_url: str
+    home_assistant_token: str
+    home_assistant_hub: HomeAssistantHubConfig
+    entity_history: EntityHistoryConfig
+    server: ServerConfig
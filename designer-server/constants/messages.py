@@ -1,9 +1,21 @@
 SERVER_ERROR_OCCURRED = "server error occurred"
 
+SERVER_BUSY = "server is busy, try again shortly"
+
 INVALID_USER_NAME_OR_PASSWORD = "invalid user name or password"
 
 USER_ALREADY_EXISTS = "user already exists"
 
+DASHBOARD_NOT_FOUND = "dashboard not found"
+DASHBOARD_VERSION_CONFLICT = "dashboard has been changed, reload it and try again"
+INVALID_DASHBOARD = "a dashboard needs a name and a layout object"
+INVALID_DASHBOARD_PATCH = "'patch' must be a list of JSON patch operations"
+INVALID_REQUEST_BODY = "request body must be a JSON object"
+
+HOME_ASSISTANT_UNAVAILABLE = "home assistant is not connected"
+HOME_ASSISTANT_TIMEOUT = "home assistant did not respond in time"
+HOME_ASSISTANT_SERVICE_NOT_ALLOWED = "home assistant service is not allowed"
+
 ACCESS_TOKEN_EXPIRED = "access token has expired"
 ACCESS_TOKEN_INVALID = "access token is invalid"
 ACCESS_TOKEN_REVOKED = "user token revoked"
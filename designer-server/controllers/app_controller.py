@@ -1,31 +1,85 @@
 import atexit
-import os
-from time import sleep
+from time import perf_counter
 import threading
-import re
 
-from flask import Blueprint, jsonify, current_app, Response, request, abort
-from flask_jwt_extended import jwt_required
+from flask import Blueprint, jsonify, current_app, request, abort
+from flask_jwt_extended import current_user, jwt_required
 
+from constants.user_security_roles import SECURITY_ROLE_ADMIN
+from services.component_service import MAX_BUNDLE_COMPONENTS, ComponentService
 from services.configuration_service import ConfigurationService
 from services.container_registry import get_container
+from services.dashboard_index_service import DashboardIndexService
+from services.data_service import DataService
+from services.entity_history_service import EntityHistoryService
+from services.home_assistant_hub_service import HomeAssistantHubService
+from services.index_page_service import IndexPageService
+from services.password_hasher_service import PasswordHasherService
+from services.token_cache_service import TokenCacheService
+from services.user_token_service import UserTokenService
+from services.user_view_cache_service import UserViewCacheService
 from services.user_service import ForbiddenException
 
 app_bp = Blueprint("app", __name__)
 
-# This controls the background task running state
-background_tasks_thread_event = threading.Event()
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Set to stop the background task, the task waits on it between runs so it stops straight away
+background_tasks_stop_event = threading.Event()
+background_tasks_thread: threading.Thread | None = None
+
+# Results of the expired token sweeps run by the background task
+token_sweep_stats_lock = threading.Lock()
+token_sweep_stats = {
+    "sweeps": 0,
+    "removed": 0,
+    "lastRemoved": 0,
+    "lastSweepSecs": 0.0,
+    "maxSweepSecs": 0.0
+}
+
+
+def sweep_expired_tokens():
+    container = get_container()
+    user_token_service: UserTokenService = container.get(UserTokenService)
+
+    start = perf_counter()
+    removed = user_token_service.remove_expired()
+    sweep_secs = perf_counter() - start
+
+    with token_sweep_stats_lock:
+        token_sweep_stats["sweeps"] += 1
+        token_sweep_stats["removed"] += removed
+        token_sweep_stats["lastRemoved"] = removed
+        token_sweep_stats["lastSweepSecs"] = sweep_secs
+        token_sweep_stats["maxSweepSecs"] = max(
+            token_sweep_stats["maxSweepSecs"], sweep_secs)
+
+    if removed > 0:
+        print(
+            f"Removed {removed} expired user tokens in {sweep_secs * 1000:.1f} ms")
 
 
 def background_task():
-    while background_tasks_thread_event.is_set():
-        print("Background task tick...")
-        sleep(5)
+    container = get_container()
+    config_service: ConfigurationService = container.get(ConfigurationService)
+
+    interval_secs = max(1.0, float(config_service.get(
+        "token_sweep_interval_mins", 5)) * 60)
+
+    # Sweep straight away to clear tokens that expired while the server was stopped
+    while not background_tasks_stop_event.is_set():
+        try:
+            sweep_expired_tokens()
+        except Exception as error:
+            print(str(error))
+
+        background_tasks_stop_event.wait(interval_secs)
 
 
 def stop_background_task():
     try:
-        background_tasks_thread_event.clear()
+        background_tasks_stop_event.set()
 
         print("Background task stopped!")
     except Exception as error:
@@ -33,13 +87,21 @@ def stop_background_task():
 
 
 def start_background_task():
+    global background_tasks_thread
+
     try:
+        # Already running
+        if background_tasks_thread is not None and background_tasks_thread.is_alive():
+            return None
+
         atexit.register(stop_background_task)
 
-        background_tasks_thread_event.set()
+        background_tasks_stop_event.clear()
 
-        thread = threading.Thread(target=background_task)
-        thread.start()
+        # Daemon thread so it never holds up the process exiting
+        background_tasks_thread = threading.Thread(
+            target=background_task, name="background-task", daemon=True)
+        background_tasks_thread.start()
 
         return None
     except Exception as error:
@@ -51,89 +113,76 @@ def start_background_task():
 @app_bp.get('/dashboard/', defaults={'path': ''})
 @app_bp.get('/dashboard/<path:path>')
 def index(path: str | None = None):
-    # Get the host and port from the request
-    host = request.host  # e.g., '127.0.0.1:5000'
+    container = get_container()
+    index_page_service: IndexPageService = container.get(IndexPageService)
 
     # Path to the static index.html file
     index_path = current_app.static_folder + '/index.html'
 
-    if not os.path.exists(index_path):
+    # Page with the API base URL for the host and port from the request (e.g., '127.0.0.1:5000')
+    page = index_page_service.get(index_path, request.host)
+
+    if page is None:
         return "index.html not found", 404
 
-    # Read file index.html content
-    with open(index_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+    # Returns 304 if the browser already has this page
+    return page.send(request)
 
-    # Replace API base URL
-    content = re.sub(
-        r'(<input\s+[^>]*id="api-base-url"[^>]*value=")[^"]*(")',
-        fr'\1http://{host}\2',
-        content
-    )
 
-    # Replace WebSocket base URL
+@app_bp.get("/components/<path:sub_path>")
+def components(sub_path: str):
     container = get_container()
-    config_service: ConfigurationService = container.get(ConfigurationService)
-    home_assistant_url = config_service.get(
-        "home_assistant_url", "http://homeassistant.local:8123")
+    component_service: ComponentService = container.get(ComponentService)
 
-    content = re.sub(
-        r'(<input\s+[^>]*id="ws-base-url"[^>]*value=")[^"]*(")',
-        fr'\1{home_assistant_url}\2',
-        content
-    )
+    component = component_service.get(current_app.static_folder, sub_path)
 
-    # Return modified HTML content
-    return Response(content, mimetype='text/html')
+    if component is None:
+        abort(404, f"Invalid component '{sub_path}'")
 
+    # Versioned URLs never change so browsers can keep them, otherwise they revalidate with the
+    # ETag. An out of date version gets the current content, which mustn't be kept.
+    if request.args.get("v") == ComponentService.get_version(component):
+        cache_control = IMMUTABLE_CACHE_CONTROL
+    else:
+        cache_control = "no-cache"
 
-@app_bp.get("/components/<path:sub_path>")
-def components(sub_path: str):
-    # Component base directory
-    base_dir = os.path.normpath(os.path.join(
-        current_app.static_folder, "components"))
+    # Serve file as JS
+    return component.send(request, cache_control)
 
-    # Normalize full path
-    component_file_path = os.path.normpath(
-        os.path.join(base_dir, f'{sub_path}.js'))
 
-    load_default_wc = False
+@app_bp.get("/component-bundle")
+def component_bundle():
+    container = get_container()
+    component_service: ComponentService = container.get(ComponentService)
 
-    # Prevent path traversal
-    if not component_file_path.startswith(base_dir):
-        abort(404, f"Invalid component file '{component_file_path}'")
+    # Comma separated component names, e.g. ?names=clock,gauge
+    names = [name.strip()
+             for name in request.args.get("names", "").split(",") if len(name.strip()) > 0]
 
-    # Default to fallback if file doesn't exist
-    if not os.path.exists(component_file_path):
-        load_default_wc = True
-        component_file_path = os.path.normpath(
-            os.path.join(base_dir, "default-web-component.js"))
+    if len(names) == 0 or len(names) > MAX_BUNDLE_COMPONENTS:
+        abort(400, f"Between 1 and {MAX_BUNDLE_COMPONENTS} component names must be provided")
 
-    # Default to fallback if file doesn't exist
-    if not os.path.exists(component_file_path):
-        abort(404, f"Invalid component file '{component_file_path}'")
+    bundle = component_service.get_bundle(current_app.static_folder, names)
 
-    # Serve file as JS
-    with open(component_file_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+    # The UI adds the manifest version (from index.html) so the bundle changes URL whenever any
+    # component changes
+    manifest = component_service.get_manifest(current_app.static_folder)
 
-    # Convert to PascalCase for the class name
-    def to_pascal_case(s: str) -> str:
-        return ''.join(word.capitalize() for word in re.split(r"[\W_]+", s))
+    if request.args.get("v") == manifest["version"]:
+        cache_control = IMMUTABLE_CACHE_CONTROL
+    else:
+        cache_control = "no-cache"
 
-    # Convert to kebab-case for the element name
-    def to_kebab_case(s: str) -> str:
-        return re.sub(r'[_\s]+', '-', re.sub(r'([a-z])([A-Z])', r'\1-\2', s)).lower()
+    # One module that defines (or imports) every requested component
+    return bundle.send(request, cache_control)
 
-    if load_default_wc:
-        class_name = f"Cwc{to_pascal_case(sub_path)}"
-        element_name = f"cwc-{to_kebab_case(sub_path)}"
 
-        content = re.sub(r"\bCwcDefaultWebComponent\b", class_name, content)
-        content = re.sub(r"\bcwc-default-web-component\b",
-                         element_name, content)
+@app_bp.get("/component-manifest")
+def component_manifest():
+    container = get_container()
+    component_service: ComponentService = container.get(ComponentService)
 
-    return Response(content, mimetype='application/javascript')
+    return jsonify(component_service.get_manifest(current_app.static_folder)), 200
 
 
 @app_bp.get("/start")
@@ -163,3 +212,43 @@ def stop_app():
 @app_bp.get("/ping")
 def ping():
     return jsonify({"ping": "pong"}), 200
+
+
+@app_bp.get("/metrics")
+@jwt_required()
+def metrics():
+    # Only admin users can view server metrics
+    if current_user is None or current_user["roles"] is None or SECURITY_ROLE_ADMIN not in current_user["roles"]:
+        return jsonify({"message": "you are not permitted"}), 403
+
+    container = get_container()
+    data_service: DataService = container.get(DataService)
+    token_cache_service: TokenCacheService = container.get(TokenCacheService)
+    user_view_cache_service: UserViewCacheService = container.get(
+        UserViewCacheService)
+    password_hasher_service: PasswordHasherService = container.get(
+        PasswordHasherService)
+    index_page_service: IndexPageService = container.get(IndexPageService)
+    component_service: ComponentService = container.get(ComponentService)
+    dashboard_index_service: DashboardIndexService = container.get(
+        DashboardIndexService)
+    home_assistant_hub_service: HomeAssistantHubService = container.get(
+        HomeAssistantHubService)
+    entity_history_service: EntityHistoryService = container.get(
+        EntityHistoryService)
+
+    with token_sweep_stats_lock:
+        token_sweep = dict(token_sweep_stats)
+
+    return jsonify({
+        "dataLock": data_service.get_lock_stats(),
+        "tokenCache": token_cache_service.get_stats(),
+        "userViewCache": user_view_cache_service.get_stats(),
+        "passwordHashing": password_hasher_service.get_stats(),
+        "tokenSweep": token_sweep,
+        "indexPage": index_page_service.get_stats(),
+        "components": component_service.get_stats(),
+        "dashboardIndex": dashboard_index_service.get_stats(),
+        "homeAssistantHub": home_assistant_hub_service.get_stats(),
+        "entityHistory": entity_history_service.get_stats()
+    }), 200
@@ -2,16 +2,17 @@
 
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import get_jwt, get_jwt_identity, jwt_required, current_user
-from services.configuration_service import ConfigurationService
 from services.container_registry import get_container
 
 from constants.messages import (
     ACCESS_TOKEN_INVALID,
     INVALID_USER_NAME_OR_PASSWORD,
+    SERVER_BUSY,
     SERVER_ERROR_OCCURRED,
     USER_ALREADY_EXISTS,
     ACCESS_TOKEN_REVOKED,
 )
+from exceptions.capacity_exceptions import ServerBusyException
 from services.user_token_service import UserTokenService
 from services.user_service import (
     InvalidCredentialsException,
@@ -22,16 +23,6 @@ from services.user_service import (
 auth_bp = Blueprint("auth", __name__)
 
 
-@auth_bp.get("/long-lived-token")
-def get_long_lived_token():
-    container = get_container()
-    config_service: ConfigurationService = container.get(ConfigurationService)
-
-    return jsonify({
-        "token": config_service["home_assistant_token"]
-    })
-
-
 @auth_bp.post("/register")
 def register_user():
     try:
@@ -55,6 +46,9 @@ def register_user():
         return jsonify({"message": USER_ALREADY_EXISTS}), 409  # Conflict
     except InvalidCredentialsException as ex:
         return jsonify({"message": str(ex)}), 400  # Bad request
+    except ServerBusyException:
+        # Too many requests, password hashing queue is full
+        return jsonify({"message": SERVER_BUSY}), 429, {"Retry-After": "1"}
     except Exception as ex:
         # Print exception for debugging use
         print(ex)
@@ -89,15 +83,8 @@ def login_user():
         user_name = user_name.strip()
         password = password.strip()
 
-        # Locate user by user_name
-        user = user_service.get_user(user_name)
-
-        if user is None:
-            # A matching user_name was not found in the database
-            return jsonify({"message": INVALID_USER_NAME_OR_PASSWORD}), 401
-
         try:
-            # Login user
+            # Login user (an unknown user name is reported as invalid credentials)
             token = user_service.login_user(user_name, password)
 
             # Return token to caller
@@ -105,6 +92,9 @@ def login_user():
         except InvalidCredentialsException as ex:
             return jsonify({"message": str(ex)}), 401  # Unauthorized
 
+    except ServerBusyException:
+        # Too many requests, password hashing queue is full
+        return jsonify({"message": SERVER_BUSY}), 429, {"Retry-After": "1"}
     except Exception as ex:
         # Print exception for debugging use
         print(ex)
@@ -135,7 +125,7 @@ def refresh_token():
 
     jwt = get_jwt()
 
-    access_token = user_token_service.refresh(jwt["jti"])
+    access_token = user_token_service.refresh(jwt["jti"], jwt["sub"])
 
     if access_token is None:
         # If the user had a valid refresh token but they have no access token entry in the DB
@@ -1,30 +1,258 @@
-from dataclasses import asdict
-from flask import Blueprint, jsonify
+from typing import Optional
+from flask import Blueprint, Response, jsonify, request
 from flask_jwt_extended import jwt_required
+from constants.messages import DASHBOARD_NOT_FOUND, INVALID_REQUEST_BODY
+from exceptions.dashboard_exceptions import (
+    DashboardNotFoundException,
+    DashboardVersionConflictException,
+    InvalidDashboardException,
+)
+from exceptions.json_patch_exceptions import JsonPatchException
 from services.container_registry import get_container
+from services.dashboard_index_service import TOKEN_KINDS
+from services.dashboard_service import DashboardService
+from services.http_cache import if_none_match
 
-from services.user_service import ForbiddenException, UserService
+from services.user_service import ForbiddenException
 
 dashboard_bp = Blueprint('dashboards', __name__)
 
+# Most dashboards a search returns
+MAX_SEARCH_RESULTS = 200
+
+
+def dashboard_etag(dashboard_id: int, version: int) -> str:
+    # The version changes on every update so is all the ETag needs
+    return f'"{dashboard_id}-{version}"'
+
+
+def expected_version(dashboard_id: int) -> Optional[int]:
+    # An If-Match header makes the update conditional on the dashboard being unchanged
+    header = request.headers.get("If-Match")
+
+    if header is None:
+        return None
+
+    prefix = f'"{dashboard_id}-'
+    etag = header.strip()
+
+    if etag.startswith(prefix) and etag.endswith('"') and etag[len(prefix):-1].isdigit():
+        return int(etag[len(prefix):-1])
+
+    # Doesn't match any version this dashboard has had
+    return -1
+
+
+def request_object() -> Optional[dict]:
+    # The JSON body when it is an object, None for anything else (missing, invalid, a list...)
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else None
+
+
+def dashboard_json(dashboard: dict) -> dict:
+    # Record IDs are larger than the integers JavaScript numbers hold exactly, so the browser
+    # gets them as strings
+    return {**dashboard, "id": str(dashboard["id"])}
+
+
+def dashboard_response(dashboard: dict, status: int) -> Response:
+    response = jsonify({"dashboard": dashboard_json(dashboard)})
+    response.status_code = status
+    response.headers["ETag"] = dashboard_etag(
+        dashboard["id"], dashboard["version"])
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
 
 @dashboard_bp.get('/all')
 @jwt_required()
 def get_all_dashboards():
     container = get_container()
-    user_service: UserService = container.get(UserService)
+    dashboard_service: DashboardService = container.get(DashboardService)
+
+    # Just the ID, name and version of each dashboard
+    dashboards = dashboard_service.get_all_dashboards()
+
+    return jsonify({
+        "dashboards": [dashboard_json(dashboard) for dashboard in dashboards]
+    }), 200
+
+
+@dashboard_bp.get('/search')
+@jwt_required()
+def search_dashboards():
+    container = get_container()
+    dashboard_service: DashboardService = container.get(DashboardService)
+
+    # e.g. ?q=cwc-date or ?q=kitchen&kind=name, every term must prefix match a token
+    query = request.args.get("q", "")
+    kind = request.args.get("kind")
+    limit = request.args.get("limit", MAX_SEARCH_RESULTS, type=int)
+
+    if kind is not None and kind not in TOKEN_KINDS:
+        return jsonify({
+            "message": f"kind must be one of {', '.join(TOKEN_KINDS)}"
+        }), 400
+
+    if limit < 1 or limit > MAX_SEARCH_RESULTS:
+        return jsonify({
+            "message": f"limit must be between 1 and {MAX_SEARCH_RESULTS}"
+        }), 400
+
+    dashboards = dashboard_service.search_dashboards(
+        query, TOKEN_KINDS if kind is None else [kind], limit)
+
+    return jsonify({
+        "dashboards": [dashboard_json(dashboard) for dashboard in dashboards]
+    }), 200
+
+
+@dashboard_bp.get('/<int:dashboard_id>')
+@jwt_required()
+def get_dashboard(dashboard_id: int):
+    container = get_container()
+    dashboard_service: DashboardService = container.get(DashboardService)
+
+    # Panels poll for layout changes, so check the version before loading the layout
+    version = dashboard_service.get_dashboard_version(dashboard_id)
+
+    if version is None:
+        return jsonify({"message": DASHBOARD_NOT_FOUND}), 404
+
+    etag = dashboard_etag(dashboard_id, version)
+
+    if if_none_match(request, etag):
+        return Response(status=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+    dashboard = dashboard_service.get_dashboard(dashboard_id)
+
+    if dashboard is None:
+        return jsonify({"message": DASHBOARD_NOT_FOUND}), 404
+
+    return dashboard_response(dashboard, 200)
+
+
+@dashboard_bp.post('')
+@jwt_required()
+def create_dashboard():
+    container = get_container()
+    dashboard_service: DashboardService = container.get(DashboardService)
+
+    try:
+        data = request_object()
+
+        if data is None:
+            return jsonify({"message": INVALID_REQUEST_BODY}), 400  # Bad request
+
+        dashboard = dashboard_service.create_dashboard(
+            data.get("name"), data.get("layout"))
+
+        return dashboard_response(dashboard, 201)
+    except InvalidDashboardException as ex:
+        return jsonify({"message": str(ex)}), 400  # Bad request
+    except ForbiddenException:
+        return jsonify({
+            "message": "you are not permitted"
+        }), 403
+
+
+@dashboard_bp.put('/<int:dashboard_id>')
+@jwt_required()
+def update_dashboard(dashboard_id: int):
+    container = get_container()
+    dashboard_service: DashboardService = container.get(DashboardService)
 
     try:
-        # Get all users including their roles
-        users = user_service.get_all_users(include_roles=True)
+        data = request_object()
+
+        if data is None:
+            return jsonify({"message": INVALID_REQUEST_BODY}), 400  # Bad request
 
-        # Convert to serializable dictionary versions
-        # serializable_users = list(map(lambda u: asdict(u), users))
+        dashboard = dashboard_service.update_dashboard(
+            dashboard_id, data.get("name"), data.get("layout"), expected_version(dashboard_id))
 
-        # Return JSON response with user list
+        return dashboard_response(dashboard, 200)
+    except InvalidDashboardException as ex:
+        return jsonify({"message": str(ex)}), 400  # Bad request
+    except DashboardNotFoundException as ex:
+        return jsonify({"message": str(ex)}), 404  # Not found
+    except DashboardVersionConflictException as ex:
+        return jsonify({"message": str(ex)}), 412  # Precondition failed
+    except ForbiddenException:
         return jsonify({
-            "users": users
-        }), 200
+            "message": "you are not permitted"
+        }), 403
+
+
+@dashboard_bp.patch('/<int:dashboard_id>')
+@jwt_required()
+def patch_dashboard(dashboard_id: int):
+    container = get_container()
+    dashboard_service: DashboardService = container.get(DashboardService)
+
+    try:
+        # e.g. {"baseVersion": 3, "patch": [{"op": "replace", "path": "/layout/title", "value": "Lounge"}]}
+        data = request_object()
+
+        if data is None:
+            return jsonify({"message": INVALID_REQUEST_BODY}), 400  # Bad request
+
+        dashboard = dashboard_service.patch_dashboard(
+            dashboard_id, data.get("baseVersion"), data.get("patch"))
+
+        # The editor already has the rest of the dashboard
+        response = jsonify({"version": dashboard["version"]})
+        response.headers["ETag"] = dashboard_etag(
+            dashboard_id, dashboard["version"])
+        return response, 200
+    except (InvalidDashboardException, JsonPatchException) as ex:
+        return jsonify({"message": str(ex)}), 400  # Bad request
+    except DashboardNotFoundException as ex:
+        return jsonify({"message": str(ex)}), 404  # Not found
+    except DashboardVersionConflictException as ex:
+        return jsonify({"message": str(ex)}), 409  # Conflict
+    except ForbiddenException:
+        return jsonify({
+            "message": "you are not permitted"
+        }), 403
+
+
+@dashboard_bp.get('/<int:dashboard_id>/changes')
+@jwt_required()
+def get_dashboard_changes(dashboard_id: int):
+    container = get_container()
+    dashboard_service: DashboardService = container.get(DashboardService)
+
+    since = request.args.get("since", type=int)
+
+    if since is None:
+        return jsonify({"message": "'since' must be a dashboard version"}), 400
+
+    try:
+        version, changes = dashboard_service.get_dashboard_changes(
+            dashboard_id, since)
+    except DashboardNotFoundException as ex:
+        return jsonify({"message": str(ex)}), 404  # Not found
+
+    if changes is None:
+        # Not all the changes are known, the editor needs to reload the dashboard
+        return jsonify({"version": version, "reset": True}), 200
+
+    return jsonify({"version": version, "changes": changes}), 200
+
+
+@dashboard_bp.delete('/<int:dashboard_id>')
+@jwt_required()
+def delete_dashboard(dashboard_id: int):
+    container = get_container()
+    dashboard_service: DashboardService = container.get(DashboardService)
+
+    try:
+        dashboard_service.delete_dashboard(dashboard_id)
+
+        return jsonify({"message": "dashboard deleted"}), 200
+    except DashboardNotFoundException as ex:
+        return jsonify({"message": str(ex)}), 404  # Not found
     except ForbiddenException:
         return jsonify({
             "message": "you are not permitted"
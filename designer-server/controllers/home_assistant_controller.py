@@ -0,0 +1,147 @@
+from time import time
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from flask_jwt_extended import get_jwt, jwt_required
+from constants.messages import SERVER_BUSY
+from exceptions.capacity_exceptions import ServerBusyException
+from exceptions.dashboard_exceptions import DashboardNotFoundException
+from exceptions.home_assistant_exceptions import (
+    HomeAssistantServiceCallException,
+    HomeAssistantServiceNotAllowedException,
+    HomeAssistantTimeoutException,
+    HomeAssistantUnavailableException,
+)
+from services.container_registry import get_container
+from services.entity_history_service import EntityHistoryService
+from services.home_assistant_hub_service import HomeAssistantHubService
+
+home_assistant_bp = Blueprint('home_assistant', __name__)
+
+# The most samples a history request returns, more are averaged down to this
+MAX_HISTORY_POINTS = 2000
+
+
+@home_assistant_bp.get('/stream')
+@jwt_required()
+def stream_entities():
+    container = get_container()
+    hub_service: HomeAssistantHubService = container.get(
+        HomeAssistantHubService)
+
+    if not hub_service.is_enabled():
+        return jsonify({"message": "home assistant hub is not enabled"}), 404
+
+    # The stream ends when the access token expires, the panel reconnects with a refreshed one
+    token_expiry = get_jwt()["exp"]
+
+    # A panel showing a dashboard only needs the entities the dashboard uses
+    dashboard_id = request.args.get("dashboard", type=int)
+
+    # A panel reconnecting sends the ID of the last event it had, so it only gets what it missed
+    last_event_id = request.headers.get(
+        "Last-Event-ID") or request.args.get("lastEventId")
+
+    try:
+        client = hub_service.subscribe(dashboard_id, last_event_id)
+    except DashboardNotFoundException as ex:
+        return jsonify({"message": str(ex)}), 404  # Not found
+    except ServerBusyException:
+        # Too many open streams, the panel tries again later
+        return jsonify({"message": SERVER_BUSY}), 503, {"Retry-After": "10"}
+
+    keepalive_secs = hub_service.get_keepalive_secs()
+
+    def generate():
+        # Server sent events: a snapshot of the entities, then deltas with just what changed
+        try:
+            while not client.is_closed() and time() < token_expiry:
+                events = hub_service.take(client, min(
+                    keepalive_secs, max(0.0, token_expiry - time())))
+
+                if len(events) == 0:
+                    # A comment line so proxies don't close an idle stream
+                    yield ": keepalive\n\n"
+                else:
+                    yield "".join(events)
+        finally:
+            hub_service.unsubscribe(client)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # Stop nginx buffering the stream
+        "X-Accel-Buffering": "no"
+    })
+
+
+@home_assistant_bp.get('/states')
+@jwt_required()
+def get_states():
+    container = get_container()
+    hub_service: HomeAssistantHubService = container.get(
+        HomeAssistantHubService)
+
+    return jsonify({
+        "entities": hub_service.get_entities()
+    }), 200
+
+
+@home_assistant_bp.get('/history/<entity_id>')
+@jwt_required()
+def get_history(entity_id: str):
+    container = get_container()
+    history_service: EntityHistoryService = container.get(
+        EntityHistoryService)
+
+    if not history_service.is_enabled():
+        return jsonify({"message": "entity history is not enabled"}), 404
+
+    # e.g. GET /home-assistant/history/sensor.power?hours=6&points=120
+    hours = request.args.get("hours", type=float)
+    points = min(MAX_HISTORY_POINTS, max(
+        0, request.args.get("points", MAX_HISTORY_POINTS, type=int)))
+
+    history = history_service.get_history(entity_id, hours, points)
+
+    if history is None:
+        return jsonify({"message": f"no history for entity '{entity_id}'"}), 404
+
+    times, values = history
+
+    if request.args.get("format") == "binary":
+        # uint32 count, float64 timestamps, float32 values, all little endian
+        return Response(EntityHistoryService.to_binary(times, values), mimetype="application/octet-stream", headers={
+            "Cache-Control": "no-cache"
+        })
+
+    # Columnar, timestamps in epoch seconds, values to float32 precision
+    return jsonify({
+        "entityId": entity_id,
+        "t": [round(t, 3) for t in times],
+        "v": [float(f"{v:.7g}") for v in values]
+    }), 200
+
+
+@home_assistant_bp.post('/services/<domain>/<service_name>')
+@jwt_required()
+def call_service(domain: str, service_name: str):
+    container = get_container()
+    hub_service: HomeAssistantHubService = container.get(
+        HomeAssistantHubService)
+
+    # e.g. POST /home-assistant/services/switch/turn_on {"entity_id": "switch.kitchen_light"}
+    service_data = request.get_json(silent=True) or {}
+
+    if not isinstance(service_data, dict):
+        return jsonify({"message": "service data must be an object"}), 400
+
+    try:
+        result = hub_service.call_service(domain, service_name, service_data)
+
+        return jsonify({"result": result}), 200
+    except HomeAssistantServiceNotAllowedException as ex:
+        return jsonify({"message": str(ex)}), 403  # Forbidden
+    except HomeAssistantUnavailableException as ex:
+        return jsonify({"message": str(ex)}), 503  # Service unavailable
+    except HomeAssistantTimeoutException as ex:
+        return jsonify({"message": str(ex)}), 504  # Gateway timeout
+    except HomeAssistantServiceCallException as ex:
+        return jsonify({"message": str(ex)}), 502  # Bad gateway
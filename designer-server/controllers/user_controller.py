@@ -1,5 +1,6 @@
+import json
 from dataclasses import asdict
-from flask import Blueprint, jsonify
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 from flask_jwt_extended import jwt_required
 from services.container_registry import get_container
 
@@ -7,6 +8,9 @@ from services.user_service import ForbiddenException, UserService
 
 user_bp = Blueprint('users', __name__)
 
+# Largest page of users that can be requested
+MAX_USERS_PAGE_SIZE = 1000
+
 
 @user_bp.get('/all')
 @jwt_required()
@@ -15,6 +19,41 @@ def get_all_users():
     user_service: UserService = container.get(UserService)
 
     try:
+        # Optional paging, e.g. ?limit=100&after=<id of the last user in the previous page>
+        limit = request.args.get("limit", type=int)
+        after = request.args.get("after", type=int)
+
+        if request.args.get("stream", "").lower() in ["1", "true"]:
+            users_iterator = user_service.iter_all_users(include_roles=True)
+
+            def generate():
+                # Users are written as they are read so memory use doesn't grow with the user count
+                yield '{"users":['
+
+                for i, user in enumerate(users_iterator):
+                    yield ("," if i > 0 else "") + json.dumps(user)
+
+                yield ']}'
+
+            return Response(stream_with_context(generate()), mimetype="application/json"), 200
+
+        if limit is not None:
+            if limit < 1 or limit > MAX_USERS_PAGE_SIZE:
+                return jsonify({
+                    "message": f"limit must be between 1 and {MAX_USERS_PAGE_SIZE}"
+                }), 400
+
+            users = user_service.get_users_page(
+                include_roles=True, limit=limit, after=after)
+
+            # The cursor for the next page, none when this is the last page
+            next_after = users[-1]["id"] if len(users) == limit else None
+
+            return jsonify({
+                "users": users,
+                "next": next_after
+            }), 200
+
         # Get all users including their roles
         users = user_service.get_all_users(include_roles=True)
 
@@ -0,0 +1,10 @@
+class DashboardNotFoundException(Exception):
+    pass
+
+
+class DashboardVersionConflictException(Exception):
+    pass
+
+
+class InvalidDashboardException(Exception):
+    pass
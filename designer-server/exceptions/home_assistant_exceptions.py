@@ -0,0 +1,14 @@
+class HomeAssistantUnavailableException(Exception):
+    pass
+
+
+class HomeAssistantTimeoutException(Exception):
+    pass
+
+
+class HomeAssistantServiceCallException(Exception):
+    pass
+
+
+class HomeAssistantServiceNotAllowedException(Exception):
+    pass
@@ -0,0 +1,2 @@
+class JsonPatchException(Exception):
+    pass
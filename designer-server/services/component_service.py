@@ -0,0 +1,368 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Annotated, Optional
+from urllib.parse import quote
+from wireup import Inject, service
+from config.config import ComponentCacheConfig
+from services.base import BaseService
+from services.http_cache import ENCODING_IDENTITY, CachedContent
+
+try:
+    import rjsmin
+except ImportError:
+    # Components are served as they are when the minifier isn't installed
+    rjsmin = None
+
+DEFAULT_COMPONENT_NAME = "default-web-component"
+
+# A bundle can't load more components than this
+MAX_BUNDLE_COMPONENTS = 200
+
+# Bundles kept for this many different sets of component names
+_MAX_BUNDLES = 64
+
+# Scripts with static imports or exports have to stay modules of their own, dynamic import()
+# and import.meta are fine inside a block
+_MODULE_SYNTAX_PATTERN = re.compile(
+    r"^\s*(?:import\s*[\w{*'\"]|export\b)", re.MULTILINE)
+
+# Cached components are checked against their source file at most this often
+_REVALIDATE_INTERVAL_SECS = 1.0
+
+
+# Convert to PascalCase for the class name
+def to_pascal_case(s: str) -> str:
+    return ''.join(word.capitalize() for word in re.split(r"[\W_]+", s))
+
+
+# Convert to kebab-case for the element name
+def to_kebab_case(s: str) -> str:
+    return re.sub(r'[_\s]+', '-', re.sub(r'([a-z])([A-Z])', r'\1-\2', s)).lower()
+
+
+class _CachedComponent:
+    __slots__ = ("source_path", "signature", "content", "checked_at")
+
+    def __init__(self, source_path: str, signature: tuple[int, int], content: CachedContent):
+        self.source_path = source_path
+        self.signature = signature
+        self.content = content
+        self.checked_at = monotonic()
+
+
+class _Manifest:
+    __slots__ = ("components", "version", "checked_at")
+
+    def __init__(self):
+        # Component name -> (source file signature, content version)
+        self.components: dict[str, tuple[tuple[int, int], str]] = {}
+        self.version = ""
+        self.checked_at = 0.0
+
+
+def _stat_signature(file_path: str) -> Optional[tuple[int, int]]:
+    try:
+        stat = os.stat(file_path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+@service
+class ComponentService(BaseService):
+    """
+    Serves web component scripts from the static components folder. Components that don't exist
+    are generated from the default web component, renamed for the requested name. The final
+    (minified) bytes and their compressed variants are kept in a size capped LRU cache keyed by
+    the requested name and checked against the source file's mtime.
+
+    The manifest maps each component in the folder to a hash of its content, so components can
+    be requested with versioned URLs that browsers cache without revalidating. Only the files
+    that changed since the last scan are processed again.
+    """
+
+    def __init__(self, component_cache: Annotated[ComponentCacheConfig, Inject(param="component_cache")]):
+        super().__init__()
+
+        self.__max_bytes = max(0, int(component_cache.get(
+            "max_bytes", 8 * 1024 * 1024)))
+        self.__minify = bool(component_cache.get(
+            "minify", True)) and rjsmin is not None
+
+        self.__lock = threading.Lock()
+        self.__components: OrderedDict[tuple[str, str], _CachedComponent] = OrderedDict()
+        self.__bytes = 0
+
+        # Static folder -> manifest of the components in it
+        self.__manifests: dict[str, _Manifest] = {}
+        self.__manifest_lock = threading.Lock()
+
+        # Sorted component names -> (ETags of the components, bundle)
+        self.__bundles: OrderedDict[tuple[str, tuple[str, ...]], tuple[tuple[str, ...], CachedContent]] = OrderedDict()
+
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__bundle_hits = 0
+        self.__bundle_misses = 0
+
+    @staticmethod
+    def resolve_path(static_folder: str, sub_path: str) -> Optional[str]:
+        # Component base directory
+        base_dir = os.path.normpath(os.path.join(static_folder, "components"))
+
+        # Normalize full path
+        component_file_path = os.path.normpath(
+            os.path.join(base_dir, f'{sub_path}.js'))
+
+        # Prevent path traversal
+        if not component_file_path.startswith(base_dir + os.sep):
+            return None
+
+        return component_file_path
+
+    @staticmethod
+    def __find_source(static_folder: str, sub_path: str) -> Optional[tuple[str, tuple[int, int], bool]]:
+        component_file_path = ComponentService.resolve_path(
+            static_folder, sub_path)
+
+        if component_file_path is None:
+            return None
+
+        signature = _stat_signature(component_file_path)
+
+        if signature is not None:
+            return (component_file_path, signature, False)
+
+        # Default to fallback if file doesn't exist
+        default_file_path = os.path.normpath(os.path.join(
+            static_folder, "components", f"{DEFAULT_COMPONENT_NAME}.js"))
+
+        signature = _stat_signature(default_file_path)
+
+        if signature is None:
+            return None
+
+        return (default_file_path, signature, True)
+
+    def __load(self, source_path: str, sub_path: str, load_default_wc: bool) -> CachedContent:
+        with open(source_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+
+        if load_default_wc:
+            class_name = f"Cwc{to_pascal_case(sub_path)}"
+            element_name = f"cwc-{to_kebab_case(sub_path)}"
+
+            content = re.sub(r"\bCwcDefaultWebComponent\b",
+                             class_name, content)
+            content = re.sub(r"\bcwc-default-web-component\b",
+                             element_name, content)
+
+        if self.__minify:
+            content = rjsmin.jsmin(content)
+
+        return CachedContent(content.encode("utf-8"), "application/javascript")
+
+    def __remove(self, key: tuple[str, str]) -> None:
+        component = self.__components.pop(key, None)
+
+        if component is not None:
+            self.__bytes -= component.content.size()
+
+    def get(self, static_folder: str, sub_path: str) -> Optional[CachedContent]:
+        key = (static_folder, sub_path)
+
+        with self.__lock:
+            component = self.__components.get(key)
+
+            # Recently checked against its source so no need to touch the disk
+            if component is not None and monotonic() - component.checked_at < _REVALIDATE_INTERVAL_SECS:
+                self.__components.move_to_end(key)
+                self.__hits += 1
+                return component.content
+
+        source = ComponentService.__find_source(static_folder, sub_path)
+
+        if source is None:
+            with self.__lock:
+                self.__remove(key)
+            return None
+
+        source_path, signature, load_default_wc = source
+
+        with self.__lock:
+            component = self.__components.get(key)
+
+            if component is not None and component.source_path == source_path and component.signature == signature:
+                component.checked_at = monotonic()
+                self.__components.move_to_end(key)
+                self.__hits += 1
+                return component.content
+
+            self.__misses += 1
+
+        content = self.__load(source_path, sub_path, load_default_wc)
+
+        with self.__lock:
+            self.__remove(key)
+
+            # Anything bigger than the whole cache is served but not kept
+            if content.size() > self.__max_bytes:
+                return content
+
+            self.__components[key] = _CachedComponent(
+                source_path, signature, content)
+            self.__bytes += content.size()
+
+            while self.__bytes > self.__max_bytes:
+                oldest_key = next(iter(self.__components))
+                self.__remove(oldest_key)
+                self.__evictions += 1
+
+        return content
+
+    @staticmethod
+    def get_version(content: CachedContent) -> str:
+        # Short form of the content hash, used in versioned component URLs
+        return content.etags[ENCODING_IDENTITY].strip('"')[:16]
+
+    def get_manifest(self, static_folder: str) -> dict:
+        with self.__manifest_lock:
+            manifest = self.__manifests.setdefault(static_folder, _Manifest())
+
+            if monotonic() - manifest.checked_at >= _REVALIDATE_INTERVAL_SECS:
+                self.__update_manifest(static_folder, manifest)
+
+            return {
+                "version": manifest.version,
+                "components": {name: version for name, (_, version) in manifest.components.items()}
+            }
+
+    def __update_manifest(self, static_folder: str, manifest: _Manifest) -> None:
+        base_dir = os.path.join(static_folder, "components")
+
+        signatures: dict[str, tuple[int, int]] = {}
+
+        try:
+            with os.scandir(base_dir) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.endswith(".js"):
+                        stat = entry.stat()
+                        signatures[entry.name[:-3]] = (
+                            stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            pass
+
+        changed = False
+
+        # Components that were removed
+        for name in list(manifest.components.keys()):
+            if name not in signatures:
+                del manifest.components[name]
+                changed = True
+
+        # Only new or changed files are loaded (and minified) again
+        for name, signature in signatures.items():
+            existing = manifest.components.get(name)
+
+            if existing is not None and existing[0] == signature:
+                continue
+
+            content = self.get(static_folder, name)
+
+            if content is None:
+                continue
+
+            manifest.components[name] = (
+                signature, ComponentService.get_version(content))
+            changed = True
+
+        if changed or manifest.checked_at == 0.0:
+            versions = json.dumps(
+                sorted((name, version) for name, (_, version) in manifest.components.items()))
+            manifest.version = hashlib.blake2b(
+                versions.encode("utf-8"), digest_size=8).hexdigest()
+
+            self.logger.info(
+                f"component manifest has {len(manifest.components)} components, version {manifest.version}")
+
+        manifest.checked_at = monotonic()
+
+    @staticmethod
+    def __build_bundle(components: list[tuple[str, Optional[CachedContent]]]) -> CachedContent:
+        parts = []
+
+        for name, content in components:
+            if content is None:
+                parts.append(
+                    f"console.error({json.dumps(f'component {name} not found')});\n")
+                continue
+
+            source = content.bodies[ENCODING_IDENTITY].decode("utf-8")
+
+            if _MODULE_SYNTAX_PATTERN.search(source):
+                # Loaded as its own module, the version makes it cacheable forever
+                version = ComponentService.get_version(content)
+                parts.append(
+                    f"import {json.dumps(f'/components/{quote(name)}?v={version}')};\n")
+            else:
+                # Each component gets its own block so their declarations don't clash, and a
+                # failing component doesn't stop the rest of the bundle
+                parts.append(
+                    f"// {name}\ntry {{\n{source}\n}} catch (e) {{\n  console.error(e);\n}}\n")
+
+        # Static imports are hoisted by the browser so their order doesn't matter
+        return CachedContent("".join(parts).encode("utf-8"), "application/javascript")
+
+    def get_bundle(self, static_folder: str, names: list[str]) -> CachedContent:
+        names_key = tuple(sorted(set(names)))
+        key = (static_folder, names_key)
+
+        # Same lookup (and default component fallback) as a single component
+        components = [(name, self.get(static_folder, name))
+                      for name in names_key]
+
+        etags = tuple(
+            content.etags[ENCODING_IDENTITY] if content is not None else ""
+            for _, content in components)
+
+        with self.__lock:
+            bundle = self.__bundles.get(key)
+
+            if bundle is not None and bundle[0] == etags:
+                self.__bundles.move_to_end(key)
+                self.__bundle_hits += 1
+                return bundle[1]
+
+            self.__bundle_misses += 1
+
+        content = ComponentService.__build_bundle(components)
+
+        with self.__lock:
+            self.__bundles[key] = (etags, content)
+            self.__bundles.move_to_end(key)
+
+            while len(self.__bundles) > _MAX_BUNDLES:
+                self.__bundles.popitem(last=False)
+
+        return content
+
+    def get_stats(self) -> dict:
+        with self.__lock:
+            return {
+                "entries": len(self.__components),
+                "bytes": self.__bytes,
+                "maxBytes": self.__max_bytes,
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "evictions": self.__evictions,
+                "bundles": len(self.__bundles),
+                "bundleHits": self.__bundle_hits,
+                "bundleMisses": self.__bundle_misses
+            }
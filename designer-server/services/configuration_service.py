@@ -1,17 +1,119 @@
+import os
+import threading
+from time import monotonic
+from types import MappingProxyType
+from typing import Any, Callable, Mapping, Optional
 from wireup import service
 from config.config_helper import load_yaml_config
 from services.base import BaseService
 
+CONFIG_FILE = "config/config.yaml"
+LOCAL_CONFIG_FILE = "config/config.local.yaml"
+
+# The config files are checked for changes at most this often
+CHECK_INTERVAL_SECS = 1.0
+
+
+def _freeze(value: Any) -> Any:
+    # Read only views all the way down so callers can't change the shared snapshot
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+
+    return value
+
+
+def _file_signature(file_name: str) -> Optional[tuple[int, int]]:
+    try:
+        stat = os.stat(file_name)
+    except FileNotFoundError:
+        return None
+
+    return (stat.st_mtime_ns, stat.st_size)
+
 
 @service
 class ConfigurationService(BaseService):
-    def __getitem__(self, key):
-        all_config = load_yaml_config(
-            "config/config.yaml", "config/config.local.yaml")
+    """
+    Holds the merged app configuration as an immutable snapshot. The files are parsed again only
+    when one of them changes, subscribers are then called with the new snapshot so they can
+    rebuild anything derived from it.
+
+    Values injected in to services when the container was created are not reloaded.
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.__lock = threading.Lock()
+        self.__subscribers: list[Callable[[Mapping[str, Any]], None]] = []
+
+        self.__signatures = self.__get_signatures()
+        self.__snapshot: Mapping[str, Any] = self.__load()
+        self.__next_check = monotonic() + CHECK_INTERVAL_SECS
+
+    @staticmethod
+    def __get_signatures() -> tuple[Optional[tuple[int, int]], ...]:
+        return (_file_signature(CONFIG_FILE), _file_signature(LOCAL_CONFIG_FILE))
 
-        return all_config["app"][key]
+    @staticmethod
+    def __load() -> Mapping[str, Any]:
+        all_config = load_yaml_config(CONFIG_FILE, LOCAL_CONFIG_FILE)
+        return _freeze(all_config["app"])
+
+    def __check_for_changes(self) -> None:
+        # Cheap check without the lock, most calls stop here
+        if monotonic() < self.__next_check:
+            return
+
+        with self.__lock:
+            if monotonic() < self.__next_check:
+                return
+
+            self.__next_check = monotonic() + CHECK_INTERVAL_SECS
+
+            signatures = self.__get_signatures()
+
+            if signatures == self.__signatures:
+                return
+
+            self.__signatures = signatures
+
+            try:
+                snapshot = self.__load()
+            except Exception as ex:
+                # Keep using the last good configuration until the file is fixed
+                self.logger.error(f"failed to reload configuration: {ex}")
+                return
+
+            self.__snapshot = snapshot
+            subscribers = list(self.__subscribers)
+
+        self.logger.info("configuration reloaded")
+
+        for subscriber in subscribers:
+            try:
+                subscriber(snapshot)
+            except Exception as ex:
+                self.logger.error(f"configuration subscriber failed: {ex}")
+
+    def subscribe(self, callback: Callable[[Mapping[str, Any]], None]) -> None:
+        with self.__lock:
+            self.__subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[Mapping[str, Any]], None]) -> None:
+        with self.__lock:
+            if callback in self.__subscribers:
+                self.__subscribers.remove(callback)
+
+    def get_snapshot(self) -> Mapping[str, Any]:
+        self.__check_for_changes()
+        return self.__snapshot
+
+    def __getitem__(self, key):
+        return self.get_snapshot()[key]
 
     def get(self, key, default=None):
-        all_config = load_yaml_config(
-            "config/config.yaml", "config/config.local.yaml")
-        return all_config["app"].get(key, default)
+        return self.get_snapshot().get(key, default)
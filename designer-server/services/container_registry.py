@@ -6,6 +6,15 @@ from services.user_service import UserService, UserTokenService
 from services.data_service import DataService
 from services.user_mapper_service import UserMapperService
 from services.dashboard_service import DashboardService
+from services.dashboard_change_feed_service import DashboardChangeFeedService
+from services.dashboard_index_service import DashboardIndexService
+from services.token_cache_service import TokenCacheService
+from services.user_view_cache_service import UserViewCacheService
+from services.password_hasher_service import PasswordHasherService
+from services.index_page_service import IndexPageService
+from services.component_service import ComponentService
+from services.home_assistant_hub_service import HomeAssistantHubService
+from services.entity_history_service import EntityHistoryService
 
 
 # Services container global singleton
@@ -22,7 +31,16 @@ def create_container(config: dict) -> SyncContainer:
             DataService,
             UserMapperService,
             DashboardService,
-            ConfigurationService])
+            DashboardChangeFeedService,
+            DashboardIndexService,
+            ConfigurationService,
+            TokenCacheService,
+            UserViewCacheService,
+            PasswordHasherService,
+            IndexPageService,
+            ComponentService,
+            HomeAssistantHubService,
+            EntityHistoryService])
 
     return _container
 
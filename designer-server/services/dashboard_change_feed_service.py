@@ -0,0 +1,72 @@
+import threading
+from collections import deque
+from typing import Optional
+from wireup import service
+from services.base import BaseService
+
+# The most recent changes kept for each dashboard, older editors reload the whole dashboard
+MAX_CHANGES_PER_DASHBOARD = 200
+
+
+@service
+class DashboardChangeFeedService(BaseService):
+    """
+    Keeps the JSON patches that took each dashboard to its recent versions, so an open editor
+    can catch up by applying the patches since the version it has rather than reloading the
+    whole layout. The history is held in memory and starts empty each time the server starts.
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        # Dashboard ID -> (version, patch that produced the version), oldest first
+        self.__changes: dict[int, deque[tuple[int, list]]] = {}
+        self.__lock = threading.Lock()
+
+    def record(self, dashboard_id: int, version: int, patch: list) -> None:
+        with self.__lock:
+            changes = self.__changes.get(dashboard_id)
+
+            if changes is None:
+                changes = deque(maxlen=MAX_CHANGES_PER_DASHBOARD)
+                self.__changes[dashboard_id] = changes
+
+            # A gap in the versions means changes were missed, only keep what follows it
+            if len(changes) > 0 and changes[-1][0] != version - 1:
+                changes.clear()
+
+            changes.append((version, patch))
+
+    def forget(self, dashboard_id: int) -> None:
+        with self.__lock:
+            self.__changes.pop(dashboard_id, None)
+
+    def get_changes(self, dashboard_id: int, since_version: int, current_version: int) -> Optional[list[dict]]:
+        """
+        Returns the changes after since_version up to current_version, or None when they aren't
+        all known and the caller needs to reload the dashboard.
+        """
+
+        if since_version == current_version:
+            return []
+
+        if since_version > current_version:
+            return None
+
+        with self.__lock:
+            changes = self.__changes.get(dashboard_id)
+
+            if changes is None or len(changes) == 0:
+                return None
+
+            # Must have every version from since_version + 1 to the current version
+            first_version = changes[0][0]
+
+            if first_version > since_version + 1 or changes[-1][0] != current_version:
+                return None
+
+            return [
+                {"version": version, "patch": patch}
+                for version, patch in changes
+                if version > since_version
+            ]
@@ -0,0 +1,312 @@
+import re
+import threading
+from bisect import bisect_left, insort
+from typing import Any, Callable, Iterable, Optional
+from wireup import service
+from services.base import BaseService
+from services.data_service import DataService
+
+# The kinds of token indexed for each dashboard
+TOKEN_KIND_NAME = "name"
+TOKEN_KIND_COMPONENT = "component"
+TOKEN_KIND_ENTITY = "entity"
+TOKEN_KINDS = (TOKEN_KIND_NAME, TOKEN_KIND_COMPONENT, TOKEN_KIND_ENTITY)
+
+# Same prefix as the custom web components loaded by the UI (see web-component.ts)
+_COMPONENT_TAG = re.compile(r"cwc-[a-z0-9]+(?:-[a-z0-9]+)*")
+
+# Home Assistant entity IDs, e.g. light.kitchen, or wildcard patterns such as light.*
+_ENTITY_ID = re.compile(r"^[a-z0-9_*]+\.[a-z0-9_*]+$")
+
+# Entity IDs given as attributes in HTML held by the layout, e.g. entity-id="light.kitchen"
+_ENTITY_ATTRIBUTE = re.compile(
+    r"""entity(?:[-_]?id)?\s*=\s*["']([a-z0-9_*]+\.[a-z0-9_*]+)["']""")
+
+# Layout keys whose values are entity IDs, compared lower case without '-' and '_'
+_ENTITY_KEYS = {"entity", "entityid", "entities", "entityids"}
+
+_NAME_WORD = re.compile(r"[a-z0-9]+")
+
+
+def _add_entity_ids(value: Any, entity_ids: set[str]) -> None:
+    values = value if isinstance(value, list) else [value]
+
+    for v in values:
+        if isinstance(v, str) and _ENTITY_ID.match(v.strip().lower()):
+            entity_ids.add(v.strip().lower())
+
+
+def _scan_layout(value: Any, components: set[str], entity_ids: set[str]) -> None:
+    # Walk the layout with a stack rather than recursion, layouts can be deeply nested
+    stack = [value]
+
+    while len(stack) > 0:
+        value = stack.pop()
+
+        if isinstance(value, dict):
+            for key, child in value.items():
+                components.update(_COMPONENT_TAG.findall(key.lower()))
+
+                if key.lower().replace("-", "").replace("_", "") in _ENTITY_KEYS:
+                    _add_entity_ids(child, entity_ids)
+
+                stack.append(child)
+        elif isinstance(value, list):
+            stack.extend(value)
+        elif isinstance(value, str):
+            text = value.lower()
+            components.update(_COMPONENT_TAG.findall(text))
+            entity_ids.update(_ENTITY_ATTRIBUTE.findall(text))
+
+
+def extract_tokens(dashboard: dict) -> dict[str, set[str]]:
+    """
+    Returns the tokens a dashboard can be found by: the words in its name, the cwc- component
+    tags used in its layout and the Home Assistant entity IDs (or wildcard patterns such as
+    light.*) its layout refers to.
+    """
+
+    components: set[str] = set()
+    entity_ids: set[str] = set()
+
+    _scan_layout(dashboard.get("layout"), components, entity_ids)
+
+    return {
+        TOKEN_KIND_NAME: set(_NAME_WORD.findall(str(dashboard.get("name", "")).lower())),
+        TOKEN_KIND_COMPONENT: components,
+        TOKEN_KIND_ENTITY: entity_ids
+    }
+
+
+@service
+class DashboardIndexService(BaseService):
+    """
+    An inverted index from name words, component tags and entity IDs to the dashboards that use
+    them, so searches don't load and scan every layout. The dashboard service updates it as
+    dashboards are saved. If the dashboards table changes any other way the index is rebuilt
+    on the next search.
+
+    Subscribers are told when a dashboard's entities may have changed, the home assistant hub
+    uses this to refresh its own copy of each dashboard's entities for routing changes.
+    """
+
+    def __init__(self, data_service: DataService):
+        super().__init__()
+
+        self.__data_service = data_service
+
+        # Kind -> token -> IDs of the dashboards with the token
+        self.__postings: dict[str, dict[str, set[int]]] = {
+            kind: {} for kind in TOKEN_KINDS}
+
+        # Kind -> the tokens in sorted order, for prefix matching
+        self.__sorted_tokens: dict[str, list[str]] = {
+            kind: [] for kind in TOKEN_KINDS}
+
+        # Dashboard ID -> the tokens it was indexed with, so it can be removed again
+        self.__tokens_by_id: dict[int, dict[str, set[str]]] = {}
+
+        # Dashboard ID -> ID, name and version returned in search results
+        self.__summaries: dict[int, dict] = {}
+
+        # Called with the ID of a dashboard whose entities may have changed, None for all of them
+        self.__subscribers: list[Callable[[Optional[int]], None]] = []
+
+        # The dashboards table version the index matches, None until it is built
+        self.__version: Optional[int] = None
+        self.__lock = threading.Lock()
+
+        self.__builds = 0
+        self.__updates = 0
+        self.__searches = 0
+
+    def __add(self, dashboard: dict) -> None:
+        dashboard_id = dashboard["id"]
+        tokens = extract_tokens(dashboard)
+
+        for kind, kind_tokens in tokens.items():
+            postings = self.__postings[kind]
+
+            for token in kind_tokens:
+                ids = postings.get(token)
+
+                if ids is None:
+                    ids = set()
+                    postings[token] = ids
+                    insort(self.__sorted_tokens[kind], token)
+
+                ids.add(dashboard_id)
+
+        self.__tokens_by_id[dashboard_id] = tokens
+        self.__summaries[dashboard_id] = {
+            "id": dashboard_id,
+            "name": dashboard["name"],
+            "version": dashboard["version"]
+        }
+
+    def __remove(self, dashboard_id: int) -> None:
+        tokens = self.__tokens_by_id.pop(dashboard_id, None)
+        self.__summaries.pop(dashboard_id, None)
+
+        if tokens is None:
+            return
+
+        for kind, kind_tokens in tokens.items():
+            postings = self.__postings[kind]
+
+            for token in kind_tokens:
+                ids = postings[token]
+                ids.discard(dashboard_id)
+
+                # Drop tokens no dashboard uses any more
+                if len(ids) == 0:
+                    del postings[token]
+                    sorted_tokens = self.__sorted_tokens[kind]
+                    del sorted_tokens[bisect_left(sorted_tokens, token)]
+
+    def __build(self, dashboards: Iterable[dict], version: int) -> None:
+        for kind in TOKEN_KINDS:
+            self.__postings[kind].clear()
+            self.__sorted_tokens[kind].clear()
+
+        self.__tokens_by_id.clear()
+        self.__summaries.clear()
+
+        for dashboard in dashboards:
+            self.__add(dashboard)
+
+        self.__version = version
+        self.__builds += 1
+
+    def __ensure_built(self) -> None:
+        dashboards_db = self.__data_service.get_dashboards_db()
+
+        with self.__lock:
+            if self.__version == dashboards_db.get_version():
+                return
+
+        # Read under the data lock so the version matches the dashboards read
+        with self.__data_service.read():
+            version = dashboards_db.get_version()
+            dashboards = dashboards_db.getAll()
+
+            with self.__lock:
+                if self.__version == version:
+                    return
+
+                self.__build(dashboards, version)
+
+        self.__notify(None)
+
+    def dashboard_saved(self, dashboard: dict) -> None:
+        # Called under the data write lock just after the dashboard is added or updated
+        self.__changed(dashboard["id"], dashboard)
+
+    def dashboard_deleted(self, dashboard_id: int) -> None:
+        # Called under the data write lock just after the dashboard is deleted
+        self.__changed(dashboard_id, None)
+
+    def __changed(self, dashboard_id: int, dashboard: Optional[dict]) -> None:
+        version = self.__data_service.get_dashboards_db().get_version()
+
+        with self.__lock:
+            # Not built yet, or another change was missed, leave it for the next search to rebuild
+            if self.__version is None or self.__version != version - 1:
+                self.__version = None
+                return
+
+            self.__remove(dashboard_id)
+
+            if dashboard is not None:
+                self.__add(dashboard)
+
+            self.__version = version
+            self.__updates += 1
+
+        self.__notify(dashboard_id)
+
+    def __notify(self, dashboard_id: Optional[int]) -> None:
+        with self.__lock:
+            subscribers = list(self.__subscribers)
+
+        for subscriber in subscribers:
+            try:
+                subscriber(dashboard_id)
+            except Exception as ex:
+                self.logger.error(f"dashboard index subscriber failed: {ex}")
+
+    def subscribe(self, callback: Callable[[Optional[int]], None]) -> None:
+        # Callbacks may be made while the data write lock is held, so must not wait on other locks
+        with self.__lock:
+            self.__subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[Optional[int]], None]) -> None:
+        with self.__lock:
+            if callback in self.__subscribers:
+                self.__subscribers.remove(callback)
+
+    def get_dashboard_entities(self, dashboard_id: int) -> Optional[set[str]]:
+        # The entity IDs and patterns a dashboard uses, None if there is no such dashboard
+        self.__ensure_built()
+
+        with self.__lock:
+            tokens = self.__tokens_by_id.get(dashboard_id)
+            return None if tokens is None else set(tokens[TOKEN_KIND_ENTITY])
+
+    def __match_prefix(self, kind: str, prefix: str) -> set[int]:
+        sorted_tokens = self.__sorted_tokens[kind]
+        postings = self.__postings[kind]
+        ids: set[int] = set()
+
+        i = bisect_left(sorted_tokens, prefix)
+
+        while i < len(sorted_tokens) and sorted_tokens[i].startswith(prefix):
+            ids.update(postings[sorted_tokens[i]])
+            i += 1
+
+        return ids
+
+    def search(self, query: str, kinds: Iterable[str] = TOKEN_KINDS, limit: Optional[int] = None) -> list[dict]:
+        """
+        Returns the ID, name and version of the dashboards matching every term in the query,
+        where a term matches any indexed token it is a prefix of. Results are ordered by name.
+        """
+
+        terms = query.lower().split()
+
+        if len(terms) == 0:
+            return []
+
+        self.__ensure_built()
+
+        with self.__lock:
+            self.__searches += 1
+            matched: Optional[set[int]] = None
+
+            for term in terms:
+                term_ids: set[int] = set()
+
+                for kind in kinds:
+                    term_ids.update(self.__match_prefix(kind, term))
+
+                matched = term_ids if matched is None else matched & term_ids
+
+                if len(matched) == 0:
+                    return []
+
+            results = sorted(
+                (dict(self.__summaries[dashboard_id])
+                 for dashboard_id in matched),
+                key=lambda s: (s["name"].lower(), s["id"]))
+
+        return results if limit is None else results[:limit]
+
+    def get_stats(self) -> dict:
+        with self.__lock:
+            return {
+                "dashboards": len(self.__summaries),
+                "tokens": sum(len(tokens) for tokens in self.__sorted_tokens.values()),
+                "builds": self.__builds,
+                "updates": self.__updates,
+                "searches": self.__searches
+            }
@@ -1,49 +1,191 @@
 from dataclasses import dataclass
-import bcrypt
-from typing import Optional, Union
+from typing import Any, Iterable, Optional
 from wireup import service
 from flask_jwt_extended import current_user
-from constants.messages import INVALID_USER_NAME_OR_PASSWORD
-from constants.user_security_roles import SECURITY_ROLE_ADMIN, SECURITY_ROLE_USER
+from pysondb.errors.db_errors import IdNotFoundError
+from constants.messages import DASHBOARD_NOT_FOUND, DASHBOARD_VERSION_CONFLICT, INVALID_DASHBOARD, INVALID_DASHBOARD_PATCH
+from constants.user_security_roles import SECURITY_ROLE_ADMIN
+from exceptions.dashboard_exceptions import (
+    DashboardNotFoundException,
+    DashboardVersionConflictException,
+    InvalidDashboardException,
+)
+from exceptions.json_patch_exceptions import JsonPatchException
 from exceptions.permission_exceptions import ForbiddenException
 from services.base import BaseService
+from services.dashboard_change_feed_service import DashboardChangeFeedService
+from services.dashboard_index_service import TOKEN_KINDS, DashboardIndexService
 from services.data_service import DataService
-from services.user_mapper_service import UserMapperService
-from services.user_token_service import UserTokenService
+from services.json_patch import apply_patch
+
+# The fields returned when listing dashboards, the layouts are left out
+DASHBOARD_SUMMARY_FIELDS = ("name", "version")
 
 
 @service
 @dataclass
 class DashboardService(BaseService):
     data_service: DataService
-    user_mapper_service: UserMapperService
-    user_token_service: UserTokenService
+    change_feed: DashboardChangeFeedService
+    dashboard_index: DashboardIndexService
 
-    def get_all_dashboards(self, include_roles: bool = False) -> list[dict]:
-        # Does this user have permissions to access?
-        if current_user is None or current_user["roles"] is None or "admin" not in current_user["roles"]:
+    def __ensure_admin(self) -> None:
+        # Only admin users can change dashboards
+        if current_user is None or current_user["roles"] is None or SECURITY_ROLE_ADMIN not in current_user["roles"]:
             raise ForbiddenException()
 
-        with self.data_service:
-            # Default to no roles
-            user_security_roles = None
+    @staticmethod
+    def __validate(name: Any, layout: Any) -> None:
+        if not isinstance(name, str) or len(name.strip()) == 0 or not isinstance(layout, dict):
+            raise InvalidDashboardException(INVALID_DASHBOARD)
+
+    def get_all_dashboards(self) -> list[dict]:
+        # Just the ID, name and version of each dashboard
+        return self.data_service.get_dashboards_db().getAllFields(DASHBOARD_SUMMARY_FIELDS)
+
+    def get_dashboard_version(self, dashboard_id: int) -> Optional[int]:
+        # Lets a caller check whether its copy is current without loading the layout
+        try:
+            return self.data_service.get_dashboards_db().getFieldsById(dashboard_id, ["version"])["version"]
+        except IdNotFoundError:
+            return None
+
+    def get_dashboard(self, dashboard_id: int) -> Optional[dict]:
+        try:
+            return self.data_service.get_dashboards_db().getById(dashboard_id)
+        except IdNotFoundError:
+            return None
+
+    def search_dashboards(self, query: str, kinds: Iterable[str] = TOKEN_KINDS, limit: Optional[int] = None) -> list[dict]:
+        # Prefix matches on name words, cwc- component tags and entity IDs
+        return self.dashboard_index.search(query, kinds, limit)
+
+    def create_dashboard(self, name: Any, layout: Any) -> dict:
+        self.__ensure_admin()
+        DashboardService.__validate(name, layout)
+
+        dashboard = {
+            "name": name.strip(),
+            "version": 1,
+            "layout": layout
+        }
+
+        with self.data_service.write():
+            self.data_service.get_dashboards_db().add(dashboard)
+            self.dashboard_index.dashboard_saved(dashboard)
+
+        return dashboard
+
+    def update_dashboard(self, dashboard_id: int, name: Any, layout: Any, expected_version: Optional[int] = None) -> dict:
+        self.__ensure_admin()
+        DashboardService.__validate(name, layout)
+
+        # Read, check and write under the one write lock so versions are never reused
+        with self.data_service.write():
+            dashboards_db = self.data_service.get_dashboards_db()
+
+            try:
+                dashboard = dashboards_db.getById(dashboard_id)
+            except IdNotFoundError:
+                raise DashboardNotFoundException(DASHBOARD_NOT_FOUND)
+
+            if expected_version is not None and dashboard["version"] != expected_version:
+                raise DashboardVersionConflictException(
+                    DASHBOARD_VERSION_CONFLICT)
+
+            changes = {
+                "name": name.strip(),
+                "version": dashboard["version"] + 1,
+                "layout": layout
+            }
+
+            dashboards_db.updateById(dashboard_id, changes)
+
+            dashboard.update(changes)
+            self.dashboard_index.dashboard_saved(dashboard)
+
+            # Editors following the feed get the whole layout as one change
+            self.change_feed.record(dashboard_id, changes["version"], [
+                {"op": "replace", "path": "/name", "value": changes["name"]},
+                {"op": "replace", "path": "/layout", "value": layout}
+            ])
+
+            return dashboard
+
+    def patch_dashboard(self, dashboard_id: int, base_version: Any, patch: Any) -> dict:
+        """
+        Applies a JSON patch to the name and layout of the dashboard at base_version, returning
+        the updated dashboard. Only the parts of the layout the patch changes are copied.
+        """
+
+        self.__ensure_admin()
+
+        if not isinstance(base_version, int) or isinstance(base_version, bool):
+            raise InvalidDashboardException("'baseVersion' must be a dashboard version")
+
+        if not isinstance(patch, list):
+            raise InvalidDashboardException(INVALID_DASHBOARD_PATCH)
+
+        with self.data_service.write():
+            dashboards_db = self.data_service.get_dashboards_db()
+
+            try:
+                dashboard = dashboards_db.getById(dashboard_id)
+            except IdNotFoundError:
+                raise DashboardNotFoundException(DASHBOARD_NOT_FOUND)
+
+            if dashboard["version"] != base_version:
+                raise DashboardVersionConflictException(
+                    DASHBOARD_VERSION_CONFLICT)
+
+            # The ID and version belong to the server so aren't part of the patched document
+            patched = apply_patch(
+                {"name": dashboard["name"], "layout": dashboard["layout"]}, patch)
+
+            if not isinstance(patched, dict) or set(patched.keys()) != {"name", "layout"}:
+                raise JsonPatchException(
+                    "a patch can only change the dashboard name and layout")
+
+            DashboardService.__validate(patched["name"], patched["layout"])
+
+            changes = {
+                "name": patched["name"].strip(),
+                "version": dashboard["version"] + 1,
+                "layout": patched["layout"]
+            }
+
+            dashboards_db.updateById(dashboard_id, changes)
+
+            dashboard.update(changes)
+            self.dashboard_index.dashboard_saved(dashboard)
+
+            self.change_feed.record(dashboard_id, changes["version"], patch)
+
+            return dashboard
+
+    def get_dashboard_changes(self, dashboard_id: int, since_version: int) -> tuple[int, Optional[list[dict]]]:
+        """
+        Returns the current version and the changes made after since_version, the changes are
+        None when they aren't all known and the dashboard needs to be reloaded.
+        """
 
-            # If the caller wants roles included then fetch all user security roles
-            if include_roles:
-                user_security_roles = self.get_all_user_security_roles()
+        # Changes are recorded under the write lock, so the version and feed agree here
+        with self.data_service.read():
+            version = self.get_dashboard_version(dashboard_id)
 
-            # Get all users (as dictionary objects)
-            users_list = self.data_service.get_users_db().getAll()
+            if version is None:
+                raise DashboardNotFoundException(DASHBOARD_NOT_FOUND)
 
-            user_models = []
+            return version, self.change_feed.get_changes(dashboard_id, since_version, version)
 
-            # Iterate each entity
-            for user_entity in users_list:
-                # Convert to user model (including user roles if roles list populated)
-                user_model = self.user_mapper_service.map_to_model(
-                    user_entity, user_security_roles)
+    def delete_dashboard(self, dashboard_id: int) -> None:
+        self.__ensure_admin()
 
-                user_models.append(user_model)
+        with self.data_service.write():
+            try:
+                self.data_service.get_dashboards_db().deleteById(dashboard_id)
+            except IdNotFoundError:
+                raise DashboardNotFoundException(DASHBOARD_NOT_FOUND)
 
-            # Return list of user models
-            return user_models
+            self.dashboard_index.dashboard_deleted(dashboard_id)
+            self.change_feed.forget(dashboard_id)
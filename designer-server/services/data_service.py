@@ -1,76 +1,399 @@
-from typing import Annotated
+import atexit
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Annotated, Iterator, Optional, Union
 from pysondb import db
 from wireup import Inject, service
-from filelock import BaseFileLock, Timeout, SoftFileLock
-from config.config import DataFileConfig
+from filelock import BaseFileLock, FileLock, Timeout
+from config.config import DataFileConfig, DataStoreConfig
 from services.base import BaseService
+from services.indexed_json_table import DURABILITY_FULL, DURABILITY_NORMAL, DURABILITY_OFF, IndexedJsonTable
+from services.rw_lock import ReentrantReadWriteLock
+from services.sqlite_table import SqliteConnectionPool, SqliteTable
+
+ENGINE_JSON = "json"
+ENGINE_SQLITE = "sqlite"
+
+WRITE_MODE_WRITE_BACK = "write_back"
+WRITE_MODE_WRITE_THROUGH = "write_through"
+
+# Either storage engine's table, both have the same methods
+DataTable = Union[IndexedJsonTable, SqliteTable]
+
+# The tables held by the data service along with the fields each one is indexed on
+_TABLE_INDEXES = {
+    "users": ["userName"],
+    "user_tokens": ["accessTokenJti", "refreshTokenJti", "userId"],
+    "user_security_roles": ["userId"],
+    "dashboards": []
+}
+
+# Tables with large records whose serialized text is kept, so saving one record doesn't
+# re-serialize all the others
+_CACHE_SERIALIZED_TABLES = {"dashboards"}
+
+# Bumped when the shape of stored records changes and they need migrating on startup
+#   1: user tokens hold the user ID, JTIs and epoch expiries
+_SCHEMA_VERSION = 1
 
 
 @service
 class DataService(BaseService):
-    __users_db: db.JsonDatabase
-    __user_tokens_db: db.JsonDatabase
-    __user_security_roles_db: db.JsonDatabase
-    __dashboards_db: db.JsonDatabase
-    __lock: BaseFileLock
+    __users_db: DataTable
+    __user_tokens_db: DataTable
+    __user_security_roles_db: DataTable
+    __dashboards_db: DataTable
+    __process_lock: Optional[BaseFileLock]
+    __sqlite_pool: Optional[SqliteConnectionPool]
+    __lock: ReentrantReadWriteLock
+    __commit_interval_secs: float
+    __commit_timer: Optional[threading.Timer]
 
-    def __init__(self, lock_file: Annotated[str, Inject(param="lock_file")], data_files: Annotated[DataFileConfig, Inject(param="data_files")]):
+    def __init__(
+            self,
+            lock_file: Annotated[str, Inject(param="lock_file")],
+            data_files: Annotated[DataFileConfig, Inject(param="data_files")],
+            data_store: Annotated[DataStoreConfig, Inject(param="data_store")]):
         super().__init__()
 
-        self.__lock = SoftFileLock(lock_file)
+        self.__process_lock = None
+        self.__sqlite_pool = None
+        self.__tables: list[DataTable] = []
+        self.__schema_version_file: Optional[str] = None
+
+        # Guards the tables within this process
+        self.__lock = ReentrantReadWriteLock()
+
+        self.__commit_lock = threading.Lock()
+        self.__commit_timer = None
+
+        engine = data_store.get("engine", ENGINE_JSON)
+        write_mode = data_store.get("write_mode", WRITE_MODE_WRITE_BACK)
+        durability = data_store.get("durability", DURABILITY_NORMAL)
+        self.__commit_interval_secs = data_store.get(
+            "commit_interval_ms", 0) / 1000
+
+        if engine not in [ENGINE_JSON, ENGINE_SQLITE]:
+            raise Exception(
+                f"'engine' setting '{engine}' must be one of '{ENGINE_JSON}' or '{ENGINE_SQLITE}'")
+
+        if write_mode not in [WRITE_MODE_WRITE_BACK, WRITE_MODE_WRITE_THROUGH]:
+            raise Exception(
+                f"'write_mode' setting '{write_mode}' must be one of '{WRITE_MODE_WRITE_BACK}' or '{WRITE_MODE_WRITE_THROUGH}'")
+
+        if durability not in [DURABILITY_FULL, DURABILITY_NORMAL, DURABILITY_OFF]:
+            raise Exception(
+                f"'durability' setting '{durability}' must be one of '{DURABILITY_FULL}', '{DURABILITY_NORMAL}' or '{DURABILITY_OFF}'")
+
+        write_back = write_mode == WRITE_MODE_WRITE_BACK
+
+        # In write through mode a write block is written as soon as it ends
+        if not write_back:
+            self.__commit_interval_secs = 0
+
+        users_data_file = data_files.get("users_data_file")
+        user_tokens_data_file = data_files.get(
+            "user_tokens_data_file")
+        user_security_roles_data_file = data_files.get(
+            "user_security_roles_data_file")
+        dashboards_data_file = data_files.get("dashboards_data_file")
+
+        if users_data_file is None:
+            raise Exception(
+                "'users_data_file' setting missing from configuration file")
+
+        if user_tokens_data_file is None:
+            raise Exception(
+                "'user_tokens_data_file' setting missing from configuration file")
+
+        if user_security_roles_data_file is None:
+            raise Exception(
+                "'user_security_roles_data_file' setting missing from configuration file")
+
+        if dashboards_data_file is None:
+            raise Exception(
+                "'dashboards_data_file' setting missing from configuration file")
+
+        json_data_files = {
+            "users": users_data_file,
+            "user_tokens": user_tokens_data_file,
+            "user_security_roles": user_security_roles_data_file,
+            "dashboards": dashboards_data_file
+        }
+
+        if engine == ENGINE_SQLITE:
+            tables = self.__open_sqlite_tables(
+                data_store, durability, json_data_files)
+        else:
+            # SQLite keeps the schema version in the database itself
+            self.__schema_version_file = os.path.join(
+                os.path.dirname(os.path.abspath(user_tokens_data_file)), "schema_version")
+
+            tables = self.__open_json_tables(
+                lock_file, write_back, durability, json_data_files)
+
+        self.__tables = list(tables.values())
+
+        self.__migrate_user_tokens(tables)
+        self.__users_db = tables["users"]
+        self.__user_tokens_db = tables["user_tokens"]
+        self.__user_security_roles_db = tables["user_security_roles"]
+        self.__dashboards_db = tables["dashboards"]
+
+        # Make sure any pending changes are written when the app exits
+        atexit.register(self.__shutdown)
+
+    def __open_json_tables(self, lock_file: str, write_back: bool, durability: str, json_data_files: dict[str, str]) -> dict[str, DataTable]:
+        # The lock file stops a second server process using the same data files. It is an
+        # operating system lock so it is released even if this process is killed.
+        self.__process_lock = FileLock(lock_file)
 
         try:
-            # Try and get the app lock without blocking
-            with self.__lock.acquire(timeout=1):
-
-                users_data_file = data_files.get("users_data_file")
-                user_tokens_data_file = data_files.get(
-                    "user_tokens_data_file")
-                user_security_roles_data_file = data_files.get(
-                    "user_security_roles_data_file")
-                dashboards_data_file = data_files.get("dashboards_data_file")
-
-                if users_data_file is None:
-                    raise Exception(
-                        "'users_data_file' setting missing from configuration file")
-
-                if user_tokens_data_file is None:
-                    raise Exception(
-                        "'user_tokens_data_file' setting missing from configuration file")
-
-                if user_security_roles_data_file is None:
-                    raise Exception(
-                        "'user_security_roles_data_file' setting missing from configuration file")
-
-                if dashboards_data_file is None:
-                    raise Exception(
-                        "'dashboards_data_file' setting missing from configuration file")
-
-                self.__users_db = db.getDb(users_data_file)
-                self.__user_tokens_db = db.getDb(user_tokens_data_file)
-                self.__user_security_roles_db = db.getDb(
-                    user_security_roles_data_file)
-                self.__dashboards_db = db.getDb(dashboards_data_file)
+            # Try and get the app lock without blocking, it is held until the app exits
+            self.__process_lock.acquire(timeout=1)
         except Timeout:
             raise Exception(
-                f"Unable to acquire the application lock file: '{lock_file}'. If you are sure no instances are running then you can safely delete this lock file and re run the application. This can happen if the application crashed previously, or the app was forcibly terminated.")
+                f"Unable to acquire the application lock file: '{lock_file}'. Another instance of the application is already running using the same data files.")
+
+        # Load each table in to memory, indexing the fields used for lookups
+        return {
+            name: IndexedJsonTable(
+                db.getDb(json_data_files[name]), indexed_fields,
+                write_back, durability, self.__on_dirty, self.__lock,
+                cache_serialized=name in _CACHE_SERIALIZED_TABLES)
+            for name, indexed_fields in _TABLE_INDEXES.items()
+        }
+
+    def __open_sqlite_tables(self, data_store: DataStoreConfig, durability: str, json_data_files: dict[str, str]) -> dict[str, DataTable]:
+        sqlite_data_file = data_store.get("sqlite_data_file")
+
+        if sqlite_data_file is None:
+            raise Exception(
+                "'sqlite_data_file' setting missing from configuration file")
+
+        # SQLite coordinates writers between processes itself so no lock file is needed
+        self.__sqlite_pool = SqliteConnectionPool(
+            sqlite_data_file,
+            durability,
+            data_store.get("sqlite_busy_timeout_ms", 5000))
+
+        tables = {
+            name: SqliteTable(self.__sqlite_pool, name,
+                              indexed_fields, self.__lock)
+            for name, indexed_fields in _TABLE_INDEXES.items()
+        }
+
+        self.__migrate_json_data_files(tables, json_data_files)
+
+        return tables
+
+    def __migrate_json_data_files(self, tables: dict[str, DataTable], json_data_files: dict[str, str]) -> None:
+        # One shot copy of the existing pysondb files, a table that already has records has
+        # either been migrated or used with SQLite from the start so is left alone
+        with self.write():
+            for name, table in tables.items():
+                json_data_file = json_data_files[name]
+
+                if table.count() > 0 or not os.path.exists(json_data_file):
+                    continue
+
+                records = db.getDb(json_data_file).getAll()
+
+                if len(records) == 0:
+                    continue
+
+                count = table.import_records(records)
+
+                self.logger.info(
+                    f"migrated {count} '{name}' records from '{json_data_file}'")
+
+    def __get_schema_version(self) -> int:
+        if self.__sqlite_pool is not None:
+            return self.__sqlite_pool.connection().execute("PRAGMA user_version").fetchone()[0]
+
+        if not os.path.exists(self.__schema_version_file):
+            return 0
+
+        with open(self.__schema_version_file, encoding="utf-8") as f:
+            return int(f.read().strip() or 0)
+
+    def __set_schema_version(self, version: int) -> None:
+        if self.__sqlite_pool is not None:
+            self.__sqlite_pool.connection().execute(
+                f"PRAGMA user_version = {int(version)}")
+            return
+
+        with open(self.__schema_version_file, "w", encoding="utf-8") as f:
+            f.write(str(version))
+
+    def __migrate_user_tokens(self, tables: dict[str, DataTable]) -> None:
+        # User tokens used to hold the user name, the signed tokens and ISO expiry dates. They
+        # are rewritten in the compact form (user ID, JTIs and epoch expiries). This only needs
+        # to happen once, the schema version records that it has.
+        if self.__get_schema_version() >= _SCHEMA_VERSION:
+            return
+
+        self.__rewrite_legacy_user_tokens(tables)
+
+        # Only recorded once the rewritten tokens are written
+        self.commit()
+        self.__set_schema_version(_SCHEMA_VERSION)
+
+    def __rewrite_legacy_user_tokens(self, tables: dict[str, DataTable]) -> None:
+        with self.write():
+            user_tokens_db = tables["user_tokens"]
+
+            legacy_tokens = [
+                token for token in user_tokens_db.getAll() if "userId" not in token]
+
+            if len(legacy_tokens) == 0:
+                return
+
+            user_ids = {
+                user["userName"]: user["id"] for user in tables["users"].getAll()}
+
+            migrated = 0
+
+            for token in legacy_tokens:
+                user_tokens_db.deleteById(token["id"])
+
+                try:
+                    compact_token = {
+                        "userId": user_ids[token["userName"]],
+                        "accessTokenJti": token["accessTokenJti"],
+                        "accessTokenExpiry": int(datetime.fromisoformat(token["accessTokenExpiry"]).timestamp()),
+                        "refreshTokenJti": token["refreshTokenJti"],
+                        "refreshTokenExpiry": int(datetime.fromisoformat(token["refreshTokenExpiry"]).timestamp())
+                    }
+                except (KeyError, TypeError, ValueError):
+                    # Tokens of deleted users (or that can't be read) are dropped, the user
+                    # just has to log in again
+                    continue
+
+                user_tokens_db.add(compact_token)
+                migrated += 1
+
+            self.logger.info(
+                f"migrated {migrated} of {len(legacy_tokens)} user tokens to the compact format")
+
+            if migrated < len(legacy_tokens):
+                self.logger.warning(
+                    f"dropped {len(legacy_tokens) - migrated} user tokens of deleted users or with unreadable expiries, their users need to log in again")
 
     def __enter__(self):
-        self.__lock.acquire(timeout=1)
+        # A plain 'with data_service:' block is a write block
+        self.__begin_write()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.__lock.release()
-        return True
+        self.__end_write(exc_type is not None)
+
+    def __begin_write(self) -> None:
+        self.__lock.acquire_write()
+
+        if self.__sqlite_pool is not None:
+            try:
+                # Changes made in the block are one SQLite transaction
+                self.__sqlite_pool.begin()
+            except BaseException:
+                self.__lock.release_write()
+                raise
+
+    def __end_write(self, failed: bool = False) -> None:
+        outermost = False
+
+        try:
+            self.__lock.release_write()
+            outermost = not self.__lock.is_write_locked_by_current_thread()
+
+            if outermost and self.__sqlite_pool is not None:
+                if failed:
+                    self.__sqlite_pool.rollback()
+                else:
+                    self.__sqlite_pool.commit()
+        finally:
+            # Changes made in the outermost block are committed together. The JSON tables
+            # can't roll back so their changes are written even if the block failed.
+            if outermost:
+                self.__commit_or_schedule()
+
+    @contextmanager
+    def read(self) -> Iterator["DataService"]:
+        # Readers run in parallel with each other, but not with a writer
+        self.__lock.acquire_read()
+        try:
+            yield self
+        finally:
+            self.__lock.release_read()
+
+    @contextmanager
+    def write(self) -> Iterator["DataService"]:
+        self.__begin_write()
+        try:
+            yield self
+        except BaseException:
+            self.__end_write(True)
+            raise
+
+        self.__end_write()
+
+    def __on_dirty(self) -> None:
+        # Changes made inside a write block are committed when the outermost block exits
+        if self.__lock.is_write_locked_by_current_thread():
+            return
+
+        self.__commit_or_schedule()
+
+    def __shutdown(self) -> None:
+        self.commit()
+
+        if self.__sqlite_pool is not None:
+            self.__sqlite_pool.close()
+
+        if self.__process_lock is not None:
+            self.__process_lock.release(force=True)
+
+    def __commit_or_schedule(self) -> None:
+        if self.__commit_interval_secs <= 0:
+            self.commit()
+            return
+
+        with self.__commit_lock:
+            # A commit is already pending for the current window
+            if self.__commit_timer is not None:
+                return
+
+            self.__commit_timer = threading.Timer(
+                self.__commit_interval_secs, self.commit)
+            self.__commit_timer.daemon = True
+            self.__commit_timer.start()
+
+    def commit(self) -> None:
+        with self.__commit_lock:
+            if self.__commit_timer is not None:
+                self.__commit_timer.cancel()
+                self.__commit_timer = None
+
+        # Write each changed table in a single atomic write
+        for table in self.__tables:
+            try:
+                table.flush()
+            except Exception as ex:
+                self.logger.error(f"failed to write data file: {ex}")
+
+    def get_lock_stats(self) -> dict:
+        return self.__lock.get_stats()
 
-    def get_users_db(self) -> db.JsonDatabase:
+    def get_users_db(self) -> DataTable:
         return self.__users_db
 
-    def get_user_tokens_db(self) -> db.JsonDatabase:
+    def get_user_tokens_db(self) -> DataTable:
         return self.__user_tokens_db
 
-    def get_user_security_roles_db(self) -> db.JsonDatabase:
+    def get_user_security_roles_db(self) -> DataTable:
         return self.__user_security_roles_db
 
-    def get_dashboards_db(self) -> db.JsonDatabase:
+    def get_dashboards_db(self) -> DataTable:
         return self.__dashboards_db
@@ -0,0 +1,241 @@
+import math
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from time import time
+from typing import Annotated, Optional
+from wireup import Inject, service
+from config.config import EntityHistoryConfig
+from services.base import BaseService
+
+# Bytes held for each sample: a float64 timestamp and a float32 value
+_SAMPLE_BYTES = array("d").itemsize + array("f").itemsize
+
+
+class _RingBuffer:
+    """
+    The recent samples of one entity in two parallel arrays, timestamps and values. The arrays
+    grow until they hold the capacity, after that the oldest sample is overwritten.
+    """
+
+    def __init__(self, capacity: int, spacing_secs: float):
+        self.capacity = capacity
+        self.spacing_secs = spacing_secs
+        self.times = array("d")
+        self.values = array("f")
+
+        # Index of the oldest sample once the arrays are full
+        self.start = 0
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def get_bytes(self) -> int:
+        return len(self.times) * _SAMPLE_BYTES
+
+    def append(self, timestamp: float, value: float) -> int:
+        # Returns the number of bytes the buffer grew by
+        count = len(self.times)
+
+        if count > 0:
+            last = (self.start - 1) % count
+
+            # Samples closer together than the spacing share a slot, the latest value is kept,
+            # so chatty entities still cover the whole history
+            if self.spacing_secs > 0 and \
+                    int(timestamp / self.spacing_secs) <= int(self.times[last] / self.spacing_secs):
+                self.values[last] = value
+                return 0
+
+        if count < self.capacity:
+            self.times.append(timestamp)
+            self.values.append(value)
+            return _SAMPLE_BYTES
+
+        self.times[self.start] = timestamp
+        self.values[self.start] = value
+        self.start = (self.start + 1) % count
+        return 0
+
+    def read(self, since: float) -> tuple[array, array]:
+        # The samples at or after since, oldest first
+        times = self.times[self.start:] + self.times[:self.start]
+        values = self.values[self.start:] + self.values[:self.start]
+
+        # Timestamps are in order
+        first = bisect_left(times, since)
+
+        return times[first:], values[first:]
+
+
+def _downsample(times: array, values: array, points: int) -> tuple[array, array]:
+    # Averages the samples into at most points buckets of equal time, empty buckets are left out
+    if points <= 0 or len(times) <= points:
+        return times, values
+
+    start = times[0]
+    width = (times[-1] - start) / points or 1.0
+
+    sums = [0.0] * points
+    time_sums = [0.0] * points
+    counts = [0] * points
+
+    for timestamp, value in zip(times, values):
+        bucket = min(points - 1, int((timestamp - start) / width))
+        sums[bucket] += value
+        time_sums[bucket] += timestamp
+        counts[bucket] += 1
+
+    out_times = array("d")
+    out_values = array("f")
+
+    for bucket in range(points):
+        if counts[bucket] > 0:
+            out_times.append(time_sums[bucket] / counts[bucket])
+            out_values.append(sums[bucket] / counts[bucket])
+
+    return out_times, out_values
+
+
+@service
+class EntityHistoryService(BaseService):
+    """
+    Keeps the recent values of numeric home assistant entities in memory, so cards such as
+    sparklines can draw them without each panel asking home assistant for its history. Each
+    entity has a ring buffer of float64 timestamps and float32 values covering the configured
+    hours, reads are downsampled to the points asked for.
+
+    The buffers share a memory cap, when it is reached the least recently used entity (read or
+    added) is dropped first.
+    """
+
+    def __init__(self, entity_history: Annotated[EntityHistoryConfig, Inject(param="entity_history")]):
+        super().__init__()
+
+        self.__enabled = bool(entity_history.get("enabled", True))
+        self.__hours = max(0.1, float(entity_history.get("hours", 24)))
+        self.__samples_per_entity = max(2, int(
+            entity_history.get("samples_per_entity", 2880)))
+        self.__max_bytes = max(0, int(entity_history.get(
+            "max_bytes", 16 * 1024 * 1024)))
+
+        # No one entity can hold more than the cap
+        self.__samples_per_entity = max(2, min(
+            self.__samples_per_entity, self.__max_bytes // _SAMPLE_BYTES))
+
+        # Samples are spread evenly over the hours kept
+        self.__spacing_secs = self.__hours * 3600 / self.__samples_per_entity
+
+        # Entity ID -> its samples, least recently used first
+        self.__buffers: OrderedDict[str, _RingBuffer] = OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+
+        self.__samples = 0
+        self.__reads = 0
+        self.__evictions = 0
+
+    def is_enabled(self) -> bool:
+        return self.__enabled
+
+    def get_hours(self) -> float:
+        return self.__hours
+
+    def record(self, entity_id: str, state: object, timestamp: Optional[float] = None) -> None:
+        """
+        Adds a sample for an entity if its state is a number, other states are ignored.
+        """
+
+        if not self.__enabled:
+            return
+
+        try:
+            value = float(state)  # type: ignore[arg-type]
+        except (TypeError, ValueError):
+            return
+
+        if not math.isfinite(value):
+            return
+
+        with self.__lock:
+            buffer = self.__buffers.get(entity_id)
+
+            if buffer is None:
+                buffer = _RingBuffer(
+                    self.__samples_per_entity, self.__spacing_secs)
+                self.__buffers[entity_id] = buffer
+
+            self.__bytes += buffer.append(
+                time() if timestamp is None else timestamp, value)
+            self.__samples += 1
+
+            self.__evict(entity_id)
+
+    def forget(self, entity_id: str) -> None:
+        with self.__lock:
+            buffer = self.__buffers.pop(entity_id, None)
+
+            if buffer is not None:
+                self.__bytes -= buffer.get_bytes()
+
+    def __evict(self, keep_entity_id: str) -> None:
+        # Must hold the lock. Drops the coldest entities until the buffers fit the cap.
+        while self.__bytes > self.__max_bytes and len(self.__buffers) > 1:
+            entity_id, buffer = next(iter(self.__buffers.items()))
+
+            if entity_id == keep_entity_id:
+                self.__buffers.move_to_end(entity_id)
+                continue
+
+            del self.__buffers[entity_id]
+            self.__bytes -= buffer.get_bytes()
+            self.__evictions += 1
+
+    def get_history(self, entity_id: str, hours: Optional[float] = None, points: int = 0) -> Optional[tuple[array, array]]:
+        """
+        Returns the timestamps (epoch seconds) and values of an entity over the last hours (all
+        that are kept when not given), averaged down to at most points samples when points is
+        more than 0. None if no history is kept for the entity.
+        """
+
+        since = time() - (self.__hours if hours is None else min(hours, self.__hours)) * 3600
+
+        with self.__lock:
+            buffer = self.__buffers.get(entity_id)
+
+            if buffer is None:
+                return None
+
+            self.__buffers.move_to_end(entity_id)
+            self.__reads += 1
+
+            times, values = buffer.read(since)
+
+        return _downsample(times, values, points)
+
+    @staticmethod
+    def to_binary(times: array, values: array) -> bytes:
+        # Little endian: uint32 count, then count float64 timestamps, then count float32 values
+        times = array("d", times)
+        values = array("f", values)
+
+        if sys.byteorder == "big":
+            times.byteswap()
+            values.byteswap()
+
+        return struct.pack("<I", len(times)) + times.tobytes() + values.tobytes()
+
+    def get_stats(self) -> dict:
+        with self.__lock:
+            return {
+                "enabled": self.__enabled,
+                "entities": len(self.__buffers),
+                "bytes": self.__bytes,
+                "maxBytes": self.__max_bytes,
+                "samples": self.__samples,
+                "reads": self.__reads,
+                "evictions": self.__evictions
+            }
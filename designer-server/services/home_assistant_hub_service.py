@@ -0,0 +1,1051 @@
+import asyncio
+import atexit
+import fnmatch
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from typing import Annotated, Any, Optional
+from wireup import Inject, service
+from config.config import HomeAssistantHubConfig
+from constants.messages import (
+    DASHBOARD_NOT_FOUND,
+    HOME_ASSISTANT_SERVICE_NOT_ALLOWED,
+    HOME_ASSISTANT_TIMEOUT,
+    HOME_ASSISTANT_UNAVAILABLE,
+    SERVER_BUSY,
+)
+from exceptions.capacity_exceptions import ServerBusyException
+from exceptions.dashboard_exceptions import DashboardNotFoundException
+from exceptions.home_assistant_exceptions import (
+    HomeAssistantServiceCallException,
+    HomeAssistantServiceNotAllowedException,
+    HomeAssistantTimeoutException,
+    HomeAssistantUnavailableException,
+)
+from services.base import BaseService
+from services.dashboard_index_service import DashboardIndexService
+from services.entity_history_service import EntityHistoryService
+
+try:
+    from websockets.asyncio.client import connect
+except ImportError:
+    # Panels only get entities through the hub, so an enabled hub without it fails at startup
+    connect = None
+
+# The message ID used for the entity subscription on each connection
+_SUBSCRIBE_ENTITIES_ID = 1
+
+# The services panels call (switch and light cards turn entities on and off)
+_DEFAULT_ALLOWED_SERVICES = ["switch", "light"]
+
+
+def _to_iso(epoch_secs: float) -> str:
+    # Same format as the home assistant websocket library gives the UI
+    return datetime.fromtimestamp(epoch_secs, timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def _to_context(context: Any) -> dict:
+    if isinstance(context, str):
+        return {"id": context, "parent_id": None, "user_id": None}
+
+    return context
+
+
+def _expand_entity(entity_id: str, compressed: dict) -> dict:
+    # subscribe_entities sends entities with short keys, expand them to a HassEntity
+    last_changed = compressed.get("lc", 0)
+
+    return {
+        "entity_id": entity_id,
+        "state": compressed.get("s"),
+        "attributes": compressed.get("a", {}),
+        "context": _to_context(compressed.get("c")),
+        "last_changed": _to_iso(last_changed),
+        "last_updated": _to_iso(compressed.get("lu", last_changed))
+    }
+
+
+def _apply_entity_change(entity: dict, change: dict) -> dict:
+    # Returns a new entity with a subscribe_entities change applied, the old one isn't changed
+    entity = dict(entity)
+    to_add = change.get("+")
+    to_remove = change.get("-")
+
+    attributes_changed = (to_add is not None and "a" in to_add) or (
+        to_remove is not None and "a" in to_remove)
+    attributes = dict(entity["attributes"]
+                      ) if attributes_changed else entity["attributes"]
+
+    if to_add is not None:
+        if "s" in to_add:
+            entity["state"] = to_add["s"]
+
+        if "c" in to_add:
+            context = to_add["c"]
+            entity["context"] = {**entity["context"], "id": context} if isinstance(
+                context, str) else {**entity["context"], **context}
+
+        if "lc" in to_add:
+            entity["last_changed"] = entity["last_updated"] = _to_iso(
+                to_add["lc"])
+        elif "lu" in to_add:
+            entity["last_updated"] = _to_iso(to_add["lu"])
+
+        if "a" in to_add:
+            attributes.update(to_add["a"])
+
+    if to_remove is not None and "a" in to_remove:
+        for key in to_remove["a"]:
+            attributes.pop(key, None)
+
+    entity["attributes"] = attributes
+
+    return entity
+
+
+def _diff_entity(old: dict, new: dict) -> dict:
+    """
+    Returns just what changed between two states of an entity: 's' the state, 'a' the attributes
+    added or changed, 'r' the names of attributes removed, 'c' the context (or just its ID),
+    'lc' the last changed time (also the last updated time unless 'lu' is given) and 'lu' the
+    last updated time.
+    """
+
+    diff: dict[str, Any] = {}
+
+    if new["state"] != old["state"]:
+        diff["s"] = new["state"]
+
+    old_attributes = old["attributes"]
+    new_attributes = new["attributes"]
+
+    # Attributes are only copied when they change, so the same object means no change
+    if new_attributes is not old_attributes:
+        changed = {
+            key: value for key, value in new_attributes.items()
+            if key not in old_attributes or old_attributes[key] != value
+        }
+        removed = [key for key in old_attributes if key not in new_attributes]
+
+        if len(changed) > 0:
+            diff["a"] = changed
+
+        if len(removed) > 0:
+            diff["r"] = removed
+
+    old_context = old["context"]
+    new_context = new["context"]
+
+    if new_context != old_context:
+        # Usually only the context ID changes, then the ID is enough
+        if isinstance(old_context, dict) and isinstance(new_context, dict) and \
+                {**new_context, "id": None} == {**old_context, "id": None}:
+            diff["c"] = new_context.get("id")
+        else:
+            diff["c"] = new_context
+
+    if new["last_changed"] != old["last_changed"]:
+        diff["lc"] = new["last_changed"]
+
+    # When the state changes both times are the same, 'lc' alone sets both
+    if new["last_updated"] != old["last_updated"] and new["last_updated"] != diff.get("lc"):
+        diff["lu"] = new["last_updated"]
+
+    return diff
+
+
+def _format_event(event: str, data: Any, event_id: Optional[str] = None) -> str:
+    # A server sent event, the data is encoded once and shared by every client
+    lines = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{lines}event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class HubClient:
+    """
+    A panel connected to the hub. Events are queued here by the hub thread and taken by the
+    request thread streaming them to the panel.
+    """
+
+    def __init__(self, max_queue: int, dashboard_id: Optional[int]):
+        self.__max_queue = max_queue
+        self.__dashboard_id = dashboard_id
+        self.__events: deque[str] = deque()
+        self.__condition = threading.Condition()
+        self.__closed = False
+
+        # Set when the client fell too far behind, it gets a new snapshot instead of the changes
+        self.__resync = False
+
+    def put(self, event: str) -> bool:
+        # Returns False if the event wasn't queued
+        with self.__condition:
+            if self.__closed or self.__resync:
+                return False
+
+            if len(self.__events) >= self.__max_queue:
+                # No point sending changes the panel will never catch up with
+                self.__resync = True
+                self.__events.clear()
+                self.__condition.notify_all()
+                return False
+
+            self.__events.append(event)
+            self.__condition.notify_all()
+            return True
+
+    def restart(self, event: str) -> bool:
+        # Replaces anything queued with a snapshot, returns True if the client was waiting for one
+        with self.__condition:
+            if not self.__resync:
+                return False
+
+            self.__resync = False
+            self.__events.clear()
+            self.__events.append(event)
+            self.__condition.notify_all()
+            return True
+
+    def resync(self) -> None:
+        # Drops anything queued, the client gets a new snapshot instead
+        with self.__condition:
+            self.__resync = True
+            self.__events.clear()
+            self.__condition.notify_all()
+
+    def needs_resync(self) -> bool:
+        with self.__condition:
+            return self.__resync
+
+    def get_dashboard_id(self) -> Optional[int]:
+        # The dashboard whose entities the client gets, None for every entity
+        return self.__dashboard_id
+
+    def close(self) -> None:
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+    def is_closed(self) -> bool:
+        with self.__condition:
+            return self.__closed
+
+    def take(self, timeout_secs: float) -> list[str]:
+        # All the queued events, empty if none arrived within the timeout or the client is closed
+        with self.__condition:
+            if len(self.__events) == 0 and not self.__closed and not self.__resync:
+                self.__condition.wait(timeout_secs)
+
+            events = list(self.__events)
+            self.__events.clear()
+            return events
+
+
+class _Topic:
+    """
+    The clients getting the entities used by one dashboard (or every entity), with the deltas
+    numbered and kept for that set of entities alone.
+    """
+
+    def __init__(
+            self, dashboard_id: Optional[int], entity_patterns: Optional[set[str]], epoch: str, history_size: int,
+            generation: int = 0):
+        self.dashboard_id = dashboard_id
+
+        self.entity_patterns: Optional[set[str]] = None
+        self.__entity_ids: set[str] = set()
+        self.__regexes: list[re.Pattern] = []
+
+        # Entity ID -> whether a pattern matches it, filled in as entities are routed
+        self.__matches: dict[str, bool] = {}
+
+        self.set_entity_patterns(entity_patterns)
+
+        self.clients: set[HubClient] = set()
+        self.seq = 0
+
+        # The most recent delta events, oldest first, as (seq, event)
+        self.history: deque[tuple[int, str]] = deque(maxlen=history_size)
+
+        # The snapshot event sent to new clients, built once for each set of entity states
+        self.snapshot_event: Optional[str] = None
+
+        # Event IDs tell apart the server runs and topics, e.g. 3f2a9c1e.12.5-40. A dashboard's
+        # topic is rebuilt when a panel shows it again, the generation keeps its numbering apart.
+        name = "all" if dashboard_id is None else f"{dashboard_id}.{generation}"
+        self.event_id_prefix = f"{epoch}.{name}"
+
+    def get_event_id(self) -> str:
+        return f"{self.event_id_prefix}-{self.seq}"
+
+    def set_entity_patterns(self, entity_patterns: Optional[set[str]]) -> None:
+        # The entity IDs and patterns (e.g. light.*) the dashboard uses, None for every entity.
+        # Kept here so routing never has to wait on the dashboard index.
+        self.entity_patterns = entity_patterns
+        self.__entity_ids = {
+            p for p in entity_patterns or () if "*" not in p}
+        self.__regexes = [re.compile(fnmatch.translate(p))
+                          for p in entity_patterns or () if "*" in p]
+        self.__matches.clear()
+
+    def uses(self, entity_id: str) -> bool:
+        if self.entity_patterns is None or entity_id in self.__entity_ids:
+            return True
+
+        matches = self.__matches.get(entity_id)
+
+        if matches is None:
+            matches = any(regex.match(entity_id) for regex in self.__regexes)
+            self.__matches[entity_id] = matches
+
+        return matches
+
+    def reset(self, entity_patterns: Optional[set[str]]) -> None:
+        # The dashboard's entities changed, deltas kept for the old ones can't be replayed
+        self.set_entity_patterns(entity_patterns)
+        self.seq += 1
+        self.history.clear()
+        self.snapshot_event = None
+
+
+@service
+class HomeAssistantHubService(BaseService):
+    """
+    Holds a single websocket connection to home assistant and shares its entity states with every
+    connected panel, so home assistant sends each change once however many panels are open and
+    the long lived token stays on the server. The connection runs on its own thread with an
+    asyncio loop and reconnects with an increasing delay when it is lost.
+
+    Changes from home assistant are coalesced: they are held for a short window, only the latest
+    state of each entity is kept and one delta is sent for the window. Domains or entities can
+    also be given a minimum interval between the changes sent, for chatty sensors.
+
+    Panels get a snapshot of every entity and then numbered deltas holding only what changed in
+    each entity. A panel that misses a delta, or falls too far behind, starts again from a new
+    snapshot. Recent deltas are kept so a panel that reconnects can pick up where it left off.
+
+    A panel showing a dashboard can subscribe to just the entities the dashboard uses, found with
+    the dashboard index. Each dashboard is a topic with its own deltas, so a change is only sent
+    to the panels showing a dashboard that uses the entity.
+    """
+
+    def __init__(
+            self,
+            dashboard_index: DashboardIndexService,
+            entity_history: EntityHistoryService,
+            home_assistant_url: Annotated[str, Inject(param="home_assistant_url")],
+            home_assistant_token: Annotated[str, Inject(param="home_assistant_token")],
+            home_assistant_hub: Annotated[HomeAssistantHubConfig, Inject(param="home_assistant_hub")]):
+        super().__init__()
+
+        # e.g. http://homeassistant.local:8123 -> ws://homeassistant.local:8123/api/websocket
+        self.__websocket_url = home_assistant_url.rstrip("/").replace(
+            "http", "ws", 1) + "/api/websocket"
+        self.__token = home_assistant_token
+        self.__dashboard_index = dashboard_index
+        self.__entity_history = entity_history
+
+        self.__enabled = bool(home_assistant_hub.get("enabled", True))
+
+        if self.__enabled and connect is None:
+            raise Exception(
+                "'home_assistant_hub' is enabled but the 'websockets' package is not installed")
+        self.__reconnect_min_secs = max(0.1, float(
+            home_assistant_hub.get("reconnect_min_secs", 1)))
+        self.__reconnect_max_secs = max(self.__reconnect_min_secs, float(
+            home_assistant_hub.get("reconnect_max_secs", 60)))
+        self.__client_queue_size = max(1, int(
+            home_assistant_hub.get("client_queue_size", 1000)))
+        self.__max_streams = max(1, int(
+            home_assistant_hub.get("max_streams", 32)))
+        self.__keepalive_secs = max(1, int(
+            home_assistant_hub.get("keepalive_secs", 15)))
+        self.__history_size = max(0, int(
+            home_assistant_hub.get("history_size", 1000)))
+        self.__service_call_timeout_secs = float(
+            home_assistant_hub.get("service_call_timeout_secs", 10))
+        self.__coalesce_window_secs = max(0, int(
+            home_assistant_hub.get("coalesce_window_ms", 150))) / 1000
+
+        # Domains (any of their services) and domain.service names panels may call
+        self.__allowed_services: set[str] = {
+            str(name).lower()
+            for name in home_assistant_hub.get("allowed_services", _DEFAULT_ALLOWED_SERVICES) or []
+        }
+
+        # Domain or entity ID -> least seconds between the changes sent for it
+        self.__min_interval_secs: dict[str, float] = {
+            str(key).lower(): max(0.0, float(value))
+            for key, value in (home_assistant_hub.get("min_interval_secs") or {}).items()
+        }
+
+        # Entity ID -> entity state, replaced (never changed in place) when an entity changes
+        self.__entities: dict[str, dict] = {}
+        self.__connected = False
+
+        # Entity ID -> latest state not sent yet (None if removed), replaced by any newer change
+        self.__pending_updates: dict[str, Optional[dict]] = {}
+
+        # Entity ID -> monotonic time its last change was sent, for the minimum intervals
+        self.__sent_at: dict[str, float] = {}
+
+        # The timer that sends the pending updates, only used on the hub's loop
+        self.__flush_handle: Optional[asyncio.TimerHandle] = None
+
+        # Deltas are numbered from 1 each time the server starts, the epoch tells the runs apart
+        self.__epoch = uuid.uuid4().hex[:8]
+
+        # Dashboard ID -> its topic, None for the topic with every entity
+        self.__topics: dict[Optional[int], _Topic] = {
+            None: _Topic(None, None, self.__epoch, self.__history_size)}
+
+        # Counts the dashboard topics made, each is dropped when its last client leaves
+        self.__topics_created = 0
+
+        # Guards the entities, topics and stats, shared by the hub and request threads
+        self.__lock = threading.Lock()
+
+        # Counts dashboard changes, so a topic created from an older lookup is refreshed
+        self.__routing_changes = 0
+
+        # Only used on the hub's loop, one topic refresh at a time
+        self.__refresh_lock = asyncio.Lock()
+
+        self.__thread: Optional[threading.Thread] = None
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__stop_event: Optional[asyncio.Event] = None
+        self.__websocket: Any = None
+
+        # Message ID -> future for the service calls waiting on a result
+        self.__pending: dict[int, asyncio.Future] = {}
+        self.__next_id = _SUBSCRIBE_ENTITIES_ID + 1
+
+        self.__connects = 0
+        self.__connect_failures = 0
+        self.__events_received = 0
+        self.__updates_received = 0
+        self.__updates_dropped = 0
+        self.__updates_delivered = 0
+        self.__events_sent = 0
+        self.__deltas = 0
+        self.__resyncs = 0
+        self.__replays = 0
+        self.__streams_refused = 0
+        self.__service_calls = 0
+        self.__service_calls_refused = 0
+
+    def is_enabled(self) -> bool:
+        return self.__enabled
+
+    def get_keepalive_secs(self) -> int:
+        return self.__keepalive_secs
+
+    def get_max_streams(self) -> int:
+        return self.__max_streams
+
+    def start(self) -> None:
+        if not self.__enabled:
+            self.logger.warning(
+                "home assistant hub is disabled, panels will not get any entities")
+            return
+
+        if self.__thread is not None:
+            return
+
+        # Daemon thread so it never holds up the process exiting
+        self.__thread = threading.Thread(
+            target=self.__run_loop, name="home-assistant-hub", daemon=True)
+        self.__thread.start()
+
+        self.__dashboard_index.subscribe(self.__dashboard_changed)
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        loop = self.__loop
+
+        # Also called at exit, when the hub may already have been stopped
+        if loop is not None and not loop.is_closed() and self.__stop_event is not None:
+            loop.call_soon_threadsafe(self.__stop_event.set)
+
+        self.__dashboard_index.unsubscribe(self.__dashboard_changed)
+
+        with self.__lock:
+            clients = [client for topic in self.__topics.values()
+                       for client in topic.clients]
+
+            for topic in self.__topics.values():
+                topic.clients.clear()
+
+        for client in clients:
+            client.close()
+
+    def __run_loop(self) -> None:
+        self.__loop = asyncio.new_event_loop()
+
+        try:
+            self.__loop.run_until_complete(self.__run())
+        finally:
+            self.__loop.close()
+
+    async def __run(self) -> None:
+        self.__stop_event = asyncio.Event()
+        failures = 0
+
+        while not self.__stop_event.is_set():
+            try:
+                await self.__connect_and_receive()
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                self.logger.warning(
+                    f"home assistant connection failed: {error}")
+                failures += 1
+
+                with self.__lock:
+                    self.__connect_failures += 1
+
+            self.__set_connected(False)
+
+            # Double the delay after each failure, with jitter so servers don't all retry together
+            delay = min(self.__reconnect_max_secs,
+                        self.__reconnect_min_secs * (2 ** min(failures, 16)))
+            delay *= random.uniform(0.5, 1.0)
+
+            try:
+                await asyncio.wait_for(self.__stop_event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __connect_and_receive(self) -> None:
+        async with connect(self.__websocket_url, max_size=None, open_timeout=10) as websocket:
+            message = json.loads(await websocket.recv())
+
+            if message.get("type") != "auth_required":
+                raise Exception(f"unexpected message '{message.get('type')}'")
+
+            await websocket.send(json.dumps({"type": "auth", "access_token": self.__token}))
+            message = json.loads(await websocket.recv())
+
+            if message.get("type") != "auth_ok":
+                raise Exception(message.get(
+                    "message", "authentication failed"))
+
+            await websocket.send(json.dumps({"id": _SUBSCRIBE_ENTITIES_ID, "type": "subscribe_entities"}))
+
+            self.__websocket = websocket
+            self.__next_id = _SUBSCRIBE_ENTITIES_ID + 1
+
+            with self.__lock:
+                self.__connects += 1
+
+            # The first event holds every entity and replaces whatever was known before
+            full_update = True
+            stop_task = asyncio.ensure_future(self.__stop_event.wait())
+
+            try:
+                while True:
+                    receive_task = asyncio.ensure_future(websocket.recv())
+                    done, _ = await asyncio.wait(
+                        [receive_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+
+                    if stop_task in done:
+                        receive_task.cancel()
+                        return
+
+                    message = json.loads(receive_task.result())
+
+                    if message.get("type") == "event" and message.get("id") == _SUBSCRIBE_ENTITIES_ID:
+                        self.__on_entities_event(
+                            message.get("event", {}), full_update)
+                        full_update = False
+                    elif message.get("type") == "result":
+                        self.__on_result(message)
+            finally:
+                stop_task.cancel()
+                self.__websocket = None
+
+                # Service calls still waiting will never get their result
+                for future in self.__pending.values():
+                    if not future.done():
+                        future.set_exception(
+                            HomeAssistantUnavailableException(HOME_ASSISTANT_UNAVAILABLE))
+
+                self.__pending.clear()
+
+    def __on_result(self, message: dict) -> None:
+        future = self.__pending.pop(message.get("id"), None)
+
+        if future is None or future.done():
+            return
+
+        if message.get("success"):
+            future.set_result(message.get("result"))
+        else:
+            error = message.get("error") or {}
+            future.set_exception(HomeAssistantServiceCallException(
+                error.get("message", "service call failed")))
+
+    def __on_entities_event(self, event: dict, full_update: bool) -> None:
+        with self.__lock:
+            self.__events_received += 1
+
+            # Entity ID -> new state, None if the entity was removed
+            updates: dict[str, Optional[dict]] = {}
+
+            if full_update:
+                # Entities that went while the connection was down are removed
+                updates = {entity_id: None for entity_id in self.__entities}
+
+            for entity_id, compressed in event.get("a", {}).items():
+                updates[entity_id] = _expand_entity(entity_id, compressed)
+
+            for entity_id, change in event.get("c", {}).items():
+                entity = updates.get(
+                    entity_id) or self.__get_latest(entity_id)
+
+                # A change to an entity that was never added can't be applied
+                if entity is not None:
+                    updates[entity_id] = _apply_entity_change(entity, change)
+
+            for entity_id in event.get("r", []):
+                updates[entity_id] = None
+
+            self.__updates_received += len(updates)
+
+            if full_update:
+                # Replaces everything still waiting to be sent
+                self.__updates_dropped += len(self.__pending_updates)
+                self.__pending_updates.clear()
+
+            for entity_id, entity in updates.items():
+                if entity_id in self.__pending_updates:
+                    self.__updates_dropped += 1
+
+                self.__pending_updates[entity_id] = entity
+
+        # Every change goes into the history, even those coalesced away
+        for entity_id, entity in updates.items():
+            if entity is None:
+                self.__entity_history.forget(entity_id)
+            else:
+                self.__entity_history.record(entity_id, entity["state"])
+
+        if full_update or self.__coalesce_window_secs == 0:
+            # Panels need the full set of entities straight away after a reconnect
+            self.__flush(full_update)
+        elif self.__flush_handle is None:
+            self.__flush_handle = asyncio.get_running_loop().call_later(
+                self.__coalesce_window_secs, self.__flush)
+
+        if full_update:
+            self.__set_connected(True)
+
+    def __get_latest(self, entity_id: str) -> Optional[dict]:
+        # Must hold the lock. The newest state of an entity, including a change not sent yet.
+        if entity_id in self.__pending_updates:
+            return self.__pending_updates[entity_id]
+
+        return self.__entities.get(entity_id)
+
+    def __get_min_interval(self, entity_id: str) -> float:
+        # The entity's own interval wins over its domain's
+        interval = self.__min_interval_secs.get(entity_id)
+
+        if interval is None:
+            interval = self.__min_interval_secs.get(
+                entity_id.split(".", 1)[0], 0)
+
+        return interval
+
+    def __flush(self, force: bool = False) -> None:
+        # Runs on the hub's loop. Sends the pending updates that are due as one delta per topic.
+        if self.__flush_handle is not None:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+
+        now = time.monotonic()
+        next_due: Optional[float] = None
+
+        with self.__lock:
+            updates: dict[str, Optional[dict]] = {}
+
+            for entity_id, entity in list(self.__pending_updates.items()):
+                # Entities added or removed are always sent, only changes are held back
+                if not force and entity is not None and entity_id in self.__entities:
+                    sent_at = self.__sent_at.get(entity_id)
+                    interval = self.__get_min_interval(entity_id)
+
+                    if sent_at is not None and sent_at + interval > now:
+                        due = sent_at + interval
+                        next_due = due if next_due is None else min(
+                            next_due, due)
+                        continue
+
+                del self.__pending_updates[entity_id]
+                updates[entity_id] = entity
+
+                if entity is None:
+                    self.__sent_at.pop(entity_id, None)
+                else:
+                    self.__sent_at[entity_id] = now
+
+            self.__updates_delivered += len(updates)
+            self.__apply_updates(updates)
+
+        if next_due is not None:
+            # Held back changes are sent in a later window once their interval is up
+            self.__flush_handle = asyncio.get_running_loop().call_later(
+                max(self.__coalesce_window_secs, next_due - now), self.__flush)
+
+    def __apply_updates(self, updates: dict[str, Optional[dict]]) -> None:
+        # Must hold the lock. Sends each topic one delta with the differences for its entities.
+        # Entity ID -> ("added", entity), ("changed", diff) or ("removed", None)
+        parts: dict[str, tuple[str, Any]] = {}
+
+        for entity_id, entity in updates.items():
+            old = self.__entities.get(entity_id)
+
+            if entity is None:
+                if old is not None:
+                    del self.__entities[entity_id]
+                    parts[entity_id] = ("removed", None)
+            elif old is None:
+                self.__entities[entity_id] = entity
+                parts[entity_id] = ("added", entity)
+            else:
+                self.__entities[entity_id] = entity
+                diff = _diff_entity(old, entity)
+
+                if len(diff) > 0:
+                    parts[entity_id] = ("changed", diff)
+
+        if len(parts) == 0:
+            return
+
+        # Topic -> the parts for the entities its dashboard uses
+        topic_parts: dict[Optional[int], dict[str, tuple[str, Any]]] = {
+            None: parts}
+
+        for topic in self.__topics.values():
+            if topic.dashboard_id is not None:
+                for entity_id, part in parts.items():
+                    if topic.uses(entity_id):
+                        topic_parts.setdefault(topic.dashboard_id, {})[
+                            entity_id] = part
+
+        for dashboard_id, entity_parts in topic_parts.items():
+            self.__send_delta(self.__topics[dashboard_id], entity_parts)
+
+    def __send_delta(self, topic: _Topic, parts: dict[str, tuple[str, Any]]) -> None:
+        # Must hold the lock
+        topic.seq += 1
+        topic.snapshot_event = None
+        self.__deltas += 1
+
+        # Nobody to send it to or keep it for
+        if len(topic.clients) == 0 and self.__history_size == 0:
+            return
+
+        delta: dict[str, Any] = {"seq": topic.seq}
+        removed: list[str] = []
+
+        for entity_id, (kind, value) in parts.items():
+            if kind == "removed":
+                removed.append(entity_id)
+            else:
+                delta.setdefault(kind, {})[entity_id] = value
+
+        if len(removed) > 0:
+            delta["removed"] = removed
+
+        event = _format_event("delta", delta, topic.get_event_id())
+
+        if self.__history_size > 0:
+            topic.history.append((topic.seq, event))
+
+        self.__publish(topic, event)
+
+    def __dashboard_changed(self, dashboard_id: Optional[int]) -> None:
+        # Called by the dashboard index, maybe with the data lock held, so hand it to the hub's loop
+        self.__routing_changes += 1
+        loop = self.__loop
+
+        if loop is not None and not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(
+                self.__refresh_topics(dashboard_id), loop)
+
+    async def __refresh_topics(self, dashboard_id: Optional[int]) -> None:
+        # An older lookup must never replace a newer one
+        async with self.__refresh_lock:
+            with self.__lock:
+                # None when the whole index was rebuilt, any dashboard may have changed
+                dashboard_ids = [topic_id for topic_id in self.__topics if topic_id is not None] \
+                    if dashboard_id is None else [dashboard_id]
+
+            loop = asyncio.get_running_loop()
+
+            for topic_id in dashboard_ids:
+                # The index may wait on the data lock, so look up off the loop and without the hub lock
+                entity_patterns = await loop.run_in_executor(
+                    None, self.__dashboard_index.get_dashboard_entities, topic_id)
+
+                with self.__lock:
+                    self.__update_topic(topic_id, entity_patterns)
+
+    def __update_topic(self, dashboard_id: int, entity_patterns: Optional[set[str]]) -> None:
+        # Must hold the lock
+        topic = self.__topics.get(dashboard_id)
+
+        if topic is None:
+            return
+
+        if entity_patterns is None:
+            # Deleted, its panels reconnect and are told it is gone
+            del self.__topics[dashboard_id]
+
+            for client in topic.clients:
+                client.close()
+        elif entity_patterns != topic.entity_patterns:
+            topic.reset(entity_patterns)
+
+            for client in topic.clients:
+                client.resync()
+
+    def __set_connected(self, connected: bool) -> None:
+        with self.__lock:
+            if self.__connected == connected:
+                return
+
+            self.__connected = connected
+            event = _format_event("status", {"connected": connected})
+
+            for topic in self.__topics.values():
+                topic.snapshot_event = None
+                self.__publish(topic, event)
+
+    def __get_topic_entities(self, topic: _Topic) -> dict[str, dict]:
+        # Must hold the lock
+        if topic.dashboard_id is None:
+            return self.__entities
+
+        return {
+            entity_id: entity for entity_id, entity in self.__entities.items()
+            if topic.uses(entity_id)
+        }
+
+    def __get_snapshot_event(self, topic: _Topic) -> str:
+        # Must hold the lock
+        if topic.snapshot_event is None:
+            topic.snapshot_event = _format_event("snapshot", {
+                "seq": topic.seq,
+                "connected": self.__connected,
+                "entities": self.__get_topic_entities(topic)
+            }, topic.get_event_id())
+
+        return topic.snapshot_event
+
+    def __publish(self, topic: _Topic, event: str) -> None:
+        # Must hold the lock
+        for client in topic.clients:
+            if client.put(event):
+                self.__events_sent += 1
+
+    def __get_replay(self, topic: _Topic, last_event_id: Optional[str]) -> Optional[list[str]]:
+        # Must hold the lock. The deltas after the last event a panel had, None if they aren't all kept.
+        if last_event_id is None:
+            return None
+
+        prefix, _, seq = last_event_id.rpartition("-")
+
+        if prefix != topic.event_id_prefix or not seq.isdigit() or int(seq) > topic.seq:
+            return None
+
+        seq = int(seq)
+
+        if seq == topic.seq:
+            return []
+
+        if len(topic.history) == 0 or topic.history[0][0] > seq + 1:
+            return None
+
+        return [event for event_seq, event in topic.history if event_seq > seq]
+
+    def subscribe(self, dashboard_id: Optional[int] = None, last_event_id: Optional[str] = None) -> HubClient:
+        """
+        Adds a client whose first event is a snapshot of the entities the dashboard uses (every
+        entity when no dashboard is given), followed by the changes made after the snapshot. A
+        client that had been connected before can pass the ID of the last event it got, and is
+        sent just the deltas it missed when they are still kept.
+        """
+
+        entity_patterns = None
+
+        # Looked up before taking the lock, the index may wait on the data lock
+        routing_changes = self.__routing_changes
+
+        if dashboard_id is not None:
+            entity_patterns = self.__dashboard_index.get_dashboard_entities(
+                dashboard_id)
+
+            if entity_patterns is None:
+                raise DashboardNotFoundException(DASHBOARD_NOT_FOUND)
+
+        client = HubClient(self.__client_queue_size, dashboard_id)
+
+        with self.__lock:
+            # Each stream holds a server thread, leave some for every other request
+            if sum(len(topic.clients) for topic in self.__topics.values()) >= self.__max_streams:
+                self.__streams_refused += 1
+                raise ServerBusyException(SERVER_BUSY)
+
+            topic = self.__topics.get(dashboard_id)
+
+            if topic is None:
+                self.__topics_created += 1
+                topic = _Topic(dashboard_id, entity_patterns, self.__epoch,
+                               self.__history_size, self.__topics_created)
+                self.__topics[dashboard_id] = topic
+
+                # A dashboard changed since the lookup, check the new topic didn't miss it
+                if routing_changes != self.__routing_changes:
+                    self.__dashboard_changed(dashboard_id)
+
+            replay = self.__get_replay(topic, last_event_id)
+
+            if replay is None:
+                client.put(self.__get_snapshot_event(topic))
+            else:
+                self.__replays += 1
+
+                # Still connected or not, the panel can't tell from the deltas alone
+                client.put(_format_event(
+                    "status", {"connected": self.__connected}))
+
+                for event in replay:
+                    client.put(event)
+
+            topic.clients.add(client)
+
+        return client
+
+    def take(self, client: HubClient, timeout_secs: float) -> list[str]:
+        """
+        The events waiting for a client, or a new snapshot if the client fell too far behind.
+        """
+
+        if client.needs_resync():
+            with self.__lock:
+                topic = self.__topics.get(client.get_dashboard_id())
+
+                # Under the lock so no delta is queued between the snapshot and those after it
+                if topic is None:
+                    client.close()
+                elif client.restart(self.__get_snapshot_event(topic)):
+                    self.__resyncs += 1
+
+        return client.take(timeout_secs)
+
+    def unsubscribe(self, client: HubClient) -> None:
+        client.close()
+
+        with self.__lock:
+            topic = self.__topics.get(client.get_dashboard_id())
+
+            if topic is not None:
+                topic.clients.discard(client)
+
+                # Nothing routes to a dashboard no panel shows, subscribe builds it again
+                if topic.dashboard_id is not None and len(topic.clients) == 0:
+                    del self.__topics[topic.dashboard_id]
+
+    def get_entities(self) -> dict[str, dict]:
+        with self.__lock:
+            return dict(self.__entities)
+
+    async def __call_service(self, domain: str, service_name: str, service_data: dict) -> Any:
+        websocket = self.__websocket
+
+        if websocket is None:
+            raise HomeAssistantUnavailableException(HOME_ASSISTANT_UNAVAILABLE)
+
+        message_id = self.__next_id
+        self.__next_id += 1
+
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[message_id] = future
+
+        try:
+            await websocket.send(json.dumps({
+                "id": message_id,
+                "type": "call_service",
+                "domain": domain,
+                "service": service_name,
+                "service_data": service_data
+            }))
+
+            return await asyncio.wait_for(future, self.__service_call_timeout_secs)
+        except asyncio.TimeoutError:
+            raise HomeAssistantTimeoutException(HOME_ASSISTANT_TIMEOUT)
+        finally:
+            self.__pending.pop(message_id, None)
+
+    def is_service_allowed(self, domain: str, service_name: str) -> bool:
+        domain = domain.lower()
+        return domain in self.__allowed_services or f"{domain}.{service_name.lower()}" in self.__allowed_services
+
+    def call_service(self, domain: str, service_name: str, service_data: dict) -> Any:
+        # Called from request threads, the call itself is made on the hub's loop. Panels can only
+        # call the allowed services, so a user can't e.g. restart home assistant or open a lock.
+        if not self.is_service_allowed(domain, service_name):
+            with self.__lock:
+                self.__service_calls_refused += 1
+
+            raise HomeAssistantServiceNotAllowedException(
+                HOME_ASSISTANT_SERVICE_NOT_ALLOWED)
+
+        loop = self.__loop
+
+        if loop is None or not self.__connected:
+            raise HomeAssistantUnavailableException(HOME_ASSISTANT_UNAVAILABLE)
+
+        with self.__lock:
+            self.__service_calls += 1
+
+        future = asyncio.run_coroutine_threadsafe(
+            self.__call_service(domain, service_name, service_data), loop)
+
+        try:
+            # A little longer than the call's own timeout so its error is the one raised
+            return future.result(self.__service_call_timeout_secs + 1)
+        except TimeoutError:
+            future.cancel()
+            raise HomeAssistantTimeoutException(HOME_ASSISTANT_TIMEOUT)
+
+    def get_stats(self) -> dict:
+        with self.__lock:
+            return {
+                "enabled": self.__enabled,
+                "connected": self.__connected,
+                "connects": self.__connects,
+                "connectFailures": self.__connect_failures,
+                "entities": len(self.__entities),
+                "clients": sum(len(topic.clients) for topic in self.__topics.values()),
+                "topics": len(self.__topics),
+                "streamsRefused": self.__streams_refused,
+                "eventsReceived": self.__events_received,
+                "updatesReceived": self.__updates_received,
+                "updatesDropped": self.__updates_dropped,
+                "updatesDelivered": self.__updates_delivered,
+                "updatesPending": len(self.__pending_updates),
+                "eventsSent": self.__events_sent,
+                "deltas": self.__deltas,
+                "resyncs": self.__resyncs,
+                "replays": self.__replays,
+                "serviceCalls": self.__service_calls,
+                "serviceCallsRefused": self.__service_calls_refused
+            }
@@ -0,0 +1,151 @@
+import gzip
+import hashlib
+from typing import Optional
+from flask import Request, Response
+
+try:
+    import brotli
+except ImportError:
+    # Brotli variants are only offered when the package is installed
+    brotli = None
+
+ENCODING_IDENTITY = "identity"
+ENCODING_GZIP = "gzip"
+ENCODING_BROTLI = "br"
+
+# Bodies smaller than this aren't worth compressing
+_MIN_COMPRESS_SIZE = 256
+
+
+def compute_etag(content: bytes) -> str:
+    # Strong ETag, changes whenever a single byte of the content changes
+    return '"' + hashlib.blake2b(content, digest_size=16).hexdigest() + '"'
+
+
+def _parse_accept_encoding(accept_encoding: str) -> dict[str, float]:
+    encodings = {}
+
+    for item in accept_encoding.split(","):
+        parts = item.strip().split(";")
+        name = parts[0].strip().lower()
+
+        if len(name) == 0:
+            continue
+
+        quality = 1.0
+        for parameter in parts[1:]:
+            key, _, value = parameter.strip().partition("=")
+
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        encodings[name] = quality
+
+    return encodings
+
+
+def choose_encoding(accept_encoding: Optional[str], available: set[str]) -> str:
+    if not accept_encoding:
+        return ENCODING_IDENTITY
+
+    encodings = _parse_accept_encoding(accept_encoding)
+    wildcard = encodings.get("*", 0.0)
+
+    # Brotli is smaller so is preferred when the client accepts both equally
+    best = ENCODING_IDENTITY
+    best_quality = 0.0
+
+    for encoding in (ENCODING_BROTLI, ENCODING_GZIP):
+        if encoding not in available:
+            continue
+
+        quality = encodings.get(encoding, wildcard)
+
+        if quality > best_quality:
+            best = encoding
+            best_quality = quality
+
+    return best
+
+
+def if_none_match(request: Request, etag: str) -> bool:
+    header = request.headers.get("If-None-Match")
+
+    if header is None:
+        return False
+
+    if header.strip() == "*":
+        return True
+
+    # If-None-Match uses the weak comparison, so ignore any W/ prefix
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+
+        if candidate == etag:
+            return True
+
+    return False
+
+
+class CachedContent:
+    """
+    A response body along with its precompressed variants and their ETags, built once and then
+    served to any number of requests.
+    """
+
+    __slots__ = ("mimetype", "bodies", "etags")
+
+    def __init__(self, content: bytes, mimetype: str):
+        self.mimetype = mimetype
+        self.bodies: dict[str, bytes] = {ENCODING_IDENTITY: content}
+
+        if len(content) >= _MIN_COMPRESS_SIZE:
+            gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+
+            if len(gzipped) < len(content):
+                self.bodies[ENCODING_GZIP] = gzipped
+
+            if brotli is not None:
+                brotlied = brotli.compress(content, quality=11)
+
+                if len(brotlied) < len(content):
+                    self.bodies[ENCODING_BROTLI] = brotlied
+
+        # Each encoding is a different representation so it needs its own strong ETag
+        etag = compute_etag(content)
+        self.etags: dict[str, str] = {
+            encoding: etag if encoding == ENCODING_IDENTITY else f'{etag[:-1]}-{encoding}"'
+            for encoding in self.bodies
+        }
+
+    def size(self) -> int:
+        return sum(len(body) for body in self.bodies.values())
+
+    def send(self, request: Request, cache_control: str = "no-cache") -> Response:
+        encoding = choose_encoding(
+            request.headers.get("Accept-Encoding"), set(self.bodies.keys()))
+        etag = self.etags[encoding]
+
+        # Any of our ETags means the client has the current content
+        not_modified = any(if_none_match(request, value)
+                           for value in self.etags.values())
+
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = Response(self.bodies[encoding], mimetype=self.mimetype)
+
+            if encoding != ENCODING_IDENTITY:
+                response.headers["Content-Encoding"] = encoding
+
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = cache_control
+        response.headers["Vary"] = "Accept-Encoding"
+
+        return response
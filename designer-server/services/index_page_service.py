@@ -0,0 +1,131 @@
+import html
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
+from wireup import service
+from services.base import BaseService
+from services.component_service import ComponentService
+from services.http_cache import CachedContent
+
+# The values of these hidden inputs are filled in for each host the page is served to
+_SLOT_PATTERNS = {
+    "api_base_url": re.compile(r'(<input\s+[^>]*id="api-base-url"[^>]*value=")[^"]*(")'),
+    "components_version": re.compile(r'(<input\s+[^>]*id="components-version"[^>]*value=")[^"]*(")')
+}
+
+# The Host header comes from the client so only keep pages for this many hosts
+_MAX_HOSTS = 32
+
+
+@service
+class IndexPageService(BaseService):
+    """
+    Serves index.html with the API base URL and the component manifest version filled in. The file is split at those values once per change of the file, and the rendered
+    (and compressed) page is kept for each host.
+    """
+
+    def __init__(self, component_service: ComponentService):
+        super().__init__()
+
+        self.__component_service = component_service
+
+        # Component manifest version the cached pages were rendered with
+        self.__components_version = ""
+        self.__lock = threading.Lock()
+
+        # (path, mtime, size) of the file the template was parsed from
+        self.__signature: Optional[tuple[str, int, int]] = None
+
+        # Literal text alternating with slot names
+        self.__template: list[str] = []
+
+        self.__pages: OrderedDict[str, CachedContent] = OrderedDict()
+
+        self.__hits = 0
+        self.__misses = 0
+
+    @staticmethod
+    def __parse(content: str) -> list[str]:
+        # Find where each slot's value is, then cut the page at those points
+        cuts = []
+        for name, pattern in _SLOT_PATTERNS.items():
+            for match in pattern.finditer(content):
+                cuts.append((match.end(1), match.start(2), name))
+
+        cuts.sort()
+
+        template = []
+        position = 0
+        for start, end, name in cuts:
+            template.append(content[position:start])
+            template.append(name)
+            position = end
+
+        template.append(content[position:])
+
+        return template
+
+    def __render(self, host: str) -> bytes:
+        values = {
+            "api_base_url": f"http://{host}",
+            "components_version": self.__components_version
+        }
+
+        # Even entries are literal text, odd entries are slot names
+        parts = [
+            part if i % 2 == 0 else html.escape(values[part], quote=True)
+            for i, part in enumerate(self.__template)
+        ]
+
+        return "".join(parts).encode("utf-8")
+
+    def get(self, index_path: str, host: str) -> Optional[CachedContent]:
+        try:
+            stat = os.stat(index_path)
+        except FileNotFoundError:
+            return None
+
+        signature = (index_path, stat.st_mtime_ns, stat.st_size)
+
+        components_version = self.__component_service.get_manifest(
+            os.path.dirname(index_path))["version"]
+
+        with self.__lock:
+            if components_version != self.__components_version:
+                self.__components_version = components_version
+                self.__pages.clear()
+
+            if signature != self.__signature:
+                with open(index_path, "r", encoding="utf-8") as f:
+                    self.__template = IndexPageService.__parse(f.read())
+
+                self.__signature = signature
+                self.__pages.clear()
+
+            page = self.__pages.get(host)
+
+            if page is not None:
+                self.__pages.move_to_end(host)
+                self.__hits += 1
+                return page
+
+            self.__misses += 1
+
+            page = CachedContent(self.__render(host), "text/html")
+
+            self.__pages[host] = page
+
+            while len(self.__pages) > _MAX_HOSTS:
+                self.__pages.popitem(last=False)
+
+            return page
+
+    def get_stats(self) -> dict:
+        with self.__lock:
+            return {
+                "entries": len(self.__pages),
+                "hits": self.__hits,
+                "misses": self.__misses
+            }
@@ -0,0 +1,344 @@
+import heapq
+import json
+import os
+import tempfile
+import threading
+import uuid
+from typing import Any, Callable, Iterable, Optional
+from pysondb import db
+from pysondb.errors.db_errors import IdNotFoundError
+from services.rw_lock import ReentrantReadWriteLock
+
+# Durability levels used when writing a table file
+DURABILITY_FULL = "full"  # fsync the file and its directory entry
+DURABILITY_NORMAL = "normal"  # fsync the file
+DURABILITY_OFF = "off"  # leave it to the operating system to write the file
+
+
+def _is_indexable(value: Any) -> bool:
+    # Only scalar values are indexed, queries on anything else fall back to a scan
+    return value is None or isinstance(value, (str, int, float, bool))
+
+
+def new_record_id() -> int:
+    # Same ID scheme as pysondb so existing and new records look the same
+    return int(str(uuid.uuid4().int)[:18])
+
+
+def _atomic_write_json(file_name: str, data: dict, durability: str) -> None:
+    _atomic_write_text(file_name, json.dumps(
+        data, indent=3, ensure_ascii=False), durability)
+
+
+def _serialize_record(record: dict) -> str:
+    # Laid out as it would be inside the data list of the file
+    return json.dumps(record, indent=3, ensure_ascii=False).replace("\n", "\n      ")
+
+
+def _join_serialized_records(serialized_records: list[str]) -> str:
+    # Same text json.dump produces for {"data": [...]} with an indent of 3
+    if len(serialized_records) == 0:
+        return '{\n   "data": []\n}'
+
+    return '{\n   "data": [\n      ' + ',\n      '.join(serialized_records) + '\n   ]\n}'
+
+
+def _atomic_write_text(file_name: str, text: str, durability: str) -> None:
+    directory = os.path.dirname(os.path.abspath(file_name))
+
+    # Write to a temporary file in the same directory so the rename is atomic
+    fd, temp_file_name = tempfile.mkstemp(
+        prefix=f".{os.path.basename(file_name)}.", suffix=".tmp", dir=directory)
+
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+
+            if durability != DURABILITY_OFF:
+                os.fsync(f.fileno())
+
+        # Keep the permissions of the file being replaced (mkstemp creates it as owner only)
+        if os.path.exists(file_name):
+            os.chmod(temp_file_name, os.stat(file_name).st_mode)
+
+        os.replace(temp_file_name, file_name)
+    except BaseException:
+        # Don't leave partial temporary files behind
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+
+    if durability == DURABILITY_FULL:
+        # Make sure the rename itself is persisted
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class IndexedJsonTable:
+    """
+    Wraps a pysondb JSON database, keeping an in-memory copy of its records together with
+    hash indexes on the configured fields so that equality lookups do not need to scan the file.
+
+    In write through mode every change rewrites the file (changes made inside an enclosing write
+    block are written when it ends). In write back mode changes are only held in memory and
+    marked dirty, the owner then calls flush() to write them all at once.
+
+    Tables with large records can keep the serialized text of each record, so writing the file
+    only serializes the records that changed since the last write.
+    """
+
+    def __init__(
+            self,
+            json_db: db.JsonDatabase,
+            indexed_fields: Iterable[str] = (),
+            write_back: bool = False,
+            durability: str = DURABILITY_NORMAL,
+            on_dirty: Optional[Callable[[], None]] = None,
+            lock: Optional[ReentrantReadWriteLock] = None,
+            cache_serialized: bool = False):
+        self.__db = json_db
+
+        # Tables owned by a data service share its lock
+        self.__lock = lock if lock is not None else ReentrantReadWriteLock()
+        self.__flush_lock = threading.Lock()
+        self.__write_back = write_back
+        self.__durability = durability
+        self.__on_dirty = on_dirty
+        self.__dirty = False
+
+        # Incremented on every change so callers can tell when cached views are stale
+        self.__version = 0
+
+        # Records keyed by their ID (insertion ordered, same as the file)
+        self.__records: dict[int, dict] = {}
+
+        # Record ID -> serialized record, when enabled
+        self.__serialized: Optional[dict[int, str]] = {} if cache_serialized else None
+
+        # For each indexed field: field value -> {record ID -> record}
+        self.__indexes: dict[str, dict[Any, dict[int, dict]]] = {
+            field: {} for field in indexed_fields}
+
+        self.__load()
+
+    def __load(self) -> None:
+        with self.__lock.write():
+            self.__records.clear()
+
+            for index in self.__indexes.values():
+                index.clear()
+
+            if self.__serialized is not None:
+                self.__serialized.clear()
+
+            for record in self.__db.getAll():
+                self.__records[record["id"]] = record
+                self.__index_record(record)
+
+    def __changed(self) -> None:
+        # Called after the write lock has been released. If an enclosing write block still
+        # holds the lock the owner writes the file when that block ends, so a block of changes
+        # is one write even in write through mode.
+        if not self.__write_back and not self.__lock.is_write_locked_by_current_thread():
+            self.flush()
+        elif self.__on_dirty is not None:
+            self.__on_dirty()
+
+    def is_dirty(self) -> bool:
+        return self.__dirty
+
+    def get_version(self) -> int:
+        return self.__version
+
+    def get_external_version(self) -> int:
+        # The data service lock file stops other processes using the same files
+        return 0
+
+    def flush(self) -> None:
+        # Only a read lock is needed, changes can't be made while it is held
+        with self.__flush_lock, self.__lock.read():
+            if not self.__dirty:
+                return
+
+            if self.__serialized is None:
+                # Same file layout as pysondb
+                _atomic_write_json(
+                    self.__db.filename,
+                    {"data": list(self.__records.values())},
+                    self.__durability)
+            else:
+                _atomic_write_text(
+                    self.__db.filename,
+                    _join_serialized_records(
+                        [self.__get_serialized(record) for record in self.__records.values()]),
+                    self.__durability)
+
+            self.__dirty = False
+
+    def __get_serialized(self, record: dict) -> str:
+        serialized = self.__serialized.get(record["id"])
+
+        if serialized is None:
+            serialized = _serialize_record(record)
+            self.__serialized[record["id"]] = serialized
+
+        return serialized
+
+    def __index_record(self, record: dict) -> None:
+        for field, index in self.__indexes.items():
+            if field not in record:
+                continue
+
+            value = record[field]
+
+            if not _is_indexable(value):
+                continue
+
+            index.setdefault(value, {})[record["id"]] = record
+
+    def __unindex_record(self, record: dict) -> None:
+        for field, index in self.__indexes.items():
+            if field not in record:
+                continue
+
+            value = record[field]
+
+            if not _is_indexable(value):
+                continue
+
+            bucket = index.get(value)
+            if bucket is None:
+                continue
+
+            bucket.pop(record["id"], None)
+
+            # Don't keep empty buckets around
+            if len(bucket) == 0:
+                del index[value]
+
+    def __candidates(self, query: dict[str, Any]) -> Iterable[dict]:
+        # Use the first indexed field in the query to narrow the candidates
+        for field, value in query.items():
+            index = self.__indexes.get(field)
+
+            if index is None:
+                continue
+
+            if not _is_indexable(value):
+                continue
+
+            return index.get(value, {}).values()
+
+        # No usable index so scan all records
+        return self.__records.values()
+
+    def __forget_serialized(self, record_id: int) -> None:
+        if self.__serialized is not None:
+            self.__serialized.pop(record_id, None)
+
+    def count(self) -> int:
+        with self.__lock.read():
+            return len(self.__records)
+
+    def getAll(self) -> list[dict]:
+        with self.__lock.read():
+            return [dict(record) for record in self.__records.values()]
+
+    def getBy(self, query: dict[str, Any]) -> list[dict]:
+        with self.__lock.read():
+            return [
+                dict(record) for record in self.__candidates(query)
+                if all(field in record and record[field] == value for field, value in query.items())
+            ]
+
+    def getAllFields(self, fields: Iterable[str]) -> list[dict]:
+        # Only the requested fields (and the ID) of each record, large values aren't copied
+        fields = tuple(fields)
+
+        with self.__lock.read():
+            return [
+                {"id": record["id"], **{field: record.get(field) for field in fields}}
+                for record in self.__records.values()
+            ]
+
+    def getFieldsById(self, pk: int, fields: Iterable[str]) -> dict:
+        with self.__lock.read():
+            record = self.__records.get(int(pk))
+
+            if record is None:
+                raise IdNotFoundError(pk)
+
+            return {"id": record["id"], **{field: record.get(field) for field in fields}}
+
+    def getPage(self, after: Optional[int], limit: int) -> list[dict]:
+        # Records in ID order starting after the given ID, only the page is sorted and copied
+        with self.__lock.read():
+            ids = self.__records.keys() if after is None else (
+                record_id for record_id in self.__records.keys() if record_id > after)
+
+            return [dict(self.__records[record_id]) for record_id in heapq.nsmallest(limit, ids)]
+
+    def getById(self, pk: int) -> dict:
+        with self.__lock.read():
+            record = self.__records.get(int(pk))
+
+            if record is None:
+                raise IdNotFoundError(pk)
+
+            return dict(record)
+
+    def add(self, new_data: dict) -> int:
+        with self.__lock.write():
+            record_id = new_record_id()
+
+            # Callers expect the ID to be set on their dictionary (same as pysondb)
+            new_data["id"] = record_id
+
+            record = dict(new_data)
+            self.__records[record_id] = record
+            self.__index_record(record)
+            self.__forget_serialized(record_id)
+            self.__dirty = True
+            self.__version += 1
+
+        self.__changed()
+
+        return record_id
+
+    def updateById(self, pk: int, new_data: dict) -> None:
+        with self.__lock.write():
+            record = self.__records.get(int(pk))
+
+            if record is None:
+                raise IdNotFoundError(pk)
+
+            # Re-index the record with its updated values
+            self.__unindex_record(record)
+            record.update(new_data)
+            self.__index_record(record)
+            self.__forget_serialized(record["id"])
+            self.__dirty = True
+            self.__version += 1
+
+        self.__changed()
+
+    def deleteById(self, pk: int) -> bool:
+        with self.__lock.write():
+            record = self.__records.get(int(pk))
+
+            if record is None:
+                raise IdNotFoundError(pk)
+
+            self.__unindex_record(record)
+            del self.__records[record["id"]]
+            self.__forget_serialized(record["id"])
+            self.__dirty = True
+            self.__version += 1
+
+        self.__changed()
+
+        return True
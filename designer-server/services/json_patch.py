@@ -0,0 +1,198 @@
+"""
+RFC 6902 JSON Patch. Patches are applied copy on write: only the objects and arrays along the
+paths being changed are copied, everything else is shared with the original document, which is
+never modified.
+"""
+import copy
+from typing import Any
+from exceptions.json_patch_exceptions import JsonPatchException
+
+
+def parse_pointer(pointer: str) -> list[str]:
+    # RFC 6901 JSON Pointer, '' is the whole document
+    if not isinstance(pointer, str):
+        raise JsonPatchException(f"'{pointer}' is not a JSON pointer")
+
+    if pointer == "":
+        return []
+
+    if not pointer.startswith("/"):
+        raise JsonPatchException(f"JSON pointer '{pointer}' must start with '/'")
+
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")]
+
+
+def _array_index(array: list, token: str, allow_end: bool) -> int:
+    if allow_end and token == "-":
+        return len(array)
+
+    # No leading zeros or signs allowed
+    if not token.isdigit() or (len(token) > 1 and token[0] == "0"):
+        raise JsonPatchException(f"'{token}' is not an array index")
+
+    index = int(token)
+    limit = len(array) if allow_end else len(array) - 1
+
+    if index > limit:
+        raise JsonPatchException(f"array index {index} is out of range")
+
+    return index
+
+
+class _Patcher:
+    def __init__(self, document: Any):
+        self.document = document
+
+        # Containers created by this patch can be changed in place, anything else is copied first
+        self.__owned: set[int] = set()
+
+    def __own(self, container: Any) -> Any:
+        if id(container) in self.__owned:
+            return container
+
+        copied = dict(container) if isinstance(container, dict) else list(container)
+        self.__owned.add(id(copied))
+        return copied
+
+    def get(self, tokens: list[str]) -> Any:
+        value = self.document
+
+        for token in tokens:
+            if isinstance(value, dict):
+                if token not in value:
+                    raise JsonPatchException(f"path '/{'/'.join(tokens)}' does not exist")
+                value = value[token]
+            elif isinstance(value, list):
+                value = value[_array_index(value, token, False)]
+            else:
+                raise JsonPatchException(f"path '/{'/'.join(tokens)}' does not exist")
+
+        return value
+
+    def __parent(self, tokens: list[str]) -> Any:
+        # Copies every container from the root down to the parent of the target
+        self.document = self.__own(self.document)
+        parent = self.document
+
+        for token in tokens[:-1]:
+            if isinstance(parent, dict):
+                if token not in parent:
+                    raise JsonPatchException(f"path '/{'/'.join(tokens)}' does not exist")
+                child = parent[token]
+            elif isinstance(parent, list):
+                index = _array_index(parent, token, False)
+                child = parent[index]
+                token = index
+            else:
+                raise JsonPatchException(f"path '/{'/'.join(tokens)}' does not exist")
+
+            if not isinstance(child, (dict, list)):
+                raise JsonPatchException(f"path '/{'/'.join(tokens)}' does not exist")
+
+            child = self.__own(child)
+            parent[token] = child
+            parent = child
+
+        return parent
+
+    def add(self, tokens: list[str], value: Any) -> None:
+        if len(tokens) == 0:
+            self.document = value
+            return
+
+        parent = self.__parent(tokens)
+
+        if isinstance(parent, dict):
+            parent[tokens[-1]] = value
+        elif isinstance(parent, list):
+            parent.insert(_array_index(parent, tokens[-1], True), value)
+        else:
+            raise JsonPatchException(f"path '/{'/'.join(tokens)}' does not exist")
+
+    def remove(self, tokens: list[str]) -> Any:
+        if len(tokens) == 0:
+            raise JsonPatchException("the whole document can't be removed")
+
+        parent = self.__parent(tokens)
+
+        if isinstance(parent, dict):
+            if tokens[-1] not in parent:
+                raise JsonPatchException(f"path '/{'/'.join(tokens)}' does not exist")
+            return parent.pop(tokens[-1])
+
+        if isinstance(parent, list):
+            return parent.pop(_array_index(parent, tokens[-1], False))
+
+        raise JsonPatchException(f"path '/{'/'.join(tokens)}' does not exist")
+
+    def replace(self, tokens: list[str], value: Any) -> None:
+        if len(tokens) == 0:
+            self.document = value
+            return
+
+        # The target must already exist
+        self.get(tokens)
+
+        parent = self.__parent(tokens)
+
+        if isinstance(parent, dict):
+            parent[tokens[-1]] = value
+        else:
+            parent[_array_index(parent, tokens[-1], False)] = value
+
+
+def _get_path(operation: dict, name: str) -> list[str]:
+    if name not in operation:
+        raise JsonPatchException(f"'{operation.get('op')}' operation needs a '{name}'")
+
+    return parse_pointer(operation[name])
+
+
+def apply_patch(document: Any, patch: Any) -> Any:
+    """
+    Returns the patched document. The patch is applied as a whole, if any operation fails an
+    exception is raised and the original document is left as it was.
+    """
+
+    if not isinstance(patch, list):
+        raise JsonPatchException("a JSON patch must be a list of operations")
+
+    patcher = _Patcher(document)
+
+    for operation in patch:
+        if not isinstance(operation, dict):
+            raise JsonPatchException("each JSON patch operation must be an object")
+
+        op = operation.get("op")
+        tokens = _get_path(operation, "path")
+
+        if op in ["add", "replace", "test"] and "value" not in operation:
+            raise JsonPatchException(f"'{op}' operation needs a 'value'")
+
+        if op == "add":
+            patcher.add(tokens, operation["value"])
+        elif op == "remove":
+            patcher.remove(tokens)
+        elif op == "replace":
+            patcher.replace(tokens, operation["value"])
+        elif op == "move":
+            from_tokens = _get_path(operation, "from")
+
+            # Can't move something in to one of its own children
+            if tokens[:len(from_tokens)] == from_tokens and len(tokens) > len(from_tokens):
+                raise JsonPatchException(
+                    "a value can't be moved in to one of its children")
+
+            patcher.add(tokens, patcher.remove(from_tokens))
+        elif op == "copy":
+            # A deep copy so later operations on either place can't change the other
+            patcher.add(tokens, copy.deepcopy(
+                patcher.get(_get_path(operation, "from"))))
+        elif op == "test":
+            if patcher.get(tokens) != operation["value"]:
+                raise JsonPatchException(
+                    f"test failed for path '{operation['path']}'")
+        else:
+            raise JsonPatchException(f"'{op}' is not a JSON patch operation")
+
+    return patcher.document
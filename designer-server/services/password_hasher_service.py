@@ -0,0 +1,115 @@
+import atexit
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from time import perf_counter
+from typing import Annotated, Any, Callable
+import bcrypt
+from wireup import Inject, service
+from config.config import PasswordHashingConfig
+from constants.messages import SERVER_BUSY
+from exceptions.capacity_exceptions import ServerBusyException
+from services.base import BaseService
+
+EXECUTOR_THREAD = "thread"
+EXECUTOR_PROCESS = "process"
+
+
+# The worker functions are module level so they can be sent to a process pool
+def _hash_password(password: str) -> tuple[str, float]:
+    start = perf_counter()
+    hashed_password = bcrypt.hashpw(
+        password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return hashed_password, perf_counter() - start
+
+
+def _check_password(password: str, hashed_password: str) -> tuple[bool, float]:
+    start = perf_counter()
+    result = bcrypt.checkpw(password.encode(
+        'utf-8'), hashed_password.encode('utf-8'))
+    return result, perf_counter() - start
+
+
+@service
+class PasswordHasherService(BaseService):
+    """
+    Runs bcrypt hashing and verification on a bounded worker pool so a burst of logins can't tie up
+    every request thread. When the pool and its queue are full new work is rejected straight away.
+    """
+
+    def __init__(self, password_hashing: Annotated[PasswordHashingConfig, Inject(param="password_hashing")]):
+        super().__init__()
+
+        executor = password_hashing.get("executor", EXECUTOR_THREAD)
+        max_workers = max(1, int(password_hashing.get("max_workers", 2)))
+        max_queue = max(0, int(password_hashing.get("max_queue", 16)))
+
+        if executor not in [EXECUTOR_THREAD, EXECUTOR_PROCESS]:
+            raise Exception(
+                f"'executor' setting '{executor}' must be one of '{EXECUTOR_THREAD}' or '{EXECUTOR_PROCESS}'")
+
+        self.__executor: Executor
+        if executor == EXECUTOR_PROCESS:
+            self.__executor = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            self.__executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="password-hasher")
+
+        atexit.register(self.__executor.shutdown, wait=False)
+
+        # Running plus queued work is capped at this many
+        self.__capacity = max_workers + max_queue
+        self.__slots = threading.BoundedSemaphore(self.__capacity)
+
+        self.__stats_lock = threading.Lock()
+        self.__stats = {
+            "completed": 0,
+            "rejected": 0,
+            "inFlight": 0,
+            "queueWaitSecs": 0.0,
+            "maxQueueWaitSecs": 0.0,
+            "hashSecs": 0.0,
+            "maxHashSecs": 0.0
+        }
+
+    def __run(self, fn: Callable[..., tuple[Any, float]], *args) -> Any:
+        if not self.__slots.acquire(blocking=False):
+            with self.__stats_lock:
+                self.__stats["rejected"] += 1
+
+            raise ServerBusyException(SERVER_BUSY)
+
+        with self.__stats_lock:
+            self.__stats["inFlight"] += 1
+
+        try:
+            start = perf_counter()
+            result, hash_secs = self.__executor.submit(fn, *args).result()
+
+            # Whatever time wasn't spent hashing was spent waiting for a worker
+            queue_wait_secs = max(0.0, perf_counter() - start - hash_secs)
+
+            with self.__stats_lock:
+                self.__stats["completed"] += 1
+                self.__stats["queueWaitSecs"] += queue_wait_secs
+                self.__stats["hashSecs"] += hash_secs
+                self.__stats["maxQueueWaitSecs"] = max(
+                    self.__stats["maxQueueWaitSecs"], queue_wait_secs)
+                self.__stats["maxHashSecs"] = max(
+                    self.__stats["maxHashSecs"], hash_secs)
+
+            return result
+        finally:
+            with self.__stats_lock:
+                self.__stats["inFlight"] -= 1
+
+            self.__slots.release()
+
+    def hash_password(self, password: str) -> str:
+        return self.__run(_hash_password, password)
+
+    def check_password(self, password: str, hashed_password: str) -> bool:
+        return self.__run(_check_password, password, hashed_password)
+
+    def get_stats(self) -> dict:
+        with self.__stats_lock:
+            return {**self.__stats, "capacity": self.__capacity}
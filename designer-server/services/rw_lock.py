@@ -0,0 +1,146 @@
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Iterator, Optional
+
+
+class ReentrantReadWriteLock:
+    """
+    An in-process reader/writer lock. Any number of threads may hold the read lock at the same time,
+    the write lock is exclusive. Both are reentrant, and a thread holding the write lock may also take
+    the read lock. A thread holding only the read lock can't upgrade to the write lock (that would
+    deadlock with another upgrading reader), so it raises instead.
+
+    Waiting writers block new readers so that a steady stream of reads can't starve writes.
+    """
+
+    def __init__(self):
+        self.__condition = threading.Condition(threading.Lock())
+
+        # Thread ID -> read depth for the threads currently holding the read lock
+        self.__readers: dict[int, int] = {}
+
+        self.__writer: Optional[int] = None
+        self.__writer_depth = 0
+        self.__waiting_writers = 0
+
+        # Contention statistics
+        self.__stats = {
+            "read": {"acquired": 0, "contended": 0, "waitSecs": 0.0, "maxWaitSecs": 0.0},
+            "write": {"acquired": 0, "contended": 0, "waitSecs": 0.0, "maxWaitSecs": 0.0}
+        }
+
+    def __record_wait(self, kind: str, start: float, contended: bool) -> None:
+        wait_secs = perf_counter() - start
+        stats = self.__stats[kind]
+        stats["acquired"] += 1
+        stats["waitSecs"] += wait_secs
+
+        if contended:
+            stats["contended"] += 1
+
+        if wait_secs > stats["maxWaitSecs"]:
+            stats["maxWaitSecs"] = wait_secs
+
+    def acquire_read(self) -> None:
+        thread_id = threading.get_ident()
+
+        with self.__condition:
+            # Nested acquisition (or reading while writing) doesn't wait
+            if thread_id in self.__readers or self.__writer == thread_id:
+                self.__readers[thread_id] = self.__readers.get(thread_id, 0) + 1
+                return
+
+            start = perf_counter()
+            contended = False
+
+            while self.__writer is not None or self.__waiting_writers > 0:
+                contended = True
+                self.__condition.wait()
+
+            self.__readers[thread_id] = 1
+            self.__record_wait("read", start, contended)
+
+    def release_read(self) -> None:
+        thread_id = threading.get_ident()
+
+        with self.__condition:
+            depth = self.__readers.get(thread_id)
+
+            if depth is None:
+                raise RuntimeError("cannot release a read lock that is not held")
+
+            if depth > 1:
+                self.__readers[thread_id] = depth - 1
+                return
+
+            del self.__readers[thread_id]
+
+            if len(self.__readers) == 0:
+                self.__condition.notify_all()
+
+    def acquire_write(self) -> None:
+        thread_id = threading.get_ident()
+
+        with self.__condition:
+            if self.__writer == thread_id:
+                self.__writer_depth += 1
+                return
+
+            if thread_id in self.__readers:
+                raise RuntimeError(
+                    "cannot upgrade a read lock to a write lock, take the write lock first")
+
+            start = perf_counter()
+            contended = False
+
+            self.__waiting_writers += 1
+            try:
+                while self.__writer is not None or len(self.__readers) > 0:
+                    contended = True
+                    self.__condition.wait()
+            finally:
+                self.__waiting_writers -= 1
+
+            self.__writer = thread_id
+            self.__writer_depth = 1
+            self.__record_wait("write", start, contended)
+
+    def release_write(self) -> None:
+        with self.__condition:
+            if self.__writer != threading.get_ident():
+                raise RuntimeError("cannot release a write lock that is not held")
+
+            self.__writer_depth -= 1
+
+            if self.__writer_depth == 0:
+                self.__writer = None
+                self.__condition.notify_all()
+
+    def is_write_locked_by_current_thread(self) -> bool:
+        return self.__writer == threading.get_ident()
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+    def get_stats(self) -> dict:
+        with self.__condition:
+            return {
+                "read": dict(self.__stats["read"]),
+                "write": dict(self.__stats["write"]),
+                "readers": len(self.__readers),
+                "waitingWriters": self.__waiting_writers
+            }
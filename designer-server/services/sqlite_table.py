@@ -0,0 +1,382 @@
+import json
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterable, Iterator, Optional
+from pysondb.errors.db_errors import IdNotFoundError
+from services.indexed_json_table import DURABILITY_FULL, DURABILITY_OFF, new_record_id
+from services.rw_lock import ReentrantReadWriteLock
+
+# Table and field names are put in to SQL text so only allow plain identifiers
+_IDENTIFIER_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# Holds a version for each table, bumped in the same transaction as every change to the table
+_VERSIONS_TABLE = "table_versions"
+
+
+def _check_identifier(name: str) -> str:
+    if not _IDENTIFIER_PATTERN.match(name):
+        raise ValueError(f"'{name}' is not a valid table or field name")
+
+    return name
+
+
+class SqliteConnectionPool:
+    """
+    Hands out one SQLite connection per thread (connections can't be shared between threads while
+    in use). Connections use WAL mode so readers in this and other processes don't block a writer.
+    """
+
+    def __init__(self, file_name: str, durability: str, busy_timeout_ms: int):
+        self.__file_name = file_name
+        self.__busy_timeout_ms = int(busy_timeout_ms)
+
+        if durability == DURABILITY_FULL:
+            self.__synchronous = "FULL"
+        elif durability == DURABILITY_OFF:
+            self.__synchronous = "OFF"
+        else:
+            # In WAL mode NORMAL can lose the last commits on power loss, but never corrupts
+            self.__synchronous = "NORMAL"
+
+        self.__local = threading.local()
+        self.__connections: list[sqlite3.Connection] = []
+        self.__connections_lock = threading.Lock()
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, "connection", None)
+
+        if connection is None:
+            # Autocommit mode, transactions are started explicitly by begin()
+            connection = sqlite3.connect(
+                self.__file_name,
+                isolation_level=None,
+                check_same_thread=False,
+                cached_statements=256)
+
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(f"PRAGMA synchronous={self.__synchronous}")
+            connection.execute(
+                f"PRAGMA busy_timeout={self.__busy_timeout_ms}")
+
+            self.__local.connection = connection
+
+            with self.__connections_lock:
+                self.__connections.append(connection)
+
+        return connection
+
+    def begin(self) -> None:
+        connection = self.connection()
+
+        if not connection.in_transaction:
+            # Take the database write lock up front so other processes wait on busy_timeout
+            connection.execute("BEGIN IMMEDIATE")
+
+    def commit(self) -> None:
+        connection = self.connection()
+
+        if connection.in_transaction:
+            connection.execute("COMMIT")
+
+    def rollback(self) -> None:
+        connection = self.connection()
+
+        if connection.in_transaction:
+            connection.execute("ROLLBACK")
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        connection = self.connection()
+
+        # Join the transaction of an enclosing data service write block
+        if connection.in_transaction:
+            yield connection
+            return
+
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        connection.execute("COMMIT")
+
+    def close(self) -> None:
+        with self.__connections_lock:
+            for connection in self.__connections:
+                try:
+                    connection.close()
+                except sqlite3.Error:
+                    pass
+
+            self.__connections.clear()
+
+
+class SqliteTable:
+    """
+    Stores the records of one table as JSON documents in SQLite, with expression indexes on the
+    configured fields. Exposes the same methods as IndexedJsonTable so services don't need to
+    know which storage engine is in use.
+    """
+
+    def __init__(
+            self,
+            pool: SqliteConnectionPool,
+            table_name: str,
+            indexed_fields: Iterable[str] = (),
+            lock: Optional[ReentrantReadWriteLock] = None):
+        self.__pool = pool
+        self.__table_name = _check_identifier(table_name)
+        self.__lock = lock if lock is not None else ReentrantReadWriteLock()
+
+        # Changes made by this process, so a cached version is read again after our own writes
+        self.__local_changes = 0
+
+        # Per thread (as connections are): (data_version, local changes, table version) last read
+        self.__version_cache = threading.local()
+
+        # The table version as of this process's last change or read of it, and how many times
+        # it was found changed by another process sharing the database
+        self.__known_version: Optional[int] = None
+        self.__external_changes = 0
+        self.__known_version_lock = threading.Lock()
+
+        # SQL text for each query shape, always using the same text means sqlite3's per-connection
+        # statement cache hands back the already prepared statement
+        self.__query_sql: dict[tuple[str, ...], str] = {}
+
+        with self.__pool.transaction() as connection:
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.__table_name} (id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {_VERSIONS_TABLE} (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+            connection.execute(
+                f"INSERT OR IGNORE INTO {_VERSIONS_TABLE} (name, version) VALUES (?, 0)", (self.__table_name,))
+
+            for field in indexed_fields:
+                _check_identifier(field)
+                connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS ix_{self.__table_name}_{field} "
+                    f"ON {self.__table_name} (json_extract(data, '$.{field}'))")
+
+    @staticmethod
+    def __to_record(row: tuple[int, str]) -> dict:
+        record = json.loads(row[1])
+        record["id"] = row[0]
+        return record
+
+    @staticmethod
+    def __to_data(record: dict) -> str:
+        return json.dumps({key: value for key, value in record.items() if key != "id"}, ensure_ascii=False)
+
+    def __get_query_sql(self, fields: tuple[str, ...]) -> str:
+        sql = self.__query_sql.get(fields)
+
+        if sql is None:
+            conditions = " AND ".join(
+                f"json_extract(data, '$.{_check_identifier(field)}') = ?" for field in fields)
+            sql = f"SELECT id, data FROM {self.__table_name} WHERE {conditions} ORDER BY id"
+            self.__query_sql[fields] = sql
+
+        return sql
+
+    def is_dirty(self) -> bool:
+        # Changes are written by SQLite as part of each transaction
+        return False
+
+    def flush(self) -> None:
+        pass
+
+    def __changed(self, connection: sqlite3.Connection) -> None:
+        # Must be in the transaction making the change, so other processes see both or neither.
+        # The transaction holds the database write lock so no other process can change the
+        # version between reading and bumping it.
+        version = connection.execute(
+            f"SELECT version FROM {_VERSIONS_TABLE} WHERE name = ?", (self.__table_name,)).fetchone()[0]
+        connection.execute(
+            f"UPDATE {_VERSIONS_TABLE} SET version = version + 1 WHERE name = ?", (self.__table_name,))
+
+        with self.__known_version_lock:
+            self.__check_known_version(version)
+            self.__known_version = version + 1
+
+        self.__local_changes += 1
+
+    def __check_known_version(self, version: int) -> None:
+        # Must hold the known version lock. A version this process didn't write or read before
+        # means another process changed the table (or a change here was rolled back, which is
+        # counted too rather than risk missing a change).
+        if self.__known_version is not None and version != self.__known_version:
+            self.__external_changes += 1
+
+        self.__known_version = version
+
+    def get_version(self) -> int:
+        """
+        A number that changes whenever the table changes, in this process or any other sharing
+        the database, so callers can tell when cached views are stale.
+        """
+
+        connection = self.__pool.connection()
+        local_changes = self.__local_changes
+
+        # Changes when another connection (in this process or another) commits, and is much
+        # cheaper than reading the version table on every call
+        data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+        cached = getattr(self.__version_cache, "value", None)
+
+        if cached is not None and cached[0] == data_version and cached[1] == local_changes:
+            return cached[2]
+
+        version = connection.execute(
+            f"SELECT version FROM {_VERSIONS_TABLE} WHERE name = ?", (self.__table_name,)).fetchone()[0]
+        self.__version_cache.value = (data_version, local_changes, version)
+
+        return version
+
+    def get_external_version(self) -> int:
+        """
+        A number that changes whenever another process sharing the database changes the table,
+        changes made by this process leave it as is.
+        """
+
+        version = self.get_version()
+
+        with self.__known_version_lock:
+            self.__check_known_version(version)
+            return self.__external_changes
+
+    def count(self) -> int:
+        with self.__lock.read():
+            row = self.__pool.connection().execute(
+                f"SELECT COUNT(*) FROM {self.__table_name}").fetchone()
+            return row[0]
+
+    def getAll(self) -> list[dict]:
+        with self.__lock.read():
+            rows = self.__pool.connection().execute(
+                f"SELECT id, data FROM {self.__table_name} ORDER BY id").fetchall()
+            return [SqliteTable.__to_record(row) for row in rows]
+
+    def getBy(self, query: dict[str, Any]) -> list[dict]:
+        if len(query) == 0:
+            return self.getAll()
+
+        fields = tuple(query.keys())
+
+        with self.__lock.read():
+            rows = self.__pool.connection().execute(
+                self.__get_query_sql(fields), tuple(query[field] for field in fields)).fetchall()
+            return [SqliteTable.__to_record(row) for row in rows]
+
+    def __get_fields_sql(self, fields: tuple[str, ...]) -> str:
+        columns = ", ".join(
+            f"json_extract(data, '$.{_check_identifier(field)}')" for field in fields)
+        return f"SELECT id, {columns} FROM {self.__table_name}"
+
+    @staticmethod
+    def __to_fields(fields: tuple[str, ...], row: tuple) -> dict:
+        # Objects and arrays come back from json_extract as JSON text
+        return {"id": row[0], **dict(zip(fields, row[1:]))}
+
+    def getAllFields(self, fields: Iterable[str]) -> list[dict]:
+        # Only the requested fields (and the ID) of each record, SQLite extracts them
+        fields = tuple(fields)
+
+        with self.__lock.read():
+            rows = self.__pool.connection().execute(
+                f"{self.__get_fields_sql(fields)} ORDER BY id").fetchall()
+            return [SqliteTable.__to_fields(fields, row) for row in rows]
+
+    def getFieldsById(self, pk: int, fields: Iterable[str]) -> dict:
+        fields = tuple(fields)
+
+        with self.__lock.read():
+            row = self.__pool.connection().execute(
+                f"{self.__get_fields_sql(fields)} WHERE id = ?", (int(pk),)).fetchone()
+
+            if row is None:
+                raise IdNotFoundError(pk)
+
+            return SqliteTable.__to_fields(fields, row)
+
+    def getPage(self, after: Optional[int], limit: int) -> list[dict]:
+        # Records in ID order starting after the given ID
+        with self.__lock.read():
+            rows = self.__pool.connection().execute(
+                f"SELECT id, data FROM {self.__table_name} WHERE id > ? ORDER BY id LIMIT ?",
+                (int(after) if after is not None else -(2 ** 63), int(limit))).fetchall()
+            return [SqliteTable.__to_record(row) for row in rows]
+
+    def getById(self, pk: int) -> dict:
+        with self.__lock.read():
+            row = self.__pool.connection().execute(
+                f"SELECT id, data FROM {self.__table_name} WHERE id = ?", (int(pk),)).fetchone()
+
+            if row is None:
+                raise IdNotFoundError(pk)
+
+            return SqliteTable.__to_record(row)
+
+    def add(self, new_data: dict) -> int:
+        with self.__lock.write(), self.__pool.transaction() as connection:
+            record_id = new_record_id()
+
+            # Callers expect the ID to be set on their dictionary (same as pysondb)
+            new_data["id"] = record_id
+
+            connection.execute(
+                f"INSERT INTO {self.__table_name} (id, data) VALUES (?, ?)",
+                (record_id, SqliteTable.__to_data(new_data)))
+
+            self.__changed(connection)
+
+            return record_id
+
+    def import_records(self, records: Iterable[dict]) -> int:
+        # Used to migrate existing records, keeping their IDs
+        count = 0
+
+        with self.__lock.write(), self.__pool.transaction() as connection:
+            for record in records:
+                connection.execute(
+                    f"INSERT OR REPLACE INTO {self.__table_name} (id, data) VALUES (?, ?)",
+                    (int(record["id"]), SqliteTable.__to_data(record)))
+                count += 1
+
+            self.__changed(connection)
+
+        return count
+
+    def updateById(self, pk: int, new_data: dict) -> None:
+        with self.__lock.write(), self.__pool.transaction() as connection:
+            row = connection.execute(
+                f"SELECT id, data FROM {self.__table_name} WHERE id = ?", (int(pk),)).fetchone()
+
+            if row is None:
+                raise IdNotFoundError(pk)
+
+            record = SqliteTable.__to_record(row)
+            record.update(new_data)
+
+            connection.execute(
+                f"UPDATE {self.__table_name} SET data = ? WHERE id = ?",
+                (SqliteTable.__to_data(record), int(pk)))
+
+            self.__changed(connection)
+
+    def deleteById(self, pk: int) -> bool:
+        with self.__lock.write(), self.__pool.transaction() as connection:
+            cursor = connection.execute(
+                f"DELETE FROM {self.__table_name} WHERE id = ?", (int(pk),))
+
+            if cursor.rowcount == 0:
+                raise IdNotFoundError(pk)
+
+            self.__changed(connection)
+
+            return True
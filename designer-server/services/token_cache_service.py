@@ -0,0 +1,116 @@
+import threading
+from collections import OrderedDict
+from time import time
+from typing import Annotated, Optional
+from wireup import Inject, service
+from config.config import TokenCacheConfig
+from services.base import BaseService
+
+
+@service
+class TokenCacheService(BaseService):
+    """
+    Remembers JWT IDs that were recently found in the user token store so that the revocation
+    check on each request doesn't need to go to storage. Only live tokens are cached, and revoking
+    a token must invalidate it here.
+    """
+
+    def __init__(self, token_cache: Annotated[TokenCacheConfig, Inject(param="token_cache")]):
+        super().__init__()
+
+        self.__max_entries = max(1, int(token_cache.get("max_entries", 10000)))
+        self.__ttl_secs = float(token_cache.get("ttl_secs", 60))
+
+        # JTI -> epoch seconds the entry expires, least recently used first
+        self.__entries: OrderedDict[str, float] = OrderedDict()
+        self.__lock = threading.Lock()
+
+        # Incremented on every invalidation, so a lookup that raced with a revoke isn't cached
+        self.__generation = 0
+
+        # The user tokens version (changes made by other processes) the entries were checked
+        # against, None until first synced
+        self.__table_version: Optional[int] = None
+
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__invalidations = 0
+        self.__resets = 0
+
+    def sync_version(self, table_version: int) -> None:
+        # Another process sharing the data changed the user tokens, maybe revoking some, so drop
+        # everything rather than trust entries that may have been revoked
+        with self.__lock:
+            if self.__table_version == table_version:
+                return
+
+            if self.__table_version is not None:
+                self.__generation += 1
+                self.__entries.clear()
+                self.__resets += 1
+
+            self.__table_version = table_version
+
+    def get_generation(self) -> int:
+        with self.__lock:
+            return self.__generation
+
+    def contains(self, jti: str) -> bool:
+        now = time()
+
+        with self.__lock:
+            expires = self.__entries.get(jti)
+
+            if expires is not None and expires > now:
+                self.__entries.move_to_end(jti)
+                self.__hits += 1
+                return True
+
+            if expires is not None:
+                # Expired entry
+                del self.__entries[jti]
+
+            self.__misses += 1
+            return False
+
+    def add(self, jti: str, token_expiry: float, generation: int) -> None:
+        now = time()
+
+        # Never keep an entry past the token's own expiry
+        expires = min(now + self.__ttl_secs, token_expiry)
+
+        if expires <= now:
+            return
+
+        with self.__lock:
+            # Something was revoked since the caller looked the token up so it may be stale
+            if generation != self.__generation:
+                return
+
+            self.__entries[jti] = expires
+            self.__entries.move_to_end(jti)
+
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+                self.__evictions += 1
+
+    def invalidate(self, *jtis: str) -> None:
+        with self.__lock:
+            self.__generation += 1
+
+            for jti in jtis:
+                if self.__entries.pop(jti, None) is not None:
+                    self.__invalidations += 1
+
+    def get_stats(self) -> dict:
+        with self.__lock:
+            return {
+                "entries": len(self.__entries),
+                "maxEntries": self.__max_entries,
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "evictions": self.__evictions,
+                "invalidations": self.__invalidations,
+                "resets": self.__resets
+            }
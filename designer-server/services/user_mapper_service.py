@@ -6,6 +6,15 @@ from services.base import BaseService
 @service
 class UserMapperService(BaseService):
 
+    def group_roles_by_user_id(self, roles: list[dict]) -> dict[int, list[dict]]:
+        # Lets many users be mapped with a single pass over the roles
+        roles_by_user_id: dict[int, list[dict]] = {}
+
+        for role in roles:
+            roles_by_user_id.setdefault(role["userId"], []).append(role)
+
+        return roles_by_user_id
+
     def map_to_model(self, user: dict, roles: Optional[list[dict]]) -> dict:
         # Het the user ID as the key for the user identity
         user_id = user["id"]
@@ -1,6 +1,5 @@
 from dataclasses import dataclass
-import bcrypt
-from typing import Optional, Union
+from typing import Iterator, Optional, Union
 from wireup import service
 from flask_jwt_extended import current_user
 from constants.messages import INVALID_USER_NAME_OR_PASSWORD
@@ -8,8 +7,10 @@ from constants.user_security_roles import SECURITY_ROLE_ADMIN, SECURITY_ROLE_USE
 from exceptions.permission_exceptions import ForbiddenException, InvalidCredentialsException, UserExistsException
 from services.base import BaseService
 from services.data_service import DataService
+from services.password_hasher_service import PasswordHasherService
 from services.user_mapper_service import UserMapperService
 from services.user_token_service import UserTokenService
+from services.user_view_cache_service import UserViewCacheService
 
 
 @service
@@ -18,6 +19,8 @@ class UserService(BaseService):
     data_service: DataService
     user_mapper_service: UserMapperService
     user_token_service: UserTokenService
+    user_view_cache_service: UserViewCacheService
+    password_hasher_service: PasswordHasherService
 
     def create_user(self, user_name: Union[str, None], password: Union[str, None]) -> dict:
         if user_name is None or password is None:
@@ -32,131 +35,187 @@ class UserService(BaseService):
             # Raise invalid credentials provided exception
             raise InvalidCredentialsException(INVALID_USER_NAME_OR_PASSWORD)
 
-        users_db = self.data_service.get_users_db()
+        # Hash on the worker pool before taking the data lock
+        hashed_password = self.password_hasher_service.hash_password(password)
 
-        # Locate existing user by user_name
-        users = users_db.getBy({"userName": user_name})
+        # Check and add under the one write lock so two registrations can't both succeed
+        with self.data_service.write():
+            users_db = self.data_service.get_users_db()
 
-        # Make sure not an existing user
-        if (len(users) > 0):
-            raise UserExistsException("user already exists")
+            # Locate existing user by user_name
+            users = users_db.getBy({"userName": user_name})
 
-        password_bytes = password.encode('utf-8')
-        password_salt = bcrypt.gensalt()
-        hashed_password = bcrypt.hashpw(
-            password_bytes, password_salt).decode('utf-8')
+            # Make sure not an existing user
+            if (len(users) > 0):
+                raise UserExistsException("user already exists")
 
-        new_user = {
-            "userName": user_name,
-            "password": hashed_password,
-            "resetPassword": False
-        }
+            new_user = {
+                "userName": user_name,
+                "password": hashed_password,
+                "resetPassword": False
+            }
 
-        users_db.add(new_user)
+            users_db.add(new_user)
 
-        return new_user
+            return new_user
 
-    def get_all_users(self, include_roles: bool = False) -> list[dict]:
+    def __ensure_admin(self) -> None:
         # Does this user have permissions to access?
         if current_user is None or current_user["roles"] is None or "admin" not in current_user["roles"]:
             raise ForbiddenException()
 
-        with self.data_service:
+    def get_all_users(self, include_roles: bool = False) -> list[dict]:
+        self.__ensure_admin()
+
+        with self.data_service.read():
             # Default to no roles
-            user_security_roles = None
+            roles_by_user_id = None
 
-            # If the caller wants roles included then fetch all user security roles
+            # If the caller wants roles included then group all user security roles by user once
             if include_roles:
-                user_security_roles = self.get_all_user_security_roles()
+                roles_by_user_id = self.user_mapper_service.group_roles_by_user_id(
+                    self.get_all_user_security_roles())
 
             # Get all users (as dictionary objects)
             users_list = self.data_service.get_users_db().getAll()
 
+        user_models = []
+
+        # Iterate each entity
+        for user_entity in users_list:
+            # Only this user's roles are passed so mapping doesn't scan every role
+            user_security_roles = None
+            if roles_by_user_id is not None:
+                user_security_roles = roles_by_user_id.get(
+                    user_entity["id"], [])
+
+            # Convert to user model (including user roles if roles list populated)
+            user_model = self.user_mapper_service.map_to_model(
+                user_entity, user_security_roles)
+
+            user_models.append(user_model)
+
+        # Return list of user models
+        return user_models
+
+    def get_users_page(self, include_roles: bool, limit: int, after: Optional[int] = None) -> list[dict]:
+        self.__ensure_admin()
+
+        return self.__get_users_page(include_roles, limit, after)
+
+    def __get_users_page(self, include_roles: bool, limit: int, after: Optional[int]) -> list[dict]:
+        with self.data_service.read():
+            # Users in ID order after the cursor
+            users_list = self.data_service.get_users_db().getPage(after, limit)
+
             user_models = []
 
-            # Iterate each entity
             for user_entity in users_list:
-                # Convert to user model (including user roles if roles list populated)
-                user_model = self.user_mapper_service.map_to_model(
-                    user_entity, user_security_roles)
+                # Default to no roles
+                user_security_roles = None
 
-                user_models.append(user_model)
+                # Roles are looked up by the user ID index for just the users in the page
+                if include_roles:
+                    user_security_roles = self.data_service.get_user_security_roles_db().getBy(
+                        {"userId": user_entity["id"]})
+
+                user_models.append(self.user_mapper_service.map_to_model(
+                    user_entity, user_security_roles))
 
-            # Return list of user models
             return user_models
 
+    def iter_all_users(self, include_roles: bool = False, page_size: int = 500) -> Iterator[dict]:
+        # Checked now rather than when the caller starts iterating
+        self.__ensure_admin()
+
+        def iterate() -> Iterator[dict]:
+            after = None
+
+            # The read lock is only held while each page is read, not while it is consumed
+            while True:
+                user_models = self.__get_users_page(
+                    include_roles, page_size, after)
+
+                yield from user_models
+
+                if len(user_models) < page_size:
+                    return
+
+                after = user_models[-1]["id"]
+
+        return iterate()
+
     def get_all_user_security_roles(self) -> list[dict]:
-        with self.data_service:
+        with self.data_service.read():
             roles = self.data_service.get_user_security_roles_db().getAll()
             return roles
 
     def get_user(self, user_name: str) -> Optional[dict]:
-        with self.data_service:
+        # The user model (including role names) comes from the cached user view
+        return self.user_view_cache_service.get(user_name)
+
+    def login_user(self, user_name: str, password: str) -> dict:
+        # Resolve the user and their roles once, the same records are used for the password
+        # check and the token claims
+        with self.data_service.read():
             users = self.data_service.get_users_db().getBy(
                 {"userName": user_name})
 
             if len(users) == 0:
-                return None
+                # Raise invalid credentials provided exception
+                raise InvalidCredentialsException(
+                    INVALID_USER_NAME_OR_PASSWORD)
 
-            user_security_roles = self.get_user_security_roles(users[0]["id"])
-
-            user_model = self.user_mapper_service.map_to_model(
-                users[0], user_security_roles)
+            user = users[0]
 
-            # Created user instance using the the first returned element
-            return user_model
+            user_security_roles = self.data_service.get_user_security_roles_db().getBy(
+                {"userId": user["id"]})
 
-    def login_user(self, user_name: str, password: str) -> dict:
-        valid = self.validate_user_password(user_name, password)
-
-        if not valid:
+        # Verify on the worker pool, outside the data lock
+        if not self.password_hasher_service.check_password(password, user["password"]):
             # Raise invalid credentials provided exception
             raise InvalidCredentialsException(INVALID_USER_NAME_OR_PASSWORD)
 
+        user_model = self.user_mapper_service.map_to_model(
+            user, user_security_roles)
+
         # Create access and refresh tokens
-        token = self.user_token_service.create(user_name)
+        token = self.user_token_service.create(user_model)
 
         return token
 
     def get_user_security_roles(self, user_id: int) -> list[dict]:
-        with self.data_service:
+        with self.data_service.read():
             # Get any roles for the specified user ID
             return self.data_service.get_user_security_roles_db().getBy(
                 {"userId": user_id})
 
     def validate_user_password(self, user_name: str, password: str) -> bool:
-        with self.data_service:
+        with self.data_service.read():
             # We need to refetch user including password
             users = self.data_service.get_users_db().getBy(
                 {"userName": user_name})
 
-            if len(users) == 0:
-                # Password not valid for unknown user
-                return False
-
-            bytes = password.encode('utf-8')
-            result = bcrypt.checkpw(
-                bytes, users[0]["password"].encode('utf-8'))
-            return result
+        if len(users) == 0:
+            # Password not valid for unknown user
+            return False
 
-    @staticmethod
-    def generate_hashed_password(password: str) -> str:
-        password_bytes = password.encode('utf-8')
-        password_salt = bcrypt.gensalt()
-        hashed_password = bcrypt.hashpw(
-            password_bytes,
-            password_salt
-        ).decode('utf-8')
-
-        return hashed_password
+        # Verify on the worker pool, outside the data lock
+        return self.password_hasher_service.check_password(password, users[0]["password"])
 
     def ensure_admin_user(self) -> Optional[dict]:
-        with self.data_service:
+        # Only needed if there are no users, but hashed before taking the data lock
+        hashed_password = None
+        if self.data_service.get_users_db().count() == 0:
+            hashed_password = self.password_hasher_service.hash_password(
+                "mekatrol")
+
+        with self.data_service.write():
             users_db = self.data_service.get_users_db()
             user_security_roles_db = self.data_service.get_user_security_roles_db()
 
             users = users_db.getAll()
-            if len(users) > 0:
+            if len(users) > 0 or hashed_password is None:
                 return None  # No user created
 
             # Create a user with 'admin' as user_name and 'mekatrol' as password
@@ -164,7 +223,7 @@ class UserService(BaseService):
 
             new_user = {
                 "userName": admin,
-                "password": UserService.generate_hashed_password("mekatrol"),
+                "password": hashed_password,
                 "resetPassword": True  # New users should reset password
             }
 
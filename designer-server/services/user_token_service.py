@@ -1,16 +1,52 @@
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
+from time import time
 from typing import Annotated, Optional
 from flask_jwt_extended import create_access_token, create_refresh_token, get_jti
 from wireup import Inject, service
 from services.base import BaseService
 from services.data_service import DataService
+from services.token_cache_service import TokenCacheService
+
+
+@dataclass(slots=True)
+class UserToken:
+    """
+    A user's live token pair. Only the JTIs and expiries (epoch seconds) are stored, the signed
+    tokens themselves are handed to the client and never read back.
+    """
+    id: Optional[int]
+    userId: int
+    accessTokenJti: str
+    accessTokenExpiry: int
+    refreshTokenJti: str
+    refreshTokenExpiry: int
+
+    @staticmethod
+    def from_record(record: dict) -> "UserToken":
+        return UserToken(
+            record.get("id"),
+            record["userId"],
+            record["accessTokenJti"],
+            record["accessTokenExpiry"],
+            record["refreshTokenJti"],
+            record["refreshTokenExpiry"])
+
+    def to_record(self) -> dict:
+        return {
+            "userId": self.userId,
+            "accessTokenJti": self.accessTokenJti,
+            "accessTokenExpiry": self.accessTokenExpiry,
+            "refreshTokenJti": self.refreshTokenJti,
+            "refreshTokenExpiry": self.refreshTokenExpiry
+        }
 
 
 @service
 @dataclass
 class UserTokenService(BaseService):
     data_service: DataService
+    token_cache_service: TokenCacheService
 
     jwt_access_token_expiry_mins: Annotated[int, Inject(
         param="jwt_access_token_expiry_mins")]
@@ -18,17 +54,16 @@ class UserTokenService(BaseService):
     jwt_refresh_token_expiry_mins: Annotated[int, Inject(
         param="jwt_refresh_token_expiry_mins")]
 
-    def get(self, user_name: str) -> list[dict]:
-        with self.data_service:
-            # Try and get by access token JTI
+    def get(self, user_id: int) -> list[UserToken]:
+        with self.data_service.read():
+            # Get all tokens for the user
             user_tokens = self.data_service.get_user_tokens_db().getBy(
-                {"userName": user_name})
+                {"userId": user_id})
 
-            # Return user
-            return user_tokens
+            return [UserToken.from_record(user_token) for user_token in user_tokens]
 
-    def getByAccessJti(self, jti: str) -> Optional[dict]:
-        with self.data_service:
+    def getByAccessJti(self, jti: str) -> Optional[UserToken]:
+        with self.data_service.read():
             # Try and get by access token JTI
             user_tokens = self.data_service.get_user_tokens_db().getBy(
                 {"accessTokenJti": jti})
@@ -36,11 +71,11 @@ class UserTokenService(BaseService):
             if len(user_tokens) == 0:
                 return None
 
-            # Return user
-            return user_tokens[0]
+            # Return user token
+            return UserToken.from_record(user_tokens[0])
 
-    def getByRefreshJti(self, jti: str) -> Optional[dict]:
-        with self.data_service:
+    def getByRefreshJti(self, jti: str) -> Optional[UserToken]:
+        with self.data_service.read():
             # Try and get by refresh token JTI
             user_tokens = self.data_service.get_user_tokens_db().getBy(
                 {"refreshTokenJti": jti})
@@ -48,87 +83,148 @@ class UserTokenService(BaseService):
             if len(user_tokens) == 0:
                 return None
 
-            # Return user
-            return user_tokens[0]
+            # Return user token
+            return UserToken.from_record(user_tokens[0])
 
-    def create(self, user_name: str) -> dict:
-        with self.data_service:
-            # Revoke any existing
-            self.revoke(user_name)
+    def is_revoked(self, jti: str, token_type: str, token_expiry: float) -> bool:
+        # Tokens revoked by this process are invalidated as they are revoked, but cached checks
+        # can't be trusted once another process sharing the data changes the user tokens
+        self.token_cache_service.sync_version(
+            self.data_service.get_user_tokens_db().get_external_version())
 
-            # Create access token and metadata
-            access_token_expires = timedelta(
-                minutes=self.jwt_access_token_expiry_mins)
-            access_token_expiry = datetime.now(
-                timezone.utc) + access_token_expires
-            access_token = create_access_token(
-                identity=user_name, expires_delta=access_token_expires)
+        # Most requests use a token that was checked recently
+        if self.token_cache_service.contains(jti):
+            return False
 
-            # Create refresh token and metadata
-            refresh_token_expires = timedelta(
-                minutes=self.jwt_refresh_token_expiry_mins)
-            refresh_token = create_refresh_token(
-                identity=user_name, expires_delta=refresh_token_expires)
-            refresh_token_expiry = datetime.now(
-                timezone.utc) + refresh_token_expires
-
-            token = {
-                "userName": user_name,
-                "accessToken": access_token,
-                "accessTokenJti": get_jti(access_token),
-                "accessTokenExpiry": access_token_expiry.isoformat(),
-                "refreshToken": refresh_token,
-                "refreshTokenJti": get_jti(refresh_token),
-                "refreshTokenExpiry": refresh_token_expiry.isoformat()
-            }
-
-            self.data_service.get_user_tokens_db().add(token)
-
-            # We don't want to include some of the properties in the return value
-            del token['id']
-            del token['accessTokenJti']
-            del token['refreshTokenJti']
-
-            return token
-
-    def refresh(self, jti: str) -> Optional[str]:
-        # Get existing token
-        token = self.getByRefreshJti(jti)
-
-        if token is None:
-            # The token has been revoked
-            return None
-
-        # Create access token
+        # Taken before the lookup so a revoke that happens during it isn't cached over
+        generation = self.token_cache_service.get_generation()
+
+        user_token = None
+        if token_type == "access":
+            user_token = self.getByAccessJti(jti)
+        elif token_type == "refresh":
+            user_token = self.getByRefreshJti(jti)
+
+        # The user token is revoked if there is no user token
+        if user_token is None:
+            return True
+
+        self.token_cache_service.add(jti, token_expiry, generation)
+
+        return False
+
+    def create(self, user: dict) -> dict:
+        # The user model is the token identity so the claims loader doesn't need to look the
+        # user up again. Tokens are signed before taking the data lock.
         access_token_expires = timedelta(
             minutes=self.jwt_access_token_expiry_mins)
         access_token_expiry = datetime.now(
             timezone.utc) + access_token_expires
         access_token = create_access_token(
-            identity=token["userName"], expires_delta=access_token_expires)
+            identity=user, expires_delta=access_token_expires)
+
+        # Create refresh token and metadata
+        refresh_token_expires = timedelta(
+            minutes=self.jwt_refresh_token_expiry_mins)
+        refresh_token = create_refresh_token(
+            identity=user, expires_delta=refresh_token_expires)
+        refresh_token_expiry = datetime.now(
+            timezone.utc) + refresh_token_expires
+
+        user_token = UserToken(
+            None,
+            user["id"],
+            get_jti(access_token),
+            int(access_token_expiry.timestamp()),
+            get_jti(refresh_token),
+            int(refresh_token_expiry.timestamp()))
+
+        # Swap the user's existing tokens for the new one in a single write
+        with self.data_service.write():
+            self.revoke_user(user["id"])
+            self.data_service.get_user_tokens_db().add(user_token.to_record())
+
+        # The caller gets the tokens themselves, they are not stored
+        return {
+            "userName": user["userName"],
+            "accessToken": access_token,
+            "accessTokenExpiry": access_token_expiry.isoformat(),
+            "refreshToken": refresh_token,
+            "refreshTokenExpiry": refresh_token_expiry.isoformat()
+        }
+
+    def refresh(self, jti: str, user_name: str) -> Optional[str]:
+        with self.data_service.write():
+            # Get existing token
+            user_token = self.getByRefreshJti(jti)
+
+            if user_token is None:
+                # The token has been revoked
+                return None
+
+            # Create access token
+            access_token_expires = timedelta(
+                minutes=self.jwt_access_token_expiry_mins)
+            access_token_expiry = datetime.now(
+                timezone.utc) + access_token_expires
+            access_token = create_access_token(
+                identity=user_name, expires_delta=access_token_expires)
 
-        token_id = token["id"]
+            # The previous access token is no longer valid
+            self.token_cache_service.invalidate(user_token.accessTokenJti)
 
-        self.data_service.get_user_tokens_db().updateById(
-            token_id, {"accessToken": access_token, "accessTokenJti": get_jti(access_token)})
+            self.data_service.get_user_tokens_db().updateById(
+                user_token.id, {
+                    "accessTokenJti": get_jti(access_token),
+                    "accessTokenExpiry": int(access_token_expiry.timestamp())
+                })
 
-        return {"accessToken": access_token, "accessTokenExpiry": access_token_expiry}
+            return {"accessToken": access_token, "accessTokenExpiry": access_token_expiry}
 
     def revoke(self, jti: str) -> None:
-        with self.data_service:
+        with self.data_service.write():
             # Find existing tokens
-            token = self.getByAccessJti(jti)
+            user_token = self.getByAccessJti(jti)
 
-            if token is None:
+            if user_token is None:
                 return
 
-            # Get username from token
-            user_name = token["userName"]
+            # Revoke all tokens for the user the token belongs to
+            self.revoke_user(user_token.userId)
+
+    def remove_expired(self) -> int:
+        now = time()
+        removed = 0
 
-            # Get all tokens by user name
-            tokens = self.get(user_name)
+        # Deleted in a single write block so the table is rewritten once
+        with self.data_service.write():
+            user_tokens_db = self.data_service.get_user_tokens_db()
+
+            for record in user_tokens_db.getAll():
+                user_token = UserToken.from_record(record)
+
+                # The access token never outlives the refresh token
+                if user_token.refreshTokenExpiry > now:
+                    continue
+
+                self.token_cache_service.invalidate(
+                    user_token.accessTokenJti, user_token.refreshTokenJti)
+
+                user_tokens_db.deleteById(user_token.id)
+                removed += 1
+
+        return removed
+
+    def revoke_user(self, user_id: int) -> None:
+        with self.data_service.write():
+            # Get all tokens for the user
+            user_tokens = self.get(user_id)
 
             # Revoke all found tokens
-            for token in tokens:
+            for user_token in user_tokens:
+                # Make sure the revocation check doesn't use a cached result
+                self.token_cache_service.invalidate(
+                    user_token.accessTokenJti, user_token.refreshTokenJti)
+
                 # Delete token from DB
-                self.data_service.get_user_tokens_db().deleteById(token["id"])
+                self.data_service.get_user_tokens_db().deleteById(user_token.id)
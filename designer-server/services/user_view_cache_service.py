@@ -0,0 +1,86 @@
+import threading
+from typing import Optional
+from wireup import service
+from services.base import BaseService
+from services.data_service import DataService
+from services.user_mapper_service import UserMapperService
+
+
+@service
+class UserViewCacheService(BaseService):
+    """
+    Holds user models joined with their role names, keyed by user name. The whole view is
+    dropped whenever the users or user security roles tables change.
+    """
+
+    def __init__(self, data_service: DataService, user_mapper_service: UserMapperService):
+        super().__init__()
+
+        self.__data_service = data_service
+        self.__user_mapper_service = user_mapper_service
+
+        self.__user_models: dict[str, dict] = {}
+        self.__versions: tuple[int, int] = self.__get_table_versions()
+        self.__lock = threading.Lock()
+
+        self.__hits = 0
+        self.__misses = 0
+
+    def __get_table_versions(self) -> tuple[int, int]:
+        return (
+            self.__data_service.get_users_db().get_version(),
+            self.__data_service.get_user_security_roles_db().get_version()
+        )
+
+    @staticmethod
+    def __copy(user_model: dict) -> dict:
+        # Callers get their own copy so they can't change the cached model
+        return {**user_model, "roles": list(user_model["roles"])}
+
+    def get(self, user_name: str) -> Optional[dict]:
+        with self.__lock:
+            versions = self.__get_table_versions()
+
+            if versions != self.__versions:
+                self.__user_models.clear()
+                self.__versions = versions
+
+            user_model = self.__user_models.get(user_name)
+
+            if user_model is not None:
+                self.__hits += 1
+                return UserViewCacheService.__copy(user_model)
+
+            self.__misses += 1
+
+        with self.__data_service.read():
+            # Versions read under the same lock as the data so the model matches them
+            versions = self.__get_table_versions()
+
+            users = self.__data_service.get_users_db().getBy(
+                {"userName": user_name})
+
+            # Unknown user names are not cached
+            if len(users) == 0:
+                return None
+
+            user_security_roles = self.__data_service.get_user_security_roles_db().getBy(
+                {"userId": users[0]["id"]})
+
+        user_model = self.__user_mapper_service.map_to_model(
+            users[0], user_security_roles)
+
+        with self.__lock:
+            # Only cache if nothing changed since the model was read
+            if versions == self.__versions:
+                self.__user_models[user_name] = user_model
+
+        return UserViewCacheService.__copy(user_model)
+
+    def get_stats(self) -> dict:
+        with self.__lock:
+            return {
+                "entries": len(self.__user_models),
+                "hits": self.__hits,
+                "misses": self.__misses
+            }
@@ -0,0 +1,68 @@
+import os
+import sys
+import pytest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Tests import the server's packages (services, config, ...) the same way app.py does
+sys.path.insert(0, SERVER_DIR)
+
+
+@pytest.fixture
+def create_data_service():
+    from services.data_service import DataService
+
+    def create(directory, **data_store) -> DataService:
+        # The data files (and lock file) in the given directory
+        directory.mkdir(parents=True, exist_ok=True)
+
+        return DataService(
+            str(directory / "app.lock"),
+            {
+                "users_data_file": str(directory / "users.json"),
+                "user_tokens_data_file": str(directory / "user_tokens.json"),
+                "user_security_roles_data_file": str(directory / "user_security_roles.json"),
+                "dashboards_data_file": str(directory / "dashboards.json")
+            },
+            {"engine": "json", "write_mode": "write_back", "durability": "normal",
+             "commit_interval_ms": 0, "sqlite_data_file": str(directory / "data.sqlite3"), **data_store})
+
+    return create
+
+
+@pytest.fixture
+def create_app(tmp_path, monkeypatch):
+    import app
+    from config.config_helper import deep_merge, load_yaml_config
+
+    def create(**app_config):
+        # The default configuration with the data in the test's directory and no home assistant
+        config = load_yaml_config(os.path.join(SERVER_DIR, "config", "config.yaml"))
+        deep_merge(config["app"], {
+            "lock_file": str(tmp_path / "app.lock"),
+            "data_files": {
+                "users_data_file": str(tmp_path / "users.json"),
+                "user_tokens_data_file": str(tmp_path / "user_tokens.json"),
+                "user_security_roles_data_file": str(tmp_path / "user_security_roles.json"),
+                "dashboards_data_file": str(tmp_path / "dashboards.json")
+            },
+            "data_store": {"sqlite_data_file": str(tmp_path / "data.sqlite3")},
+            "home_assistant_hub": {"enabled": False}
+        })
+        deep_merge(config["app"], app_config)
+
+        monkeypatch.setattr(app, "load_yaml_config", lambda *config_names: config)
+
+        return app.create_app()
+
+    return create
+
+
+@pytest.fixture
+def admin_headers():
+    def login(client) -> dict:
+        # The default admin user created on startup
+        response = client.post("/auth/login", json={"userName": "admin", "password": "mekatrol"})
+        return {"Authorization": f"Bearer {response.get_json()['accessToken']}"}
+
+    return login
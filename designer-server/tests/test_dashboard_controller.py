@@ -0,0 +1,66 @@
+import pytest
+
+
+@pytest.fixture
+def client(create_app):
+    return create_app().test_client()
+
+
+@pytest.fixture
+def headers(client, admin_headers) -> dict:
+    return admin_headers(client)
+
+
+def create_dashboard(client, headers, name: str = "Kitchen") -> dict:
+    response = client.post("/dashboards", json={"name": name, "layout": {"title": name}}, headers=headers)
+    assert response.status_code == 201
+    return response.get_json()["dashboard"]
+
+
+@pytest.mark.parametrize("body", ["null", "[]", '"x"', "1", "{not json"])
+def test_body_must_be_an_object(client, headers, body):
+    dashboard = create_dashboard(client, headers)
+    headers = {**headers, "Content-Type": "application/json"}
+
+    for response in [
+        client.post("/dashboards", data=body, headers=headers),
+        client.put(f"/dashboards/{dashboard['id']}", data=body, headers=headers),
+        client.patch(f"/dashboards/{dashboard['id']}", data=body, headers=headers)
+    ]:
+        assert response.status_code == 400
+        assert response.get_json()["message"] == "request body must be a JSON object"
+
+
+@pytest.mark.parametrize("patch", [None, "x", {"op": "remove", "path": "/layout/title"}])
+def test_patch_must_be_a_list(client, headers, patch):
+    dashboard = create_dashboard(client, headers)
+
+    response = client.patch(
+        f"/dashboards/{dashboard['id']}", json={"baseVersion": 1, "patch": patch}, headers=headers)
+
+    assert response.status_code == 400
+    assert "'patch' must be a list" in response.get_json()["message"]
+
+
+def test_ids_are_sent_as_strings(client, headers):
+    dashboard = create_dashboard(client, headers)
+    dashboard_id = dashboard["id"]
+
+    # Above the largest integer a JavaScript number holds exactly
+    assert isinstance(dashboard_id, str)
+    assert int(dashboard_id) > 2 ** 53
+
+    response = client.get(f"/dashboards/{dashboard_id}", headers=headers)
+    assert response.get_json()["dashboard"]["id"] == dashboard_id
+    assert response.headers["ETag"] == f'"{dashboard_id}-1"'
+
+    response = client.put(
+        f"/dashboards/{dashboard_id}", json={"name": "Lounge", "layout": {}},
+        headers={**headers, "If-Match": response.headers["ETag"]})
+    assert response.status_code == 200
+    assert response.get_json()["dashboard"]["id"] == dashboard_id
+
+    assert client.get("/dashboards/all", headers=headers).get_json()["dashboards"] == [
+        {"id": dashboard_id, "name": "Lounge", "version": 2}]
+    assert client.get("/dashboards/search?q=lou", headers=headers).get_json()["dashboards"] == [
+        {"id": dashboard_id, "name": "Lounge", "version": 2}]
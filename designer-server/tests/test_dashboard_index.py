@@ -0,0 +1,178 @@
+import pytest
+from services.dashboard_index_service import DashboardIndexService, extract_tokens
+
+
+def test_tokens_of_nested_layouts():
+    tokens = extract_tokens({
+        "name": "Kitchen & Lounge 2",
+        "layout": {
+            "rows": [
+                {"cwc-date-time": {"format": "HH:mm"}},
+                {"columns": [[{"type": "cwc-light-switch", "entityId": "light.kitchen"}]]},
+                {"Entity_IDs": ["sensor.power", "not an entity", 5]},
+                {"entities": "Light.*"}
+            ]
+        }
+    })
+
+    assert tokens == {
+        "name": {"kitchen", "lounge", "2"},
+        "component": {"cwc-date-time", "cwc-light-switch"},
+        "entity": {"light.kitchen", "sensor.power", "light.*"}
+    }
+
+
+def test_tokens_of_html_attributes():
+    tokens = extract_tokens({
+        "name": "Panel",
+        "layout": {
+            "html": "<cwc-gauge entity-id=\"sensor.temp\"></cwc-gauge><cwc-toggle entity='switch.fan' />"
+        }
+    })
+
+    assert tokens["component"] == {"cwc-gauge", "cwc-toggle"}
+    assert tokens["entity"] == {"sensor.temp", "switch.fan"}
+
+
+def test_deep_layouts_are_scanned():
+    layout = {"entity": "light.deep"}
+
+    for _ in range(5000):
+        layout = {"child": [layout]}
+
+    assert extract_tokens({"name": "Deep", "layout": layout})["entity"] == {"light.deep"}
+
+
+@pytest.fixture
+def data_service(tmp_path, create_data_service):
+    return create_data_service(tmp_path)
+
+
+@pytest.fixture
+def index(data_service) -> DashboardIndexService:
+    return DashboardIndexService(data_service)
+
+
+def save(data_service, index: DashboardIndexService, name: str, layout: dict, dashboard_id=None) -> dict:
+    # The same as the dashboard service, the index is told under the data write lock
+    with data_service.write():
+        dashboards_db = data_service.get_dashboards_db()
+        dashboard = {"name": name, "version": 1, "layout": layout}
+
+        if dashboard_id is None:
+            dashboards_db.add(dashboard)
+        else:
+            dashboards_db.updateById(dashboard_id, dashboard)
+            dashboard["id"] = dashboard_id
+
+        index.dashboard_saved(dashboard)
+
+    return dashboard
+
+
+def delete(data_service, index: DashboardIndexService, dashboard_id: int) -> None:
+    with data_service.write():
+        data_service.get_dashboards_db().deleteById(dashboard_id)
+        index.dashboard_deleted(dashboard_id)
+
+
+def names(results: list[dict]) -> list[str]:
+    return [result["name"] for result in results]
+
+
+def test_every_term_must_prefix_match(data_service, index):
+    save(data_service, index, "Kitchen Lights", {"cwc-light": {"entity": "light.kitchen"}})
+    save(data_service, index, "Kitchen Power", {"cwc-gauge": {"entity": "sensor.power"}})
+    save(data_service, index, "Lounge", {"cwc-light": {"entity": "light.lounge"}})
+
+    assert names(index.search("kit")) == ["Kitchen Lights", "Kitchen Power"]
+    assert names(index.search("KIT cwc-light")) == ["Kitchen Lights"]
+    assert names(index.search("light.")) == ["Kitchen Lights", "Lounge"]
+    assert names(index.search("kit light.l")) == []
+    assert index.search("") == []
+
+    # Only the kinds asked for
+    assert names(index.search("light", ["name"])) == ["Kitchen Lights"]
+    assert names(index.search("light", ["entity"])) == ["Kitchen Lights", "Lounge"]
+
+    assert names(index.search("kit", limit=1)) == ["Kitchen Lights"]
+
+
+def test_saves_and_deletes_update_the_index(data_service, index):
+    kitchen = save(data_service, index, "Kitchen", {"cwc-light": {"entity": "light.kitchen"}})
+    assert index.get_stats()["builds"] == 0
+
+    # Built on first use, then kept up to date
+    assert names(index.search("kitchen")) == ["Kitchen"]
+    assert index.get_stats()["tokens"] == 3
+
+    save(data_service, index, "Garage", {"cwc-door": {"entity": "cover.garage"}}, kitchen["id"])
+
+    assert index.search("kitchen") == []
+    assert index.search("light.kitchen") == []
+    assert names(index.search("cover.gar")) == ["Garage"]
+    assert index.get_dashboard_entities(kitchen["id"]) == {"cover.garage"}
+
+    delete(data_service, index, kitchen["id"])
+
+    assert index.search("garage") == []
+    assert index.get_dashboard_entities(kitchen["id"]) is None
+
+    # Tokens no dashboard uses are dropped
+    assert index.get_stats()["tokens"] == 0
+    assert index.get_stats()["builds"] == 1
+    assert index.get_stats()["updates"] == 2
+
+
+def test_changes_made_around_the_index_rebuild_it(data_service, index):
+    save(data_service, index, "Kitchen", {})
+    assert names(index.search("kitchen")) == ["Kitchen"]
+
+    # Changed without telling the index
+    data_service.get_dashboards_db().add({"name": "Lounge", "version": 1, "layout": {}})
+
+    assert names(index.search("lounge")) == ["Lounge"]
+    assert index.get_stats()["builds"] == 2
+
+    # A save after a missed change can't be applied on top, so it rebuilds too
+    data_service.get_dashboards_db().add({"name": "Garage", "version": 1, "layout": {}})
+    save(data_service, index, "Office", {})
+
+    assert names(index.search("garage")) == ["Garage"]
+    assert names(index.search("office")) == ["Office"]
+    assert index.get_stats()["builds"] == 3
+
+
+def test_subscribers_are_told_of_changes(data_service, index):
+    changed = []
+    index.subscribe(changed.append)
+
+    # Not built yet, so nothing to tell
+    kitchen = save(data_service, index, "Kitchen", {})
+    assert changed == []
+
+    index.search("kitchen")
+    save(data_service, index, "Lounge", {}, kitchen["id"])
+    delete(data_service, index, kitchen["id"])
+
+    # A rebuild may change any dashboard
+    assert changed == [None, kitchen["id"], kitchen["id"]]
+
+
+def test_search_endpoint(create_app, admin_headers):
+    client = create_app().test_client()
+    headers = admin_headers(client)
+
+    for name, entity_id in [("Kitchen", "light.kitchen"), ("Lounge", "light.lounge")]:
+        client.post("/dashboards", json={"name": name, "layout": {"entity": entity_id}}, headers=headers)
+
+    def search(query: str):
+        return client.get(f"/dashboards/search?{query}", headers=headers)
+
+    assert names(search("q=light").get_json()["dashboards"]) == ["Kitchen", "Lounge"]
+    assert names(search("q=light&kind=entity&limit=1").get_json()["dashboards"]) == ["Kitchen"]
+    assert search("q=light&kind=name").get_json()["dashboards"] == []
+    assert search("q=light&kind=other").status_code == 400
+    assert search("q=light&limit=0").status_code == 400
+    assert search("q=light&limit=201").status_code == 400
+    assert client.get("/dashboards/search?q=light").status_code == 401
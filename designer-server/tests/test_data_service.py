@@ -0,0 +1,286 @@
+import json
+import os
+import time
+import pytest
+import services.indexed_json_table as indexed_json_table
+from pysondb import db
+from services.indexed_json_table import IndexedJsonTable
+
+
+@pytest.fixture
+def writes(monkeypatch) -> list[str]:
+    # The names of the files written, one entry for each write
+    written = []
+    atomic_write_text = indexed_json_table._atomic_write_text
+
+    def counting_write(file_name: str, text: str, durability: str) -> None:
+        written.append(os.path.basename(file_name))
+        atomic_write_text(file_name, text, durability)
+
+    monkeypatch.setattr(indexed_json_table, "_atomic_write_text", counting_write)
+
+    return written
+
+
+def read_records(file_name) -> list[dict]:
+    with open(file_name, encoding="utf-8") as f:
+        return json.load(f)["data"]
+
+
+def test_write_block_is_written_once(tmp_path, create_data_service, writes):
+    data_service = create_data_service(tmp_path)
+
+    with data_service.write():
+        users_db = data_service.get_users_db()
+        first_id = users_db.add({"userName": "a"})
+        users_db.add({"userName": "b"})
+        users_db.updateById(first_id, {"userName": "c"})
+
+        # Nothing is written until the block ends
+        assert writes == []
+
+    # Only the changed table is written
+    assert writes == ["users.json"]
+    assert [user["userName"] for user in read_records(tmp_path / "users.json")] == ["c", "b"]
+
+
+def test_nested_blocks_are_written_when_the_outermost_ends(tmp_path, create_data_service, writes):
+    data_service = create_data_service(tmp_path)
+
+    with data_service:
+        with data_service.write():
+            data_service.get_users_db().add({"userName": "a"})
+
+        assert writes == []
+
+        data_service.get_dashboards_db().add({"name": "d"})
+
+    assert sorted(writes) == ["dashboards.json", "users.json"]
+
+
+def test_change_outside_a_block_is_written(tmp_path, create_data_service, writes):
+    data_service = create_data_service(tmp_path)
+
+    data_service.get_users_db().add({"userName": "a"})
+    data_service.get_users_db().add({"userName": "b"})
+
+    assert writes == ["users.json", "users.json"]
+
+
+def test_failed_block_still_commits(tmp_path, create_data_service, writes):
+    data_service = create_data_service(tmp_path)
+
+    # The JSON tables can't roll back, the changes made before the failure are written
+    with pytest.raises(RuntimeError):
+        with data_service.write():
+            data_service.get_users_db().add({"userName": "a"})
+            raise RuntimeError("failed")
+
+    assert writes == ["users.json"]
+    assert [user["userName"] for user in read_records(tmp_path / "users.json")] == ["a"]
+
+
+def test_blocks_in_a_commit_interval_are_written_once(tmp_path, create_data_service, writes):
+    data_service = create_data_service(tmp_path, commit_interval_ms=200)
+
+    for name in ["a", "b", "c"]:
+        with data_service.write():
+            data_service.get_users_db().add({"userName": name})
+
+    assert writes == []
+
+    deadline = time.time() + 5
+    while len(writes) == 0 and time.time() < deadline:
+        time.sleep(0.05)
+
+    # Allow for a second (wrong) write to show up
+    time.sleep(0.3)
+
+    assert writes == ["users.json"]
+    assert len(read_records(tmp_path / "users.json")) == 3
+
+
+def test_commit_writes_pending_changes_now(tmp_path, create_data_service, writes):
+    data_service = create_data_service(tmp_path, commit_interval_ms=60000)
+
+    with data_service.write():
+        data_service.get_users_db().add({"userName": "a"})
+
+    data_service.commit()
+    data_service.commit()
+
+    assert writes == ["users.json"]
+
+
+def test_write_through_table_writes_each_change(tmp_path, writes):
+    table = IndexedJsonTable(db.getDb(str(tmp_path / "users.json")), ["userName"])
+
+    table.add({"userName": "a"})
+    table.add({"userName": "b"})
+    assert writes == ["users.json", "users.json"]
+
+    # A block of changes is one write
+    with table._IndexedJsonTable__lock.write():
+        table.add({"userName": "c"})
+        table.add({"userName": "d"})
+
+    table.flush()
+    assert len(writes) == 3
+    assert len(read_records(tmp_path / "users.json")) == 4
+
+
+def test_flush_replaces_the_file_atomically(tmp_path, monkeypatch):
+    file_name = tmp_path / "users.json"
+    table = IndexedJsonTable(db.getDb(str(file_name)), write_back=True)
+    table.add({"userName": "a"})
+    table.flush()
+
+    def failing_replace(source, destination):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    table.add({"userName": "b"})
+
+    with pytest.raises(OSError):
+        table.flush()
+
+    # The old file is left whole and the temporary file is removed
+    assert [user["userName"] for user in read_records(file_name)] == ["a"]
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".tmp")] == []
+
+    # Still dirty, so the next flush writes the change
+    monkeypatch.undo()
+    table.flush()
+    assert [user["userName"] for user in read_records(file_name)] == ["a", "b"]
+
+
+@pytest.mark.parametrize("durability, syncs", [("off", 0), ("normal", 1), ("full", 2)])
+def test_flush_syncs_for_durability(tmp_path, monkeypatch, durability, syncs):
+    table = IndexedJsonTable(db.getDb(str(tmp_path / "users.json")), write_back=True, durability=durability)
+    table.add({"userName": "a"})
+
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd) or fsync(fd))
+
+    table.flush()
+
+    # The file, then its directory entry
+    assert len(synced) == syncs
+
+
+def test_serialized_records_match_the_pysondb_layout(tmp_path):
+    records = [{"name": name, "layout": {"rows": [1, 2]}, "id": record_id}
+               for record_id, name in [(1, "a"), (2, "b"), (3, "c")]]
+
+    for file_name in ["plain.json", "cached.json"]:
+        with open(tmp_path / file_name, "w", encoding="utf-8") as f:
+            json.dump({"data": records}, f)
+
+    plain = IndexedJsonTable(db.getDb(str(tmp_path / "plain.json")), write_back=True)
+    cached = IndexedJsonTable(db.getDb(str(tmp_path / "cached.json")), write_back=True, cache_serialized=True)
+
+    for table in [plain, cached]:
+        table.updateById(2, {"name": "changed"})
+        table.deleteById(3)
+        table.flush()
+
+    assert (tmp_path / "cached.json").read_text() == (tmp_path / "plain.json").read_text()
+
+
+def write_json_records(file_name, records: list[dict]) -> None:
+    with open(file_name, "w", encoding="utf-8") as f:
+        json.dump({"data": records}, f)
+
+
+def test_json_files_are_imported_to_sqlite_once(tmp_path, create_data_service):
+    write_json_records(tmp_path / "users.json", [
+        {"userName": "a", "id": 1}, {"userName": "b", "id": 2}])
+    write_json_records(tmp_path / "dashboards.json", [
+        {"name": "d", "layout": {"rows": []}, "id": 3}])
+
+    data_service = create_data_service(tmp_path, engine="sqlite")
+
+    assert data_service.get_users_db().getById(2) == {"userName": "b", "id": 2}
+    assert data_service.get_dashboards_db().getById(3)["layout"] == {"rows": []}
+
+    # Changes to the files after the import are not copied again
+    write_json_records(tmp_path / "users.json", [{"userName": "c", "id": 4}])
+
+    data_service = create_data_service(tmp_path, engine="sqlite")
+
+    assert [user["id"] for user in data_service.get_users_db().getAll()] == [1, 2]
+
+
+def test_sqlite_write_block_is_one_transaction(tmp_path, create_data_service):
+    data_service = create_data_service(tmp_path, engine="sqlite")
+    other_data_service = create_data_service(tmp_path, engine="sqlite")
+
+    with data_service.write():
+        data_service.get_users_db().add({"userName": "a"})
+        data_service.get_users_db().add({"userName": "b"})
+
+        # Not seen by another process until the block ends
+        assert other_data_service.get_users_db().count() == 0
+
+    assert other_data_service.get_users_db().count() == 2
+
+    # A failed block is rolled back
+    with pytest.raises(RuntimeError):
+        with data_service.write():
+            data_service.get_users_db().add({"userName": "c"})
+            raise RuntimeError("failed")
+
+    assert data_service.get_users_db().count() == 2
+    assert other_data_service.get_users_db().count() == 2
+
+
+def legacy_user_token(record_id: int, user_name: str, expiry: str) -> dict:
+    return {
+        "userName": user_name,
+        "accessToken": "signed access token",
+        "accessTokenJti": f"access-{record_id}",
+        "accessTokenExpiry": expiry,
+        "refreshToken": "signed refresh token",
+        "refreshTokenJti": f"refresh-{record_id}",
+        "refreshTokenExpiry": expiry,
+        "id": record_id
+    }
+
+
+@pytest.mark.parametrize("engine", ["json", "sqlite"])
+def test_legacy_user_tokens_are_migrated_once(tmp_path, create_data_service, caplog, engine):
+    write_json_records(tmp_path / "users.json", [{"userName": "a", "id": 1}])
+    write_json_records(tmp_path / "user_tokens.json", [
+        legacy_user_token(10, "a", "2030-01-01T00:00:00+00:00"),
+        legacy_user_token(11, "deleted", "2030-01-01T00:00:00+00:00"),
+        legacy_user_token(12, "a", "not a date")
+    ])
+
+    with caplog.at_level("INFO"):
+        data_service = create_data_service(tmp_path, engine=engine)
+
+    assert [
+        {key: value for key, value in token.items() if key != "id"}
+        for token in data_service.get_user_tokens_db().getAll()
+    ] == [{
+        "userId": 1,
+        "accessTokenJti": "access-10",
+        "accessTokenExpiry": 1893456000,
+        "refreshTokenJti": "refresh-10",
+        "refreshTokenExpiry": 1893456000
+    }]
+
+    assert "migrated 1 of 3 user tokens" in caplog.text
+    assert "dropped 2 user tokens" in caplog.text
+
+    # Startup doesn't look at the tokens again once they have been migrated, so a legacy token
+    # added now is left alone
+    data_service.get_user_tokens_db().add(legacy_user_token(13, "a", "2030-01-01T00:00:00+00:00"))
+    data_service._DataService__shutdown()
+    caplog.clear()
+
+    data_service = create_data_service(tmp_path, engine=engine)
+
+    assert "user tokens" not in caplog.text
+    assert len(data_service.get_user_tokens_db().getBy({"userName": "a"})) == 1
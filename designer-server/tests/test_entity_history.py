@@ -0,0 +1,161 @@
+import struct
+from array import array
+from time import time
+from services.entity_history_service import EntityHistoryService, _RingBuffer, _downsample
+
+
+def test_ring_buffer_grows_then_wraps():
+    buffer = _RingBuffer(3, 0)
+
+    assert [buffer.append(t, t * 10) for t in [1, 2, 3]] == [12, 12, 12]
+
+    # Full, the oldest sample is overwritten and the buffer stays the same size
+    assert buffer.append(4, 40) == 0
+    assert buffer.append(5, 50) == 0
+
+    times, values = buffer.read(0)
+    assert list(times) == [3, 4, 5]
+    assert list(values) == [30, 40, 50]
+    assert buffer.get_bytes() == 36
+
+
+def test_ring_buffer_read_since_after_wrapping():
+    buffer = _RingBuffer(4, 0)
+
+    for t in range(1, 11):
+        buffer.append(t, t)
+
+    times, values = buffer.read(8.5)
+    assert list(times) == [9, 10]
+    assert list(values) == [9, 10]
+
+    assert list(buffer.read(100)[0]) == []
+
+
+def test_ring_buffer_samples_in_one_slot_keep_the_latest_value():
+    buffer = _RingBuffer(10, 10)
+
+    buffer.append(100, 1)
+    buffer.append(105, 2)
+    buffer.append(109.9, 3)
+    buffer.append(110, 4)
+
+    times, values = buffer.read(0)
+    assert list(times) == [100, 110]
+    assert list(values) == [3, 4]
+
+
+def test_ring_buffer_slots_after_wrapping():
+    buffer = _RingBuffer(2, 10)
+
+    for t in [0, 10, 20, 25]:
+        buffer.append(t, t)
+
+    times, values = buffer.read(0)
+    assert list(times) == [10, 20]
+    assert list(values) == [10, 25]
+
+
+def test_downsample_averages_time_buckets():
+    times = array("d", [0, 1, 2, 3, 10, 11])
+    values = array("f", [1, 3, 5, 7, 10, 20])
+
+    out_times, out_values = _downsample(times, values, 2)
+
+    # Buckets [0, 5.5) and [5.5, 11]
+    assert list(out_times) == [1.5, 10.5]
+    assert list(out_values) == [4, 15]
+
+
+def test_downsample_leaves_out_empty_buckets_and_small_inputs():
+    times = array("d", [0, 1, 100])
+    values = array("f", [1, 1, 2])
+
+    out_times, _ = _downsample(times, values, 10)
+    assert list(out_times) == [0, 1, 100]
+
+    out_times, out_values = _downsample(times, values, 2)
+    assert list(out_times) == [0.5, 100]
+    assert list(out_values) == [1, 2]
+
+    # All at the same time
+    out_times, out_values = _downsample(array("d", [5, 5, 5]), array("f", [1, 2, 3]), 2)
+    assert list(out_times) == [5]
+    assert list(out_values) == [2]
+
+
+def create_history(**config) -> EntityHistoryService:
+    return EntityHistoryService({"hours": 1, "samples_per_entity": 3600, **config})
+
+
+def test_only_numeric_states_are_recorded():
+    history = create_history()
+
+    for state in ["on", None, "nan", "inf", ""]:
+        history.record("sensor.a", state)
+
+    assert history.get_history("sensor.a") is None
+
+    history.record("sensor.a", "21.5")
+    times, values = history.get_history("sensor.a")
+    assert list(values) == [21.5]
+
+
+def test_old_samples_are_left_out():
+    history = create_history()
+    now = time()
+
+    history.record("sensor.a", 1, now - 7200)
+    history.record("sensor.a", 2, now - 1800)
+    history.record("sensor.a", 3, now - 60)
+
+    assert list(history.get_history("sensor.a")[1]) == [2, 3]
+    assert list(history.get_history("sensor.a", hours=0.25)[1]) == [3]
+
+
+def test_least_recently_used_entities_are_evicted():
+    # Room for 20 samples in all, 10 for each entity, one every 6 minutes
+    history = create_history(samples_per_entity=10, max_bytes=240)
+    now = time()
+
+    for i in range(10):
+        history.record("sensor.a", i, now - 3500 + i * 360)
+        history.record("sensor.b", i, now - 3500 + i * 360)
+
+    # Reading a makes b the coldest
+    history.get_history("sensor.a")
+
+    for i in range(10):
+        history.record("sensor.c", i, now - 3500 + i * 360)
+
+    assert history.get_history("sensor.b") is None
+    assert history.get_history("sensor.a") is not None
+    assert history.get_stats()["bytes"] <= 240
+    assert history.get_stats()["evictions"] == 1
+
+
+def test_one_entity_never_holds_more_than_the_cap():
+    history = create_history(samples_per_entity=1000, max_bytes=120)
+    now = time()
+
+    for i in range(100):
+        history.record("sensor.a", i, now - (99 - i) * 360 - 1)
+
+    assert len(history.get_history("sensor.a")[0]) == 10
+    assert history.get_stats()["bytes"] == 120
+
+
+def test_forget_frees_the_bytes():
+    history = create_history()
+    history.record("sensor.a", 1)
+    history.forget("sensor.a")
+
+    assert history.get_history("sensor.a") is None
+    assert history.get_stats()["bytes"] == 0
+
+
+def test_binary_format():
+    data = EntityHistoryService.to_binary(array("d", [1.5, 2.5]), array("f", [3.25, 4.5]))
+
+    assert len(data) == 4 + 2 * 8 + 2 * 4
+    assert struct.unpack("<I2d2f", data) == (2, 1.5, 2.5, 3.25, 4.5)
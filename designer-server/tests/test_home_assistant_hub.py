@@ -0,0 +1,382 @@
+import asyncio
+import json
+import time
+from typing import Optional
+from services.home_assistant_hub_service import (
+    HomeAssistantHubService,
+    HubClient,
+    _apply_entity_change,
+    _diff_entity,
+    _expand_entity,
+)
+
+
+class FakeDashboardIndex:
+    # Just what the hub uses of the dashboard index
+    def __init__(self, dashboards: Optional[dict[int, set[str]]] = None):
+        self.dashboards = dashboards or {}
+
+    def subscribe(self, callback) -> None:
+        pass
+
+    def unsubscribe(self, callback) -> None:
+        pass
+
+    def get_dashboard_entities(self, dashboard_id: int) -> Optional[set[str]]:
+        entities = self.dashboards.get(dashboard_id)
+        return None if entities is None else set(entities)
+
+
+class FakeEntityHistory:
+    def record(self, entity_id: str, state: object) -> None:
+        pass
+
+    def forget(self, entity_id: str) -> None:
+        pass
+
+
+def create_hub(dashboards: Optional[dict[int, set[str]]] = None, **hub_config) -> HomeAssistantHubService:
+    # Changes are sent as they arrive so no event loop is needed
+    return HomeAssistantHubService(
+        FakeDashboardIndex(dashboards), FakeEntityHistory(), "http://localhost:8123", "token",
+        {"coalesce_window_ms": 0, **hub_config})
+
+
+def receive(hub: HomeAssistantHubService, event: dict, full_update: bool = False) -> None:
+    hub._HomeAssistantHubService__on_entities_event(event, full_update)
+
+
+def parse(event: str) -> tuple[Optional[str], str, dict]:
+    fields = dict(line.split(": ", 1) for line in event.strip().split("\n"))
+    return fields.get("id"), fields["event"], json.loads(fields["data"])
+
+
+def compressed(state: str, attributes: Optional[dict] = None, secs: float = 1000.0) -> dict:
+    return {"s": state, "a": attributes or {}, "c": "ctx", "lc": secs, "lu": secs}
+
+
+def test_expand_entity():
+    entity = _expand_entity("light.a", {"s": "on", "a": {"b": 1}, "c": "x", "lc": 0, "lu": 1.5})
+
+    assert entity == {
+        "entity_id": "light.a",
+        "state": "on",
+        "attributes": {"b": 1},
+        "context": {"id": "x", "parent_id": None, "user_id": None},
+        "last_changed": "1970-01-01T00:00:00.000Z",
+        "last_updated": "1970-01-01T00:00:01.500Z"
+    }
+
+
+def test_apply_entity_change_copies_and_applies():
+    entity = _expand_entity("light.a", compressed("off", {"b": 1, "c": 2}))
+    original = json.loads(json.dumps(entity))
+
+    changed = _apply_entity_change(entity, {"+": {"s": "on", "lc": 2000, "a": {"b": 5}, "c": "y"}, "-": {"a": ["c"]}})
+
+    assert entity == original
+    assert changed["state"] == "on"
+    assert changed["attributes"] == {"b": 5}
+    assert changed["context"]["id"] == "y"
+    assert changed["last_changed"] == changed["last_updated"] == "1970-01-01T00:33:20.000Z"
+
+
+def test_apply_entity_change_keeps_unchanged_attributes_object():
+    entity = _expand_entity("light.a", compressed("off", {"b": 1}))
+    changed = _apply_entity_change(entity, {"+": {"lu": 2000}})
+
+    assert changed["attributes"] is entity["attributes"]
+    assert changed["last_changed"] == entity["last_changed"]
+    assert changed["last_updated"] == "1970-01-01T00:33:20.000Z"
+
+
+def test_diff_entity_only_holds_changes():
+    old = _expand_entity("light.a", compressed("off", {"b": 1, "c": 2}))
+    new = _apply_entity_change(old, {"+": {"s": "on", "lc": 2000, "a": {"b": 5}, "c": "y"}, "-": {"a": ["c"]}})
+
+    assert _diff_entity(old, new) == {
+        "s": "on",
+        "a": {"b": 5},
+        "r": ["c"],
+        "c": "y",
+        "lc": "1970-01-01T00:33:20.000Z"
+    }
+
+
+def test_diff_entity_last_updated_alone():
+    old = _expand_entity("light.a", compressed("off"))
+    new = _apply_entity_change(old, {"+": {"lu": 2000}})
+
+    assert _diff_entity(old, new) == {"lu": "1970-01-01T00:33:20.000Z"}
+    assert _diff_entity(old, old) == {}
+
+
+def test_diff_entity_full_context_when_more_than_id_changes():
+    old = _expand_entity("light.a", compressed("off"))
+    new = dict(old, context={"id": "z", "parent_id": "p", "user_id": None})
+
+    assert _diff_entity(old, new) == {"c": new["context"]}
+
+
+def test_snapshot_then_numbered_deltas():
+    hub = create_hub()
+    receive(hub, {"a": {"light.a": compressed("off"), "sensor.b": compressed("1")}}, True)
+
+    client = hub.subscribe()
+    snapshot_id, event, snapshot = parse(hub.take(client, 0)[0])
+    assert event == "snapshot"
+
+    # The first full update was itself a delta
+    assert snapshot["seq"] == 1
+    assert set(snapshot["entities"]) == {"light.a", "sensor.b"}
+
+    receive(hub, {"c": {"light.a": {"+": {"s": "on", "lc": 2000}}}})
+    receive(hub, {"r": ["sensor.b"]})
+    receive(hub, {"a": {"sensor.c": compressed("2")}})
+
+    deltas = [parse(e) for e in hub.take(client, 0)]
+
+    assert [data["seq"] for _, _, data in deltas] == [2, 3, 4]
+    assert deltas[0][2]["changed"] == {"light.a": {"s": "on", "lc": "1970-01-01T00:33:20.000Z"}}
+    assert deltas[1][2]["removed"] == ["sensor.b"]
+    assert "sensor.c" in deltas[2][2]["added"]
+
+    # Event IDs carry the sequence number for resuming
+    assert deltas[2][0] == snapshot_id[:-1] + "4"
+
+
+def test_no_delta_when_nothing_changed():
+    hub = create_hub()
+    receive(hub, {"a": {"light.a": compressed("off")}}, True)
+    client = hub.subscribe()
+    hub.take(client, 0)
+
+    receive(hub, {"a": {"light.a": compressed("off")}})
+
+    assert hub.take(client, 0) == []
+
+
+def test_full_update_removes_missing_entities():
+    hub = create_hub()
+    receive(hub, {"a": {"light.a": compressed("off"), "light.b": compressed("on")}}, True)
+    client = hub.subscribe()
+    hub.take(client, 0)
+
+    receive(hub, {"a": {"light.a": compressed("off")}}, True)
+
+    _, _, delta = parse(hub.take(client, 0)[0])
+    assert delta["removed"] == ["light.b"]
+
+
+def test_reconnecting_client_gets_only_missed_deltas():
+    hub = create_hub()
+    receive(hub, {"a": {"light.a": compressed("off")}}, True)
+
+    client = hub.subscribe()
+    hub.take(client, 0)
+    receive(hub, {"c": {"light.a": {"+": {"s": "on", "lc": 2000}}}})
+    last_id, _, _ = parse(hub.take(client, 0)[0])
+    hub.unsubscribe(client)
+
+    receive(hub, {"c": {"light.a": {"+": {"s": "off", "lc": 3000}}}})
+    receive(hub, {"c": {"light.a": {"+": {"s": "on", "lc": 4000}}}})
+
+    client = hub.subscribe(None, last_id)
+    events = [parse(e) for e in hub.take(client, 0)]
+
+    assert events[0][1] == "status"
+    assert [data["seq"] for _, event, data in events if event == "delta"] == [3, 4]
+
+
+def test_reconnect_with_unknown_or_old_id_gets_snapshot():
+    hub = create_hub(history_size=1)
+    receive(hub, {"a": {"light.a": compressed("off")}}, True)
+    client = hub.subscribe()
+    first_id, _, _ = parse(hub.take(client, 0)[0])
+
+    for secs in [2000, 3000, 4000]:
+        receive(hub, {"c": {"light.a": {"+": {"lu": secs}}}})
+
+    # Only the last delta is kept, so the gap can't be filled
+    assert parse(hub.take(hub.subscribe(None, first_id), 0)[0])[1] == "snapshot"
+    assert parse(hub.take(hub.subscribe(None, "other-run.all-1"), 0)[0])[1] == "snapshot"
+    assert parse(hub.take(hub.subscribe(None, first_id[:-1] + "99"), 0)[0])[1] == "snapshot"
+
+
+def test_client_that_falls_behind_is_resynced():
+    hub = create_hub(client_queue_size=2)
+    receive(hub, {"a": {"light.a": compressed("off")}}, True)
+    client = hub.subscribe()
+    hub.take(client, 0)
+
+    for secs in [2000, 3000, 4000]:
+        receive(hub, {"c": {"light.a": {"+": {"lu": secs}}}})
+
+    events = [parse(e) for e in hub.take(client, 0)]
+
+    # Queued changes are dropped for a snapshot at the current sequence number
+    assert [event for _, event, _ in events] == ["snapshot"]
+    assert events[0][2]["seq"] == 4
+    assert hub.get_stats()["resyncs"] == 1
+
+    receive(hub, {"c": {"light.a": {"+": {"lu": 5000}}}})
+    assert parse(hub.take(client, 0)[0])[2]["seq"] == 5
+
+
+def test_dashboard_topic_only_gets_its_entities():
+    hub = create_hub({7: {"light.*", "switch.a"}})
+    receive(hub, {"a": {
+        "light.a": compressed("off"),
+        "switch.a": compressed("off"),
+        "switch.b": compressed("off"),
+        "sensor.c": compressed("1")
+    }}, True)
+
+    client = hub.subscribe(7)
+    _, _, snapshot = parse(hub.take(client, 0)[0])
+    assert set(snapshot["entities"]) == {"light.a", "switch.a"}
+
+    receive(hub, {"c": {"sensor.c": {"+": {"s": "2", "lc": 2000}}}})
+    assert hub.take(client, 0) == []
+
+    receive(hub, {"a": {"light.new": compressed("on")}})
+    _, _, delta = parse(hub.take(client, 0)[0])
+    assert delta["seq"] == 1
+    assert list(delta["added"]) == ["light.new"]
+
+
+def test_dashboard_topic_is_dropped_with_its_last_client():
+    hub = create_hub({7: {"light.a"}})
+    receive(hub, {"a": {"light.a": compressed("off")}}, True)
+
+    first = hub.subscribe(7)
+    second = hub.subscribe(7)
+    assert hub.get_stats()["topics"] == 2
+
+    hub.unsubscribe(first)
+    assert hub.get_stats()["topics"] == 2
+
+    hub.unsubscribe(second)
+    assert hub.get_stats()["topics"] == 1
+
+    # The all entities topic stays however many clients it has
+    hub.unsubscribe(hub.subscribe())
+    assert hub.get_stats()["topics"] == 1
+
+
+def test_resubscribe_rebuilds_dropped_topic():
+    hub = create_hub({7: {"light.a"}})
+    receive(hub, {"a": {"light.a": compressed("off")}}, True)
+
+    client = hub.subscribe(7)
+    hub.take(client, 0)
+    receive(hub, {"c": {"light.a": {"+": {"s": "on", "lc": 2000}}}})
+    last_id, _, _ = parse(hub.take(client, 0)[0])
+    hub.unsubscribe(client)
+
+    receive(hub, {"c": {"light.a": {"+": {"s": "off", "lc": 3000}}}})
+
+    # The change was made while nothing held the topic, so the panel starts from a snapshot
+    client = hub.subscribe(7, last_id)
+    event_id, event, snapshot = parse(hub.take(client, 0)[0])
+    assert event == "snapshot"
+    assert snapshot["entities"]["light.a"]["state"] == "off"
+    assert event_id != last_id
+
+    receive(hub, {"c": {"light.a": {"+": {"s": "on", "lc": 4000}}}})
+    _, event, delta = parse(hub.take(client, 0)[0])
+    assert event == "delta"
+    assert delta["seq"] == 1
+
+
+async def take_within(hub: HomeAssistantHubService, client: HubClient, secs: float) -> list[str]:
+    # Lets the hub's flush timer run until the client has events or the time is up
+    deadline = time.monotonic() + secs
+    events = hub.take(client, 0)
+
+    while len(events) == 0 and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+        events = hub.take(client, 0)
+
+    return events
+
+
+def test_changes_in_window_are_coalesced_into_one_delta():
+    async def run():
+        hub = create_hub(coalesce_window_ms=50)
+        receive(hub, {"a": {"light.a": compressed("off")}}, True)
+        client = hub.subscribe()
+        _, _, snapshot = parse(hub.take(client, 0)[0])
+
+        for state, secs in [("on", 2000), ("off", 3000), ("on", 4000)]:
+            receive(hub, {"c": {"light.a": {"+": {"s": state, "lc": secs}}}})
+
+        # Nothing goes out until the window is over
+        assert hub.take(client, 0) == []
+
+        events = [parse(e) for e in await take_within(hub, client, 2)]
+        assert len(events) == 1
+
+        _, event, delta = events[0]
+        assert event == "delta"
+        assert delta["seq"] == snapshot["seq"] + 1
+        assert delta["changed"]["light.a"]["s"] == "on"
+
+        await asyncio.sleep(0.1)
+        assert hub.take(client, 0) == []
+
+        stats = hub.get_stats()
+        assert stats["updatesReceived"] == 4
+        assert stats["updatesDropped"] == 2
+        assert stats["updatesDelivered"] == 2
+
+    asyncio.run(run())
+
+
+def test_min_interval_holds_back_changes_entity_over_domain():
+    async def run():
+        hub = create_hub(coalesce_window_ms=20, min_interval_secs={
+            "sensor": 0.5, "sensor.fast": 0})
+        receive(hub, {"a": {
+            "sensor.slow": compressed("1"),
+            "sensor.fast": compressed("1")
+        }}, True)
+        client = hub.subscribe()
+        hub.take(client, 0)
+        start = time.monotonic()
+
+        receive(hub, {"c": {
+            "sensor.slow": {"+": {"s": "2", "lc": 2000}},
+            "sensor.fast": {"+": {"s": "2", "lc": 2000}}
+        }})
+
+        # The entity's own interval wins, so only the slow sensor is held back
+        _, _, delta = parse((await take_within(hub, client, 2))[0])
+        assert set(delta["changed"]) == {"sensor.fast"}
+
+        receive(hub, {"c": {"sensor.slow": {"+": {"s": "3", "lc": 3000}}}})
+
+        _, _, delta = parse((await take_within(hub, client, 2))[0])
+        assert time.monotonic() - start >= 0.5
+        assert set(delta["changed"]) == {"sensor.slow"}
+        assert delta["changed"]["sensor.slow"]["s"] == "3"
+
+        stats = hub.get_stats()
+        assert stats["updatesDropped"] == 1
+        assert stats["updatesDelivered"] == 4
+
+    asyncio.run(run())
+
+
+def test_hub_client_overflow_needs_resync():
+    client = HubClient(2, None)
+
+    assert client.put("a")
+    assert client.put("b")
+    assert not client.put("c")
+    assert client.needs_resync()
+    assert client.take(0) == []
+
+    assert client.restart("snapshot")
+    assert not client.needs_resync()
+    assert client.take(0) == ["snapshot"]
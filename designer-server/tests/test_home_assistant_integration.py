@@ -0,0 +1,214 @@
+"""
+Runs the hub against the stand-in home assistant in tools/fake_home_assistant.py, over a real
+websocket connection.
+"""
+import asyncio
+import socket
+import threading
+import time
+from typing import Callable, Optional
+import pytest
+from tools import fake_home_assistant
+from websockets.asyncio.server import serve
+from exceptions.home_assistant_exceptions import (
+    HomeAssistantServiceCallException,
+    HomeAssistantServiceNotAllowedException,
+)
+from services.entity_history_service import EntityHistoryService
+from services.home_assistant_hub_service import HomeAssistantHubService
+
+TOKEN = "test-token"
+
+
+class FakeHomeAssistant:
+    # Serves the stand-in on its own thread and loop so it can be stopped and started again
+    def __init__(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__stop: Optional[asyncio.Event] = None
+        self.__thread: Optional[threading.Thread] = None
+
+        fake_home_assistant.entities.clear()
+        fake_home_assistant.subscriptions.clear()
+        fake_home_assistant.create_entities()
+
+    def start(self) -> None:
+        started = threading.Event()
+
+        async def run() -> None:
+            self.__stop = asyncio.Event()
+
+            async with serve(lambda websocket: fake_home_assistant.handle(websocket, TOKEN), "127.0.0.1", self.port):
+                started.set()
+                await self.__stop.wait()
+
+        def run_loop() -> None:
+            self.__loop = asyncio.new_event_loop()
+            self.__loop.run_until_complete(run())
+
+            # Connections still opening when the server stopped
+            tasks = asyncio.all_tasks(self.__loop)
+
+            for task in tasks:
+                task.cancel()
+
+            self.__loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.__loop.close()
+
+        self.__thread = threading.Thread(target=run_loop, daemon=True)
+        self.__thread.start()
+        assert started.wait(5)
+
+    def stop(self) -> None:
+        # Closes the server and every connection to it
+        self.__loop.call_soon_threadsafe(self.__stop.set)
+        self.__thread.join(5)
+
+
+class FakeDashboardIndex:
+    def subscribe(self, callback) -> None:
+        pass
+
+    def unsubscribe(self, callback) -> None:
+        pass
+
+    def get_dashboard_entities(self, dashboard_id: int) -> Optional[set[str]]:
+        return None
+
+
+def wait_for(condition: Callable[[], bool], timeout_secs: float = 5) -> None:
+    deadline = time.monotonic() + timeout_secs
+
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def home_assistant():
+    home_assistant = FakeHomeAssistant()
+    home_assistant.start()
+    yield home_assistant
+    home_assistant.stop()
+
+
+@pytest.fixture
+def create_hub():
+    hubs = []
+
+    def create(url: str, token: str = TOKEN, **hub_config) -> HomeAssistantHubService:
+        hub = HomeAssistantHubService(
+            FakeDashboardIndex(), EntityHistoryService({}), url, token,
+            {"reconnect_min_secs": 0.1, "reconnect_max_secs": 0.8, "coalesce_window_ms": 0, **hub_config})
+        hub.start()
+        hubs.append(hub)
+        return hub
+
+    yield create
+
+    for hub in hubs:
+        hub.stop()
+        hub._HomeAssistantHubService__thread.join(5)
+
+
+def test_hub_authenticates_and_gets_every_entity(home_assistant, create_hub):
+    hub = create_hub(home_assistant.url)
+
+    wait_for(lambda: hub.get_stats()["connected"])
+
+    entities = hub.get_entities()
+    assert set(entities) == set(fake_home_assistant.entities)
+    assert entities["light.lounge"]["state"] == "on"
+    assert entities["light.lounge"]["attributes"]["brightness"] == 180
+    assert hub.get_stats()["connects"] == 1
+
+
+def test_wrong_token_is_refused(home_assistant, create_hub):
+    hub = create_hub(home_assistant.url, token="wrong")
+
+    wait_for(lambda: hub.get_stats()["connectFailures"] >= 2)
+
+    assert not hub.get_stats()["connected"]
+    assert hub.get_entities() == {}
+
+
+def test_service_call_round_trip(home_assistant, create_hub):
+    hub = create_hub(home_assistant.url)
+    wait_for(lambda: hub.get_stats()["connected"])
+
+    client = hub.subscribe()
+    client.take(1)
+
+    result = hub.call_service("switch", "turn_on", {"entity_id": "switch.kitchen_light"})
+    assert "context" in result
+
+    # Home assistant sends the change back on the entity subscription
+    wait_for(lambda: hub.get_entities()["switch.kitchen_light"]["state"] == "on")
+    events = client.take(1)
+    assert any('"switch.kitchen_light":{"s":"on"' in event for event in events)
+
+    with pytest.raises(HomeAssistantServiceCallException):
+        hub.call_service("switch", "turn_on", {"entity_id": "switch.missing"})
+
+
+def test_only_allowed_services_are_called(home_assistant, create_hub):
+    hub = create_hub(home_assistant.url, allowed_services=["switch.turn_on"])
+    wait_for(lambda: hub.get_stats()["connected"])
+
+    for domain, service_name in [("homeassistant", "restart"), ("lock", "unlock"), ("switch", "turn_off")]:
+        with pytest.raises(HomeAssistantServiceNotAllowedException):
+            hub.call_service(domain, service_name, {})
+
+    hub.call_service("switch", "turn_on", {"entity_id": "switch.kitchen_light"})
+
+    assert hub.get_stats()["serviceCalls"] == 1
+    assert hub.get_stats()["serviceCallsRefused"] == 3
+
+    # By default the domains the panels use
+    default_hub = create_hub(home_assistant.url)
+    assert default_hub.is_service_allowed("light", "turn_on")
+    assert default_hub.is_service_allowed("switch", "toggle")
+    assert not default_hub.is_service_allowed("homeassistant", "restart")
+
+
+def test_hub_reconnects_with_backoff(home_assistant, create_hub):
+    hub = create_hub(home_assistant.url)
+    wait_for(lambda: hub.get_stats()["connected"])
+
+    client = hub.subscribe()
+    client.take(1)
+
+    home_assistant.stop()
+    wait_for(lambda: not hub.get_stats()["connected"])
+
+    # Panels are told the connection is lost
+    assert any('"connected":false' in event for event in client.take(1))
+
+    # The delay doubles after each failure (0.1, 0.2, 0.4 then 0.8 seconds, less jitter), a
+    # retry without any delay would fail many more times
+    failures = hub.get_stats()["connectFailures"]
+    time.sleep(1.5)
+    assert 2 <= hub.get_stats()["connectFailures"] - failures <= 6
+
+    home_assistant.start()
+    wait_for(lambda: hub.get_stats()["connected"])
+
+    assert hub.get_stats()["connects"] == 2
+    assert any('"connected":true' in event for event in client.take(1))
+
+
+def test_service_endpoint_refuses_services_not_allowed(create_app, admin_headers):
+    client = create_app().test_client()
+    headers = admin_headers(client)
+
+    response = client.post("/home-assistant/services/homeassistant/restart", json={}, headers=headers)
+    assert response.status_code == 403
+
+    # Allowed, but the hub isn't connected in the test app
+    response = client.post(
+        "/home-assistant/services/switch/turn_on", json={"entity_id": "switch.kitchen_light"}, headers=headers)
+    assert response.status_code == 503
@@ -0,0 +1,42 @@
+from services.http_cache import ENCODING_IDENTITY
+from services.index_page_service import IndexPageService
+
+INDEX_HTML = """<html>
+  <body>
+    <input type="hidden" id="api-base-url" value="http://designer-server.lan:8000"></input>
+    <input type="hidden" id="components-version" value=""></input>
+  </body>
+</html>"""
+
+
+class FakeComponentService:
+    def __init__(self):
+        self.version = "v1"
+
+    def get_manifest(self, static_folder: str) -> dict:
+        return {"version": self.version}
+
+
+def render(index_page_service: IndexPageService, index_path, host: str) -> str:
+    return index_page_service.get(str(index_path), host).bodies[ENCODING_IDENTITY].decode()
+
+
+def test_page_is_rendered_for_each_host(tmp_path):
+    index_path = tmp_path / "index.html"
+    index_path.write_text(INDEX_HTML)
+    component_service = FakeComponentService()
+    index_page_service = IndexPageService(component_service)
+
+    page = render(index_page_service, index_path, "panel.lan:8000")
+
+    assert 'id="api-base-url" value="http://panel.lan:8000"' in page
+    assert 'id="components-version" value="v1"' in page
+
+    assert render(index_page_service, index_path, "panel.lan:8000") == page
+    assert render(index_page_service, index_path, "other.lan") != page
+    assert index_page_service.get_stats() == {"entries": 2, "hits": 1, "misses": 2}
+
+    # A new component version renders the pages again
+    component_service.version = "v2"
+    assert 'value="v2"' in render(index_page_service, index_path, "panel.lan:8000")
+
@@ -0,0 +1,140 @@
+import copy
+import pytest
+from exceptions.json_patch_exceptions import JsonPatchException
+from services.json_patch import apply_patch, parse_pointer
+
+
+def test_parse_pointer_unescapes_tokens():
+    assert parse_pointer("") == []
+    assert parse_pointer("/a~1b/c~0d/0") == ["a/b", "c~d", "0"]
+
+    with pytest.raises(JsonPatchException):
+        parse_pointer("a/b")
+
+
+def test_add_to_object_and_array():
+    document = {"a": [1, 2]}
+
+    assert apply_patch(document, [{"op": "add", "path": "/b", "value": 3}]) == {"a": [1, 2], "b": 3}
+    assert apply_patch(document, [{"op": "add", "path": "/a/0", "value": 0}]) == {"a": [0, 1, 2]}
+    assert apply_patch(document, [{"op": "add", "path": "/a/2", "value": 3}]) == {"a": [1, 2, 3]}
+
+    # '-' is the end of the array
+    assert apply_patch(document, [{"op": "add", "path": "/a/-", "value": 3}]) == {"a": [1, 2, 3]}
+
+
+def test_array_index_errors():
+    document = {"a": [1, 2]}
+
+    for path in ["/a/3", "/a/-1", "/a/01", "/a/x"]:
+        with pytest.raises(JsonPatchException):
+            apply_patch(document, [{"op": "add", "path": path, "value": 0}])
+
+    # '-' only means the end for add
+    with pytest.raises(JsonPatchException):
+        apply_patch(document, [{"op": "replace", "path": "/a/-", "value": 0}])
+
+    with pytest.raises(JsonPatchException):
+        apply_patch(document, [{"op": "remove", "path": "/a/2"}])
+
+
+def test_remove_and_replace():
+    document = {"a": {"b": 1, "c": 2}, "d": [1, 2, 3]}
+
+    assert apply_patch(document, [{"op": "remove", "path": "/a/b"}]) == {"a": {"c": 2}, "d": [1, 2, 3]}
+    assert apply_patch(document, [{"op": "remove", "path": "/d/1"}])["d"] == [1, 3]
+    assert apply_patch(document, [{"op": "replace", "path": "/a/c", "value": 5}])["a"] == {"b": 1, "c": 5}
+
+    with pytest.raises(JsonPatchException):
+        apply_patch(document, [{"op": "replace", "path": "/missing", "value": 5}])
+
+    with pytest.raises(JsonPatchException):
+        apply_patch(document, [{"op": "remove", "path": ""}])
+
+
+def test_replace_whole_document():
+    assert apply_patch({"a": 1}, [{"op": "replace", "path": "", "value": [1]}]) == [1]
+
+
+def test_move():
+    document = {"a": {"b": 1}, "c": [1, 2, 3]}
+
+    assert apply_patch(document, [{"op": "move", "from": "/a/b", "path": "/x"}]) == {"a": {}, "c": [1, 2, 3], "x": 1}
+
+    # Within an array the target index is applied after the value is removed
+    assert apply_patch(document, [{"op": "move", "from": "/c/0", "path": "/c/-"}])["c"] == [2, 3, 1]
+    assert apply_patch(document, [{"op": "move", "from": "/c/2", "path": "/c/0"}])["c"] == [3, 1, 2]
+
+    # Moving to the same place changes nothing
+    assert apply_patch(document, [{"op": "move", "from": "/a", "path": "/a"}]) == document
+
+    with pytest.raises(JsonPatchException):
+        apply_patch(document, [{"op": "move", "from": "/a", "path": "/a/b/c"}])
+
+    with pytest.raises(JsonPatchException):
+        apply_patch(document, [{"op": "move", "from": "/missing", "path": "/x"}])
+
+
+def test_copy_is_deep():
+    document = {"a": {"b": [1]}}
+    patched = apply_patch(document, [
+        {"op": "copy", "from": "/a", "path": "/c"},
+        {"op": "add", "path": "/c/b/-", "value": 2}
+    ])
+
+    assert patched == {"a": {"b": [1]}, "c": {"b": [1, 2]}}
+
+
+def test_test_operation():
+    document = {"a": [1, {"b": None}], "n": 1}
+
+    assert apply_patch(document, [
+        {"op": "test", "path": "/a/1/b", "value": None},
+        {"op": "test", "path": "/a", "value": [1, {"b": None}]}
+    ]) == document
+
+    with pytest.raises(JsonPatchException):
+        apply_patch(document, [{"op": "test", "path": "/n", "value": 2}])
+
+    with pytest.raises(JsonPatchException):
+        apply_patch(document, [{"op": "test", "path": "/missing", "value": None}])
+
+
+def test_failed_patch_leaves_document_unchanged():
+    document = {"a": [1, 2], "b": {"c": 1}}
+    original = copy.deepcopy(document)
+
+    with pytest.raises(JsonPatchException):
+        apply_patch(document, [
+            {"op": "add", "path": "/a/-", "value": 3},
+            {"op": "remove", "path": "/b/c"},
+            {"op": "test", "path": "/a/0", "value": 99}
+        ])
+
+    assert document == original
+
+
+def test_successful_patch_does_not_change_the_original():
+    document = {"a": [1, 2], "b": {"c": 1}}
+    original = copy.deepcopy(document)
+
+    patched = apply_patch(document, [
+        {"op": "add", "path": "/a/-", "value": 3},
+        {"op": "replace", "path": "/b/c", "value": 2}
+    ])
+
+    assert document == original
+    assert patched == {"a": [1, 2, 3], "b": {"c": 2}}
+
+
+def test_invalid_operations():
+    for patch in [
+        {"op": "add"},
+        [1],
+        [{"op": "add", "path": "/a"}],
+        [{"op": "move", "path": "/a"}],
+        [{"op": "bogus", "path": "/a"}],
+        [{"op": "add", "value": 1}]
+    ]:
+        with pytest.raises(JsonPatchException):
+            apply_patch({}, patch)
@@ -0,0 +1,148 @@
+import threading
+import time
+import pytest
+from services.rw_lock import ReentrantReadWriteLock
+
+
+def start(target) -> threading.Thread:
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_readers_share_the_lock():
+    lock = ReentrantReadWriteLock()
+    inside = threading.Barrier(3, timeout=2)
+
+    def reader():
+        with lock.read():
+            # Only passes if all three readers hold the lock at once
+            inside.wait()
+
+    threads = [start(reader) for _ in range(3)]
+
+    for thread in threads:
+        thread.join(2)
+
+    assert not inside.broken
+    assert lock.get_stats()["readers"] == 0
+
+
+def test_read_and_write_are_reentrant():
+    lock = ReentrantReadWriteLock()
+
+    with lock.write():
+        with lock.write():
+            # A writer may also read
+            with lock.read():
+                assert lock.is_write_locked_by_current_thread()
+
+        assert lock.is_write_locked_by_current_thread()
+
+    assert not lock.is_write_locked_by_current_thread()
+
+    with lock.read():
+        with lock.read():
+            pass
+
+    assert lock.get_stats()["readers"] == 0
+
+
+def test_upgrading_a_read_lock_raises():
+    lock = ReentrantReadWriteLock()
+
+    with lock.read():
+        with pytest.raises(RuntimeError):
+            lock.acquire_write()
+
+    # The failed upgrade left nothing behind
+    with lock.write():
+        pass
+
+
+def test_releasing_a_lock_not_held_raises():
+    lock = ReentrantReadWriteLock()
+
+    with pytest.raises(RuntimeError):
+        lock.release_read()
+
+    with pytest.raises(RuntimeError):
+        lock.release_write()
+
+
+def test_writer_excludes_readers():
+    lock = ReentrantReadWriteLock()
+    events = []
+
+    lock.acquire_write()
+
+    def reader():
+        with lock.read():
+            events.append("read")
+
+    thread = start(reader)
+    time.sleep(0.1)
+    assert events == []
+
+    events.append("write released")
+    lock.release_write()
+    thread.join(2)
+
+    assert events == ["write released", "read"]
+
+
+def test_waiting_writer_blocks_new_readers():
+    lock = ReentrantReadWriteLock()
+    events = []
+
+    lock.acquire_read()
+
+    def writer():
+        with lock.write():
+            events.append("write")
+
+    def late_reader():
+        with lock.read():
+            events.append("late read")
+
+    writer_thread = start(writer)
+
+    # Wait until the writer is queued behind the first reader
+    deadline = time.monotonic() + 2
+    while lock.get_stats()["waitingWriters"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    reader_thread = start(late_reader)
+    time.sleep(0.1)
+
+    # The late reader must not get in ahead of the waiting writer
+    assert events == []
+
+    lock.release_read()
+    writer_thread.join(2)
+    reader_thread.join(2)
+
+    assert events == ["write", "late read"]
+
+
+def test_reentrant_read_is_not_blocked_by_waiting_writer():
+    lock = ReentrantReadWriteLock()
+    lock.acquire_read()
+
+    def writer():
+        with lock.write():
+            pass
+
+    writer_thread = start(writer)
+
+    deadline = time.monotonic() + 2
+    while lock.get_stats()["waitingWriters"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # Blocking here would deadlock, the writer waits for this thread's first read to end
+    lock.acquire_read()
+    lock.release_read()
+    lock.release_read()
+
+    writer_thread.join(2)
+    assert not writer_thread.is_alive()
@@ -0,0 +1,152 @@
+import sqlite3
+import pytest
+from pysondb.errors.db_errors import IdNotFoundError
+from services.sqlite_table import SqliteConnectionPool, SqliteTable
+
+
+def create_pool(tmp_path, busy_timeout_ms: int = 5000) -> SqliteConnectionPool:
+    return SqliteConnectionPool(str(tmp_path / "data.sqlite3"), "normal", busy_timeout_ms)
+
+
+@pytest.fixture
+def users_db(tmp_path) -> SqliteTable:
+    users_db = SqliteTable(create_pool(tmp_path), "users", ["userName", "enabled"])
+
+    for user_name, enabled in [("a", True), ("b", False), ("c", True)]:
+        users_db.add({"userName": user_name, "enabled": enabled, "theme": user_name.upper(), "profile": {"theme": user_name}})
+
+    return users_db
+
+
+def user_names(users: list[dict]) -> list[str]:
+    # Records come back in ID order, and IDs are random
+    return sorted(user["userName"] for user in users)
+
+
+def test_get_by_matches_every_field(users_db):
+    assert user_names(users_db.getBy({"enabled": True})) == ["a", "c"]
+    assert user_names(users_db.getBy({"userName": "c", "enabled": True})) == ["c"]
+    assert users_db.getBy({"userName": "c", "enabled": False}) == []
+
+    # A field that isn't indexed
+    assert user_names(users_db.getBy({"theme": "B"})) == ["b"]
+    assert len(users_db.getBy({})) == 3
+
+
+def test_lookups_on_indexed_fields_use_the_index(tmp_path, users_db):
+    connection = sqlite3.connect(str(tmp_path / "data.sqlite3"))
+    plan = connection.execute(
+        "EXPLAIN QUERY PLAN SELECT id, data FROM users WHERE json_extract(data, '$.userName') = ? ORDER BY id",
+        ("a",)).fetchall()
+    connection.close()
+
+    assert any("ix_users_userName" in row[-1] for row in plan)
+
+
+def test_records_round_trip(users_db):
+    user = users_db.getBy({"userName": "a"})[0]
+
+    assert users_db.getById(user["id"]) == user
+    assert user["profile"] == {"theme": "a"}
+
+    users_db.updateById(user["id"], {"enabled": False})
+    assert users_db.getById(user["id"])["enabled"] is False
+    assert users_db.getById(user["id"])["profile"] == {"theme": "a"}
+
+    users_db.deleteById(user["id"])
+
+    with pytest.raises(IdNotFoundError):
+        users_db.getById(user["id"])
+
+    with pytest.raises(IdNotFoundError):
+        users_db.deleteById(user["id"])
+
+    with pytest.raises(IdNotFoundError):
+        users_db.updateById(user["id"], {})
+
+
+def test_fields_and_pages(users_db):
+    users = users_db.getAll()
+    ids = [user["id"] for user in users]
+
+    assert ids == sorted(ids)
+    assert users_db.getAllFields(["userName"]) == [
+        {"id": user["id"], "userName": user["userName"]} for user in users]
+    assert users_db.getFieldsById(ids[1], ["userName", "missing"]) == {
+        "id": ids[1], "userName": users[1]["userName"], "missing": None}
+
+    assert [user["id"] for user in users_db.getPage(None, 2)] == ids[:2]
+    assert [user["id"] for user in users_db.getPage(ids[1], 2)] == ids[2:]
+
+
+def test_identifiers_are_checked(tmp_path):
+    with pytest.raises(ValueError):
+        SqliteTable(create_pool(tmp_path), "users; DROP TABLE x")
+
+    users_db = SqliteTable(create_pool(tmp_path), "users")
+
+    with pytest.raises(ValueError):
+        users_db.getBy({"a') = 1 OR ('": 1})
+
+
+def test_transaction_is_begun_immediately(tmp_path, users_db):
+    pool = create_pool(tmp_path)
+    other_pool = create_pool(tmp_path, busy_timeout_ms=0)
+    table = SqliteTable(pool, "users")
+    other_table = SqliteTable(other_pool, "users")
+
+    pool.begin()
+    table.add({"userName": "d"})
+
+    # The database write lock is taken by begin, another writer can't start
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        other_pool.begin()
+
+    # Readers still see the last commit
+    assert len(other_table.getAll()) == 3
+
+    pool.rollback()
+
+    assert len(other_table.getAll()) == 3
+
+    other_pool.begin()
+    other_table.add({"userName": "e"})
+    other_pool.commit()
+
+    assert user_names(table.getAll()) == ["a", "b", "c", "e"]
+
+
+def test_version_follows_other_connections(tmp_path, users_db):
+    other_db = SqliteTable(create_pool(tmp_path), "users")
+
+    version = users_db.get_version()
+    assert other_db.get_version() == version
+
+    other_db.add({"userName": "d"})
+    assert users_db.get_version() == version + 1
+
+    users_db.add({"userName": "e"})
+    assert other_db.get_version() == version + 2
+    assert users_db.get_version() == version + 2
+
+
+def test_external_version_only_follows_other_processes(tmp_path, users_db):
+    other_db = SqliteTable(create_pool(tmp_path), "users")
+
+    external_version = users_db.get_external_version()
+    other_external_version = other_db.get_external_version()
+
+    users_db.add({"userName": "d"})
+    users_db.deleteById(users_db.getBy({"userName": "d"})[0]["id"])
+
+    assert users_db.get_external_version() == external_version
+    assert other_db.get_external_version() != other_external_version
+
+    other_db.add({"userName": "e"})
+    assert users_db.get_external_version() != external_version
+
+    # Found when this process writes next, without reading the version in between
+    external_version = users_db.get_external_version()
+    other_db.add({"userName": "f"})
+    users_db.add({"userName": "g"})
+    assert users_db.get_external_version() != external_version
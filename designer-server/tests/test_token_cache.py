@@ -0,0 +1,87 @@
+from time import sleep, time
+from services.token_cache_service import TokenCacheService
+
+
+def create_cache(**config) -> TokenCacheService:
+    return TokenCacheService({"max_entries": 100, "ttl_secs": 60, **config})
+
+
+def test_added_tokens_are_found():
+    cache = create_cache()
+    cache.add("a", time() + 600, cache.get_generation())
+
+    assert cache.contains("a")
+    assert not cache.contains("b")
+
+
+def test_entries_never_outlive_the_token():
+    cache = create_cache()
+    cache.add("expired", time() - 1, cache.get_generation())
+    cache.add("short", time() + 0.01, cache.get_generation())
+
+    assert not cache.contains("expired")
+
+    sleep(0.02)
+
+    assert not cache.contains("short")
+
+
+def test_entries_expire_after_ttl():
+    cache = create_cache(ttl_secs=0)
+    cache.add("a", time() + 600, cache.get_generation())
+
+    assert not cache.contains("a")
+
+
+def test_invalidate_removes_token():
+    cache = create_cache()
+    cache.add("a", time() + 600, cache.get_generation())
+    cache.invalidate("a")
+
+    assert not cache.contains("a")
+
+
+def test_lookup_that_raced_a_revoke_is_not_cached():
+    cache = create_cache()
+
+    # Taken before the lookup, then something is revoked before the result is added
+    generation = cache.get_generation()
+    cache.invalidate("other")
+    cache.add("a", time() + 600, generation)
+
+    assert not cache.contains("a")
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = create_cache(max_entries=2)
+    generation = cache.get_generation()
+
+    cache.add("a", time() + 600, generation)
+    cache.add("b", time() + 600, generation)
+    cache.contains("a")
+    cache.add("c", time() + 600, generation)
+
+    assert cache.contains("a")
+    assert not cache.contains("b")
+    assert cache.contains("c")
+    assert cache.get_stats()["evictions"] == 1
+
+
+def test_table_version_change_drops_entries():
+    cache = create_cache()
+    cache.sync_version(1)
+    cache.add("a", time() + 600, cache.get_generation())
+
+    cache.sync_version(1)
+    assert cache.contains("a")
+
+    # Changed by another process, maybe revoking a
+    generation = cache.get_generation()
+    cache.sync_version(2)
+
+    assert not cache.contains("a")
+
+    # A lookup started before the change isn't cached
+    cache.add("b", time() + 600, generation)
+    assert not cache.contains("b")
+    assert cache.get_stats()["resets"] == 1
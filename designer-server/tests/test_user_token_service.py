@@ -0,0 +1,49 @@
+from time import time
+from services.token_cache_service import TokenCacheService
+from services.user_token_service import UserToken, UserTokenService
+
+
+def create_user_token_service(data_service) -> UserTokenService:
+    return UserTokenService(data_service, TokenCacheService({"max_entries": 100, "ttl_secs": 60}), 10, 60)
+
+
+def add_user_token(data_service, user_id: int) -> UserToken:
+    expiry = int(time()) + 600
+    user_token = UserToken(None, user_id, f"access-{user_id}", expiry, f"refresh-{user_id}", expiry)
+    user_token.id = data_service.get_user_tokens_db().add(user_token.to_record())
+    return user_token
+
+
+def check(user_token_service: UserTokenService, user_token: UserToken) -> bool:
+    return user_token_service.is_revoked(user_token.accessTokenJti, "access", user_token.accessTokenExpiry)
+
+
+def test_writes_by_this_process_keep_the_cache(tmp_path, create_data_service):
+    for engine in ["json", "sqlite"]:
+        data_service = create_data_service(tmp_path / engine, engine=engine)
+        user_token_service = create_user_token_service(data_service)
+        token_cache_service = user_token_service.token_cache_service
+
+        user_token = add_user_token(data_service, 1)
+        assert not check(user_token_service, user_token)
+
+        # Logins and logouts of other users
+        add_user_token(data_service, 2)
+        user_token_service.revoke_user(2)
+
+        assert not check(user_token_service, user_token)
+        assert token_cache_service.get_stats()["hits"] == 1
+        assert token_cache_service.get_stats()["resets"] == 0
+
+
+def test_revoke_by_another_process_is_seen(tmp_path, create_data_service):
+    data_service = create_data_service(tmp_path, engine="sqlite")
+    other_data_service = create_data_service(tmp_path, engine="sqlite")
+    user_token_service = create_user_token_service(data_service)
+
+    user_token = add_user_token(data_service, 1)
+    assert not check(user_token_service, user_token)
+
+    create_user_token_service(other_data_service).revoke_user(1)
+
+    assert check(user_token_service, user_token)
@@ -0,0 +1,186 @@
+"""
+A stand-in for the home assistant websocket API, enough of it to run the designer server's hub
+without a real home assistant: authentication, subscribe_entities, call_service for switches
+and lights, and a power sensor that changes on a timer.
+
+    python tools/fake_home_assistant.py --port 8124 --token test-token
+
+Then set home_assistant_url to http://127.0.0.1:8124 and home_assistant_token to test-token in
+config/config.local.yaml.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from websockets.asyncio.server import ServerConnection, serve
+from websockets.exceptions import ConnectionClosed
+
+# Entity ID -> compressed state, in the short key form subscribe_entities sends
+entities: dict[str, dict] = {}
+
+# Connection -> ID of its subscribe_entities subscription
+subscriptions: dict[ServerConnection, int] = {}
+
+
+def add_entity(entity_id: str, state: str, attributes: dict) -> None:
+    now = time.time()
+    entities[entity_id] = {
+        "s": state,
+        "a": attributes,
+        "c": uuid.uuid4().hex,
+        "lc": now,
+        "lu": now
+    }
+
+
+def create_entities() -> None:
+    add_entity("sun.sun", "above_horizon", {
+               "friendly_name": "Sun", "elevation": 35.2})
+    add_entity("switch.kitchen_light", "off", {
+               "friendly_name": "Kitchen Light"})
+    add_entity("switch.clothes_line_light", "off", {
+               "friendly_name": "Clothes Line Light"})
+    add_entity("light.lounge", "on", {
+               "friendly_name": "Lounge", "brightness": 180})
+    add_entity("sensor.power", "0", {
+               "friendly_name": "Power", "unit_of_measurement": "W"})
+
+
+def set_state(entity_id: str, state: str, attributes: dict | None = None) -> dict:
+    # Changes an entity and returns the subscribe_entities change for it
+    entity = entities[entity_id]
+    now = time.time()
+    to_add: dict = {"c": uuid.uuid4().hex}
+
+    if entity["s"] != state:
+        entity["s"] = state
+        entity["lc"] = now
+        to_add["s"] = state
+        to_add["lc"] = now
+    else:
+        to_add["lu"] = now
+
+    entity["lu"] = now
+
+    if attributes:
+        entity["a"].update(attributes)
+        to_add["a"] = attributes
+
+    return {"+": to_add}
+
+
+async def broadcast(changes: dict) -> None:
+    for websocket, subscription_id in list(subscriptions.items()):
+        try:
+            await websocket.send(json.dumps({
+                "id": subscription_id,
+                "type": "event",
+                "event": {"c": changes}
+            }))
+        except Exception:
+            subscriptions.pop(websocket, None)
+
+
+async def call_service(message: dict) -> dict | None:
+    domain = message.get("domain")
+    service = message.get("service")
+    entity_ids = message.get("service_data", {}).get("entity_id", [])
+
+    if isinstance(entity_ids, str):
+        entity_ids = [entity_ids]
+
+    if domain not in ["switch", "light", "homeassistant"] or service not in ["turn_on", "turn_off", "toggle"]:
+        return {"code": "not_found", "message": f"Service {domain}.{service} not found."}
+
+    changes = {}
+
+    for entity_id in entity_ids:
+        if entity_id not in entities:
+            return {"code": "not_found", "message": f"Entity {entity_id} not found."}
+
+        if service == "toggle":
+            state = "off" if entities[entity_id]["s"] == "on" else "on"
+        else:
+            state = "on" if service == "turn_on" else "off"
+
+        changes[entity_id] = set_state(entity_id, state)
+
+    await broadcast(changes)
+
+    return None
+
+
+async def handle(websocket: ServerConnection, token: str) -> None:
+    await websocket.send(json.dumps({"type": "auth_required", "ha_version": "2025.1.0"}))
+
+    message = json.loads(await websocket.recv())
+
+    if message.get("type") != "auth" or message.get("access_token") != token:
+        await websocket.send(json.dumps({"type": "auth_invalid", "message": "Invalid access token or password"}))
+        return
+
+    await websocket.send(json.dumps({"type": "auth_ok", "ha_version": "2025.1.0"}))
+
+    try:
+        async for raw in websocket:
+            message = json.loads(raw)
+            message_id = message.get("id")
+            message_type = message.get("type")
+
+            if message_type == "ping":
+                await websocket.send(json.dumps({"id": message_id, "type": "pong"}))
+            elif message_type == "subscribe_entities":
+                await websocket.send(json.dumps({"id": message_id, "type": "result", "success": True, "result": None}))
+                await websocket.send(json.dumps({"id": message_id, "type": "event", "event": {"a": entities}}))
+                subscriptions[websocket] = message_id
+            elif message_type == "call_service":
+                error = await call_service(message)
+                await websocket.send(json.dumps({
+                    "id": message_id,
+                    "type": "result",
+                    "success": error is None,
+                    **({"error": error} if error else {"result": {"context": {"id": uuid.uuid4().hex}}})
+                }))
+            else:
+                await websocket.send(json.dumps({
+                    "id": message_id,
+                    "type": "result",
+                    "success": False,
+                    "error": {"code": "unknown_command", "message": "Unknown command."}
+                }))
+    except ConnectionClosed:
+        pass
+    finally:
+        subscriptions.pop(websocket, None)
+
+
+async def change_sensors(interval_secs: float) -> None:
+    # A chatty sensor so panels have something to show
+    while True:
+        await asyncio.sleep(interval_secs)
+        value = str(round(random.uniform(200, 3500), 1))
+        await broadcast({"sensor.power": set_state("sensor.power", value)})
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Stand-in home assistant websocket API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8124)
+    parser.add_argument("--token", default="test-token")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="seconds between power sensor changes")
+    args = parser.parse_args()
+
+    create_entities()
+
+    async with serve(lambda websocket: handle(websocket, args.token), args.host, args.port):
+        print(
+            f"Fake home assistant listening on ws://{args.host}:{args.port}/api/websocket")
+        await change_sensors(args.interval)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,92 +1,298 @@
 import { useAppStore } from '@/stores/app-store';
-import { getHomeAssistantToken } from './api';
-import { getWebSocketBaseUrl } from './url';
+import { useAuthService } from './authService';
+import { combinePathWithBaseUrl } from './url';
 
 /*********************************************************************
- * See: https://github.com/home-assistant/home-assistant-js-websocket
+ * The server holds the one connection to home assistant and streams
+ * entity states to each panel as server sent events. The stream is
+ * read with fetch (rather than EventSource) so the access token can be
+ * sent in the Authorization header.
+ *
+ * The first event is a snapshot of every entity, after that numbered
+ * deltas hold just what changed. If a delta is missed the stream is
+ * reopened to get a new snapshot.
+ *
+ * A panel opened with ?dashboard=<id> in its URL only gets the entities
+ * that dashboard uses.
  *********************************************************************/
 
-import {
-  Auth,
-  createConnection,
-  subscribeEntities,
-  Connection,
-  ERR_INVALID_AUTH,
-  createLongLivedTokenAuth,
-  ERR_CANNOT_CONNECT,
-  ERR_CONNECTION_LOST,
-  ERR_HASS_HOST_REQUIRED,
-  ERR_INVALID_HTTPS_TO_HTTP,
-  type HassEntities,
-  type HassEntity,
-  callService
-} from 'home-assistant-js-websocket';
-import { updateHassEntities } from './web-component';
-
-const url = getWebSocketBaseUrl();
-let connection: Connection | undefined = undefined;
-
-const errorToMessage = (err: unknown): string => {
-  switch (err) {
-    case ERR_CANNOT_CONNECT:
-      return 'ERR_CANNOT_CONNECT';
-    case ERR_INVALID_AUTH:
-      return 'ERR_INVALID_AUTH';
-    case ERR_CONNECTION_LOST:
-      return 'ERR_CONNECTION_LOST';
-    case ERR_HASS_HOST_REQUIRED:
-      return 'ERR_HASS_HOST_REQUIRED';
-    case ERR_INVALID_HTTPS_TO_HTTP:
-      return 'ERR_INVALID_HTTPS_TO_HTTP';
-    default:
-      return 'Unknown';
+import { type HassEntities, type HassEntity } from 'home-assistant-js-websocket';
+
+const STREAM_URL = '/home-assistant/stream';
+const SERVICES_URL = '/home-assistant/services';
+
+// Reconnect delays double from the min up to the max after each failure
+const RECONNECT_MIN_MS = 1000;
+const RECONNECT_MAX_MS = 30000;
+
+// What changed in an entity, only the changed fields are present
+interface EntityDiff {
+  s?: string; // State
+  a?: Record<string, unknown>; // Attributes added or changed
+  r?: string[]; // Attributes removed
+  c?: string | HassEntity['context']; // Context, or just its ID
+  lc?: string; // Last changed (and last updated unless lu is set)
+  lu?: string; // Last updated
+}
+
+interface DeltaEvent {
+  seq: number;
+  added?: HassEntities;
+  changed?: Record<string, EntityDiff>;
+  removed?: string[];
+}
+
+interface SnapshotEvent {
+  seq: number;
+  connected: boolean;
+  entities: HassEntities;
+}
+
+let abortController: AbortController | undefined = undefined;
+let entities: HassEntities = {};
+
+// The sequence number of the last delta applied, and the ID of the last event
+let seq = -1;
+let lastEventId: string | undefined = undefined;
+
+// The server dashboard whose entities are streamed, every entity when not set
+let dashboardId: string | undefined = undefined;
+
+// Thrown when a delta is missed and the stream must start again from a snapshot
+class ResyncError extends Error {}
+
+const getAuthorizationHeaders = (): Record<string, string> => {
+  const appStore = useAppStore();
+  const accessToken = appStore.userToken?.accessToken;
+
+  return accessToken ? { Authorization: `Bearer ${accessToken}` } : {};
+};
+
+const delay = (ms: number, signal: AbortSignal): Promise<void> => {
+  return new Promise((resolve) => {
+    const timer = setTimeout(resolve, ms);
+    signal.addEventListener('abort', () => {
+      clearTimeout(timer);
+      resolve();
+    });
+  });
+};
+
+const setEntities = (newEntities: HassEntities): void => {
+  // Always a new object so the store watchers (which update the components) see the change
+  entities = newEntities;
+
+  const appStore = useAppStore();
+  appStore.setHomeAssistantEntities(entities);
+};
+
+const applyDiff = (entity: HassEntity, diff: EntityDiff): HassEntity => {
+  let attributes = entity.attributes;
+
+  if (diff.a || diff.r) {
+    attributes = { ...attributes, ...diff.a };
+    diff.r?.forEach((name) => delete attributes[name]);
+  }
+
+  return {
+    ...entity,
+    state: diff.s ?? entity.state,
+    attributes,
+    context: typeof diff.c === 'string' ? { ...entity.context, id: diff.c } : (diff.c ?? entity.context),
+    last_changed: diff.lc ?? entity.last_changed,
+    last_updated: diff.lu ?? diff.lc ?? entity.last_updated
+  };
+};
+
+const handleEvent = (event: string, data: string): void => {
+  switch (event) {
+    case 'snapshot': {
+      const snapshot = JSON.parse(data) as SnapshotEvent;
+      seq = snapshot.seq;
+      setEntities(snapshot.entities);
+      break;
+    }
+
+    case 'delta': {
+      const delta = JSON.parse(data) as DeltaEvent;
+
+      if (delta.seq !== seq + 1) {
+        throw new ResyncError(`Expected delta ${seq + 1} but got ${delta.seq}`);
+      }
+
+      const newEntities = { ...entities, ...delta.added };
+
+      Object.entries(delta.changed ?? {}).forEach(([entityId, diff]) => {
+        const entity = newEntities[entityId];
+
+        if (!entity) {
+          throw new ResyncError(`Delta for unknown entity '${entityId}'`);
+        }
+
+        newEntities[entityId] = applyDiff(entity, diff);
+      });
+
+      delta.removed?.forEach((entityId) => delete newEntities[entityId]);
+
+      seq = delta.seq;
+      setEntities(newEntities);
+      break;
+    }
   }
 };
 
-export const homeAssistantConnect = async (container: HTMLElement): Promise<void> => {
+// Returns true if the stream was opened, false if it was refused
+const readStream = async (signal: AbortSignal, onEvent: (event: string, data: string) => void): Promise<boolean> => {
+  // After a reconnect the server only sends the deltas missed, if it still has them
+  const resumeHeaders: Record<string, string> = lastEventId ? { 'Last-Event-ID': lastEventId } : {};
+
+  const url = dashboardId ? `${STREAM_URL}?dashboard=${encodeURIComponent(dashboardId)}` : STREAM_URL;
+
+  const response = await fetch(combinePathWithBaseUrl(url), {
+    headers: { Accept: 'text/event-stream', ...resumeHeaders, ...getAuthorizationHeaders() },
+    signal
+  });
+
+  if (!response.ok || !response.body) {
+    if (response.status === 401) {
+      // Access token expired, refresh it before trying again
+      await useAuthService().refreshToken();
+    } else if (response.status === 404 && dashboardId) {
+      // The dashboard was deleted, stream every entity instead
+      console.warn(`Home assistant stream dashboard '${dashboardId}' not found`);
+      dashboardId = undefined;
+      lastEventId = undefined;
+    }
+
+    return false;
+  }
+
+  const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+  let buffer = '';
+
   try {
-    const appStore = useAppStore();
-    appStore.incrementBusy();
+    while (!signal.aborted) {
+      const { value, done } = await reader.read();
 
-    // Get long lived token from the server
-    const token = await getHomeAssistantToken();
+      if (done) {
+        break;
+      }
 
-    if (token === undefined) {
-      appStore.decrementBusy();
-      // No token then don't connect
-      return;
+      buffer += value;
+
+      // Events are separated by a blank line
+      let end = buffer.indexOf('\n\n');
+
+      while (end >= 0) {
+        const lines = buffer.substring(0, end).split('\n');
+        buffer = buffer.substring(end + 2);
+        end = buffer.indexOf('\n\n');
+
+        let event = 'message';
+        let id: string | undefined = undefined;
+        const data: string[] = [];
+
+        for (const line of lines) {
+          // Lines starting with ':' are keepalive comments
+          if (line.startsWith('event: ')) {
+            event = line.substring(7);
+          } else if (line.startsWith('data: ')) {
+            data.push(line.substring(6));
+          } else if (line.startsWith('id: ')) {
+            id = line.substring(4);
+          }
+        }
+
+        if (data.length > 0) {
+          onEvent(event, data.join('\n'));
+        }
+
+        // Only remembered once the event has been applied
+        if (id !== undefined) {
+          lastEventId = id;
+        }
+      }
     }
+  } finally {
+    // Closes the connection if the stream is left early
+    reader.cancel().catch(() => undefined);
+  }
+
+  return true;
+};
+
+export const homeAssistantConnect = async (): Promise<void> => {
+  // Only one stream at a time
+  homeAssistantClose();
+
+  const controller = new AbortController();
+  abortController = controller;
 
-    const auth: Auth = createLongLivedTokenAuth(url, token);
+  dashboardId = new URLSearchParams(window.location.search).get('dashboard') ?? undefined;
+  lastEventId = undefined;
 
-    connection = await createConnection({ auth });
+  const appStore = useAppStore();
+  appStore.incrementBusy();
 
-    subscribeEntities(connection, (entities: HassEntities) => {
-      appStore.setHomeAssistantEntities(entities);
-      updateHassEntities(container, entities);
+  // Busy until the first snapshot arrives or the first attempt fails
+  let busy = true;
+  const releaseBusy = (): void => {
+    if (busy) {
+      busy = false;
       appStore.decrementBusy();
-    });
-  } catch (err: unknown) {
-    throw Error(`Connection to home assistant failed with: '${errorToMessage(err)}'`);
+    }
+  };
+
+  let reconnectMs = RECONNECT_MIN_MS;
+
+  while (!controller.signal.aborted) {
+    try {
+      if (appStore.userToken) {
+        const opened = await readStream(controller.signal, (event, data) => {
+          handleEvent(event, data);
+          releaseBusy();
+        });
+
+        if (opened) {
+          reconnectMs = RECONNECT_MIN_MS;
+        }
+      }
+    } catch (err: unknown) {
+      if (err instanceof ResyncError) {
+        // Start again from a snapshot straight away
+        console.warn(`Home assistant stream resync: ${err.message}`);
+        lastEventId = undefined;
+        reconnectMs = 0;
+      } else if (!controller.signal.aborted) {
+        console.error(`Home assistant stream failed with: '${err}'`);
+      }
+    }
+
+    releaseBusy();
+
+    await delay(reconnectMs, controller.signal);
+    reconnectMs = Math.min(RECONNECT_MAX_MS, Math.max(RECONNECT_MIN_MS, reconnectMs * 2));
   }
 };
 
 export const homeAssistantClose = (): void => {
-  connection?.close();
-  connection = undefined;
+  abortController?.abort();
+  abortController = undefined;
 };
 
 export const toggleEntity = async (entity: HassEntity): Promise<void> => {
-  if (!connection) {
-    // Can't toggle entity if not connected
-    return;
-  }
-
   // Get entity domain and service
   const domain = entity.entity_id.split('.')[0];
   const service = entity.state === 'on' ? 'turn_off' : 'turn_on';
 
-  await callService(connection, domain, service, {
-    entity_id: entity.entity_id
+  // The server makes the call on its home assistant connection
+  const response = await fetch(combinePathWithBaseUrl(`${SERVICES_URL}/${domain}/${service}`), {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', ...getAuthorizationHeaders() },
+    body: JSON.stringify({ entity_id: entity.entity_id })
   });
+
+  if (!response.ok) {
+    console.error(`Toggle of '${entity.entity_id}' failed with status ${response.status}`);
+  }
 };
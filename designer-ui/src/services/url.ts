@@ -35,14 +35,13 @@ export const getApiBaseUrl = (): string => {
   return baseUrl;
 };
 
-export const getWebSocketBaseUrl = (): string => {
+export const getComponentsVersion = (): string => {
   /*
-   * Get WebSocket base URL from hidden input in index.html, the hidden input is injected by
-   * the server so that it does not need to be compiled in to the SPA.
-   * This allows the server to inject the API URL when the SPA is loading on the server.
-   * However, during development it will the value set in the local index.html
+   * Get the component manifest version from hidden input in index.html, the server fills it in
+   * so that component bundle URLs change whenever a component changes (and can be cached until then).
+   * During development it is empty and bundles are always revalidated.
    */
 
-  const baseUrl = (document.getElementById('ws-base-url') as HTMLInputElement)?.value ?? '/';
-  return baseUrl;
+  const version = (document.getElementById('components-version') as HTMLInputElement)?.value ?? '';
+  return version;
 };
@@ -1,11 +1,12 @@
 import type { HassEntities } from 'home-assistant-js-websocket';
-import { getApiBaseUrl } from './url';
+import { getApiBaseUrl, getComponentsVersion } from './url';
 import { nextTick } from 'vue';
 import { useAppStore } from '@/stores/app-store';
 
 export const CWC_PREFIX = 'cwc-';
 
 const apiBaseUrl = getApiBaseUrl();
+const componentsVersion = getComponentsVersion();
 
 export interface CwcWebComponent {
   hass: HassEntities;
@@ -48,14 +49,58 @@ const loadScriptFromUrl = async (url: string): Promise<void> => {
   });
 };
 
+// Component name -> load of the bundle that includes it
+const componentLoads = new Map<string, Promise<void>>();
+
+// Names waiting to be loaded in the next bundle
+let pendingNames: string[] = [];
+let pendingBundle: Promise<void> | undefined;
+
+const loadComponentScript = (name: string): Promise<void> => {
+  const existing = componentLoads.get(name);
+  if (existing) {
+    return existing;
+  }
+
+  pendingNames.push(name);
+
+  if (!pendingBundle) {
+    pendingBundle = new Promise<void>((resolve, reject) => {
+      // Wait a tick so that all the components mounted together are loaded in one request
+      setTimeout(() => {
+        const names = pendingNames.sort();
+
+        pendingNames = [];
+        pendingBundle = undefined;
+
+        let url = `${apiBaseUrl}/component-bundle?names=${names.map((n) => encodeURIComponent(n)).join(',')}`;
+        if (componentsVersion) {
+          url += `&v=${componentsVersion}`;
+        }
+
+        loadScriptFromUrl(url).then(resolve, reject);
+      }, 0);
+    });
+  }
+
+  const load = pendingBundle;
+
+  // A failed load can be tried again
+  load.catch(() => componentLoads.delete(name));
+
+  componentLoads.set(name, load);
+  return load;
+};
+
 export const loadWebComponent = async (name: string, finishedLoading: (hadError: boolean) => void): Promise<void> => {
   try {
-    const url = `${apiBaseUrl}/components/${name}`;
     const componentName = `${CWC_PREFIX}${name}`;
 
     let loadError = false;
     try {
-      await loadScriptFromUrl(url);
+      if (!customElements.get(componentName)) {
+        await loadComponentScript(name);
+      }
     } catch (e) {
       console.error(e);
       loadError = true;
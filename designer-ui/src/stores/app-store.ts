@@ -1,7 +1,7 @@
 import { computed, ref } from 'vue';
 import { defineStore } from 'pinia';
 import { clearMessage, type MessageData } from '@/services/message';
-import type { AccessToken, HomeAssistantToken, User } from '@/services/authService';
+import type { AccessToken, User } from '@/services/authService';
 import { useLocalSessionJsonObject } from '@/composables/local-session';
 import { type HassEntities } from 'home-assistant-js-websocket';
 
@@ -13,7 +13,6 @@ export const useAppStore = defineStore('app', () => {
   const serverOnline = ref(false);
   const userToken = ref<AccessToken | undefined>(undefined);
   const user = ref<User | undefined>(undefined);
-  const homeAssistantToken = ref<HomeAssistantToken | undefined>(undefined);
   const homeAssistantEntities = ref<HassEntities | undefined>(undefined);
 
   const isBusy = computed(() => isBusyCount.value > 0);
@@ -50,10 +49,6 @@ export const useAppStore = defineStore('app', () => {
     }
   };
 
-  const setHomeAssistantToken = (token: HomeAssistantToken | undefined): void => {
-    homeAssistantToken.value = token;
-  };
-
   const setHomeAssistantEntities = (entities: HassEntities | undefined): void => {
     homeAssistantEntities.value = entities;
   };
@@ -71,9 +66,7 @@ export const useAppStore = defineStore('app', () => {
 
     user,
     userToken,
-    homeAssistantToken,
     setUserToken,
-    setHomeAssistantToken,
 
     homeAssistantEntities,
     setHomeAssistantEntities